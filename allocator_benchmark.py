@@ -0,0 +1,155 @@
+"""
+Contention benchmark of Allocator: hundreds of threads act as peers of
+one torrent (null storage, no sockets). Every peer sends bitfield and
+haves, loads blocks, uploads blocks of present pieces and reconnects
+from time to time (so bitfields are added and removed). Between rounds
+peer sleeps as if it waits for network. Prints throughput and latencies
+of allocator calls: time spent waiting for locks is in them.
+
+    python allocator_benchmark.py [--peers 300] [--pieces 20000]
+"""
+import time
+import queue
+import random
+import logging
+import argparse
+import threading
+from collections import defaultdict
+from torrent_info import Messages
+from data_storage import STORAGE_NULL
+from pieces_allocator import Allocator
+from torrent_fixtures import make_torrent
+
+PIECE_LENGTH = 16 * Messages.piece_segment_length
+BLOCK = bytes(Messages.piece_segment_length)
+LOGGER = logging.getLogger("benchmark")
+
+
+class SimulatedLoader:
+    def __init__(self):
+        self.finished = threading.Event()
+
+    def is_piece_correct(self, piece_index, piece):
+        return True
+
+    def finish_downloading(self):
+        self.finished.set()
+
+    def save_resume_data(self):
+        pass
+
+
+class SimulatedPeer(threading.Thread):
+    def __init__(self, index, allocator, pieces_count, seed, rounds,
+                 reconnect_rounds, delay):
+        threading.Thread.__init__(self)
+        self.index = index
+        self.peer_address = ("simulated", index)
+        self.allocator = allocator
+        self.pieces_count = pieces_count
+        self.seed = seed
+        self.rounds = rounds
+        self.reconnect_rounds = reconnect_rounds
+        self.delay = delay
+        self.messages = queue.Queue()
+        self.haves_count = 0
+        self.blocks_count = 0
+        self.latencies = defaultdict(list)
+
+    def send_cancel_message(self, piece_index, begin, length):
+        self.messages.put((piece_index, begin, length))
+
+    def _timed(self, method, *args):
+        start = time.perf_counter()
+        result = method(*args)
+        self.latencies[method.__name__].append(time.perf_counter() - start)
+        return result
+
+    def run(self):
+        rand = random.Random(self.index)
+        bitfield = bytearray(-(-self.pieces_count // 8))
+        have = list(range(self.pieces_count)) if self.seed else \
+            rand.sample(range(self.pieces_count), self.pieces_count // 2)
+        for piece_index in have:
+            bitfield[piece_index // 8] |= 0x80 >> (piece_index % 8)
+        self._timed(self.allocator.add_bitfield_info, bytes(bitfield), self)
+        for round_index in range(1, self.rounds + 1):
+            for _ in range(16):
+                block = self._timed(self.allocator.try_get_block, self)
+                if block is None:
+                    break
+                piece_index, begin, length = block
+                self._timed(self.allocator.add_block, piece_index, begin,
+                            BLOCK[:length], self)
+                self.blocks_count += 1
+            haves, self.haves_count = self._timed(
+                self.allocator.get_new_haves, self, self.haves_count)
+            self._timed(self.allocator.add_have_info,
+                        rand.randrange(self.pieces_count), self)
+            self._timed(self.allocator.try_get_piece_segment,
+                        rand.randrange(self.pieces_count), 0, len(BLOCK))
+            if self.allocator.get_left_bytes_count() == 0:
+                break
+            if round_index % self.reconnect_rounds == 0:
+                self._timed(self.allocator.remove_peer, self)
+                self._timed(self.allocator.add_bitfield_info,
+                            bytes(bitfield), self)
+            time.sleep(self.delay)
+        self._timed(self.allocator.remove_peer, self)
+
+
+def _percentile(values, part):
+    return values[min(len(values) - 1, int(len(values) * part))]
+
+
+def run_benchmark(peers_count, pieces_count, rounds, reconnect_rounds,
+                  delay, seeds_part=0.1):
+    torrent = make_torrent([pieces_count * PIECE_LENGTH], PIECE_LENGTH,
+                           logger_name="benchmark")
+    loader = SimulatedLoader()
+    allocator = Allocator(torrent, None, LOGGER, loader,
+                          storage_backend=STORAGE_NULL)
+    peers = [SimulatedPeer(index, allocator, pieces_count,
+                           index < peers_count * seeds_part, rounds,
+                           reconnect_rounds, delay)
+             for index in range(peers_count)]
+    start = time.perf_counter()
+    for peer in peers:
+        peer.start()
+    for peer in peers:
+        peer.join()
+    elapsed = time.perf_counter() - start
+    allocator.close()
+    blocks_count = sum(peer.blocks_count for peer in peers)
+    print("~ %d peers, %d pieces: %.2f sec, %d blocks (%.0f blocks/sec)"
+          % (peers_count, pieces_count, elapsed, blocks_count,
+             blocks_count / elapsed))
+    latencies = defaultdict(list)
+    for peer in peers:
+        for name, values in peer.latencies.items():
+            latencies[name] += values
+    print("%-22s %8s %12s %12s %12s"
+          % ("call", "count", "median, us", "p99, us", "max, ms"))
+    for name, values in latencies.items():
+        values.sort()
+        print("%-22s %8d %12.1f %12.1f %12.1f"
+              % (name, len(values), _percentile(values, 0.5) * 10 ** 6,
+                 _percentile(values, 0.99) * 10 ** 6, values[-1] * 10 ** 3))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--peers", type=int, default=300)
+    parser.add_argument("--pieces", type=int, default=20000)
+    parser.add_argument("--rounds", type=int, default=100)
+    parser.add_argument("--reconnect-rounds", type=int, default=25)
+    parser.add_argument("--delay", type=float, default=0.02,
+                        help="sleep of peer between rounds, sec")
+    args = parser.parse_args()
+    run_benchmark(args.peers, args.pieces, args.rounds,
+                  args.reconnect_rounds, args.delay)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,5 @@
+from collections.abc import Mapping
+
 DIGITS = [str(x) for x in range(10)]
 
 
@@ -132,62 +134,557 @@ class BencodeParser:
                             'dictionary key')
 
 
-def _add_int(source, collection):
-    collection.append(b"i")
-    collection.append(str(source).encode())
-    collection.append(b"e")
-
-
-def _add_str_or_bytes(source, collection):
-    collection.append(str(len(source)).encode())
-    collection.append(b":")
-    if isinstance(source, str):
-        collection.append(source.encode())
-    else:
-        collection.append(source)
-
-
-def _add_list(source, collection):
-    collection.append(b"l")
-    for elem in source:
-        _translate(elem, collection)
-    collection.append(b"e")
-
-
-def _add_dict(source, collection):
-    collection.append(b"d")
-    keys = list(source.keys())
-    keys.sort()
-    for key in keys:
-        if not isinstance(key, (str, bytes)):
-            raise TypeError("Keys in bencode dictionary "
-                            "can be strings or bytes only")
-        _translate(key, collection)
-        _translate(source[key], collection)
-    collection.append(b"e")
-
-
-def _translate(source, collection):
-    if isinstance(source, int):
-        _add_int(source, collection)
-    elif isinstance(source, (str, bytes)):
-        _add_str_or_bytes(source, collection)
-    elif isinstance(source, list):
-        _add_list(source, collection)
-    elif isinstance(source, dict):
-        _add_dict(source, collection)
-    else:
-        raise TypeError("Cannot convert to bencode object "
+_INT = ord('i')
+_LIST = ord('l')
+_DICT = ord('d')
+_END = ord('e')
+_ZERO = ord('0')
+_NINE = ord('9')
+_NO_KEY = object()
+
+MAX_STREAM_DEPTH = 64
+MAX_STREAM_STRING_LENGTH = 2 ** 24
+MAX_STREAM_NUMBER_LENGTH = 64
+
+
+class BencodeDecoder:
+    """
+    Non-recursive decoder over one buffer. Integers and string lengths are
+    found with bytes.index, nested values are tracked with an explicit
+    stack, and raw byte spans of any sub-value are available as memoryview
+    slices of the original source (without re-encoding).
+    """
+    def __init__(self, source):
+        if isinstance(source, str):
+            source = source.encode()
+        elif not isinstance(source, bytes):
+            source = bytes(source)
+        self._source = source
+        self._view = memoryview(source)
+        self._length = len(source)
+        self._ends = {}
+
+    def parse(self):
+        content = []
+        index = 0
+        while index < self._length:
+            extracted, index = self.decode(index)
+            content.append(extracted)
+        return content
+
+    def decode(self, index=0):
+        source = self._source
+        length = self._length
+        stack = []
+        while True:
+            if index >= length:
+                if stack:
+                    name = "dictionary" if isinstance(stack[-1][0], dict) \
+                        else "list"
+                    raise Exception("Error in bencode: unexpected end "
+                                    "of source during reading " + name)
+                raise Exception("Error in bencode: unexpected end of source")
+            symbol = source[index]
+            if symbol == _END and stack:
+                value, key = stack.pop()
+                if key is not _NO_KEY:
+                    raise Exception('Error in bencode: dictionary key "' +
+                                    key.decode() + '" has no value')
+                index += 1
+            elif _ZERO <= symbol <= _NINE:
+                value, index = self._read_string(index)
+            elif symbol == _INT:
+                value, index = self._read_int(index + 1)
+            elif symbol == _LIST:
+                stack.append([[], _NO_KEY])
+                index += 1
+                continue
+            elif symbol == _DICT:
+                stack.append([{}, _NO_KEY])
+                index += 1
+                continue
+            else:
+                raise Exception("Error in bencode: byte № " + str(index) +
+                                " value " + str(symbol))
+
+            if not stack:
+                return value, index
+            top = stack[-1]
+            container = top[0]
+            if isinstance(container, list):
+                container.append(value)
+            elif top[1] is _NO_KEY:
+                BencodeParser._is_key_string(value)
+                top[1] = value
+            else:
+                container[top[1]] = value
+                top[1] = _NO_KEY
+
+    def skip(self, index=0):
+        """Returns index of the first byte after the value at index"""
+        ends = self._ends
+        if index in ends:
+            return ends[index]
+        source = self._source
+        length = self._length
+        start = index
+        depth = 0
+        while True:
+            if index >= length:
+                raise Exception("Error in bencode: unexpected end of source")
+            symbol = source[index]
+            if _ZERO <= symbol <= _NINE:
+                colon = source.find(b":", index)
+                digits = source[index:colon]
+                if colon == -1 or not digits.isdigit():
+                    self._find_string(index)
+                index = colon + 1 + int(digits)
+            elif symbol == _INT:
+                end = source.find(b"e", index)
+                digits = source[index + 1:end]
+                if digits[:1] == b"-":
+                    digits = digits[1:]
+                if end == -1 or not digits.isdigit():
+                    self._read_int(index + 1)
+                index = end + 1
+            elif symbol == _LIST or symbol == _DICT:
+                if depth > 0 and index in ends:
+                    index = ends[index]
+                    continue
+                depth += 1
+                index += 1
+            elif symbol == _END and depth > 0:
+                depth -= 1
+                index += 1
+            else:
+                raise Exception("Error in bencode: byte № " + str(index) +
+                                " value " + str(symbol))
+            if depth == 0:
+                if index > length:
+                    raise Exception("Error in bencode: unexpected end of "
+                                    "source during reading string")
+                if index - start > 1:
+                    ends[start] = index
+                return index
+
+    def find_span(self, path=(), index=0):
+        """
+        Returns (start, end) offsets of the value reached from the value
+        at index through path: bytes items select dictionary keys,
+        int items select list elements. Returns None if there is no such
+        value.
+        """
+        source = self._source
+        for step in path:
+            if index >= self._length:
+                return None
+            symbol = source[index]
+            if symbol == _DICT and isinstance(step, bytes):
+                index += 1
+                while index < self._length and source[index] != _END:
+                    start, end = self._find_string(index)
+                    if source[start:end] == step:
+                        index = end
+                        break
+                    index = self.skip(end)
+                else:
+                    return None
+            elif symbol == _LIST and isinstance(step, int):
+                index += 1
+                for _ in range(step):
+                    if index >= self._length or source[index] == _END:
+                        return None
+                    index = self.skip(index)
+                if index >= self._length or source[index] == _END:
+                    return None
+            else:
+                return None
+        return index, self.skip(index)
+
+    def lazy(self, index=0):
+        """
+        Dictionary at index is returned as a view which decodes its values
+        on first access, other values are decoded at once
+        """
+        if index < self._length and self._source[index] == _DICT:
+            return BencodeDictView(self, index)
+        return self.decode(index)[0]
+
+    def raw(self, path=(), index=0):
+        """Memoryview of the original bytes of the value (see find_span)"""
+        span = self.find_span(path, index)
+        if span is None:
+            return None
+        return self._view[span[0]:span[1]]
+
+    def _read_int(self, index):
+        source = self._source
+        try:
+            end = source.index(b"e", index)
+        except ValueError:
+            end = -1
+        if end != -1:
+            digits = source[index:end]
+            if digits[:1] == b"-":
+                digits = digits[1:]
+            if digits.isdigit():
+                return int(source[index:end]), end + 1
+        BencodeParser._parse_int(source, index)
+        raise Exception("Error in bencode: incorrect symbol in integer number")
+
+    def _find_string(self, index):
+        source = self._source
+        try:
+            colon = source.index(b":", index)
+        except ValueError:
+            colon = -1
+        if colon != -1 and source[index:colon].isdigit():
+            start = colon + 1
+            end = start + int(source[index:colon])
+            if end > self._length:
+                raise Exception("Error in bencode: unexpected end of "
+                                "source during reading string")
+            return start, end
+        BencodeParser._get_string_length(source, index)
+        raise Exception("Error in bencode: incorrect symbol in string length")
+
+    def _read_string(self, index):
+        start, end = self._find_string(index)
+        return self._source[start:end], end
+
+
+class BencodeDictView(Mapping):
+    """
+    Read-only dictionary over bencoded source. Keys are indexed on demand
+    (sorted order of keys lets a lookup stop at the first greater key) and
+    values are decoded (lazily) on first access.
+    """
+    def __init__(self, decoder: BencodeDecoder, index=0):
+        if index >= decoder._length or decoder._source[index] != _DICT:
+            raise Exception("Error in bencode: dictionary expected at "
+                            "byte № " + str(index))
+        self._decoder = decoder
+        self._start = index
+        self._offsets = {}
+        self._values = {}
+        self._next = index + 1
+        self._unskipped = None
+        self._last_key = None
+        self._is_sorted = True
+        self.end = None
+
+    def _index_keys(self, key=None):
+        decoder = self._decoder
+        source = decoder._source
+        while self.end is None:
+            if key is not None and (key in self._offsets or (
+                    self._is_sorted and self._last_key is not None and
+                    self._last_key > key)):
+                return
+            if self._unskipped is not None:
+                self._next = decoder.skip(self._unskipped)
+                self._unskipped = None
+            index = self._next
+            if index >= decoder._length:
+                raise Exception("Error in bencode: unexpected end "
+                                "of source during reading dictionary")
+            if source[index] == _END:
+                self.end = index + 1
+                decoder._ends[self._start] = self.end
+                return
+            if not _ZERO <= source[index] <= _NINE:
+                raise Exception('Error in bencode: key at byte № ' +
+                                str(index) + ' is not a string, so it '
+                                'cannot be dictionary key')
+            start, end = decoder._find_string(index)
+            new_key = source[start:end]
+            if self._last_key is not None and new_key < self._last_key:
+                self._is_sorted = False
+            self._last_key = new_key
+            self._offsets[new_key] = end
+            self._unskipped = end
+
+    def __getitem__(self, key):
+        if key in self._values:
+            return self._values[key]
+        self._index_keys(key)
+        value = self._decoder.lazy(self._offsets[key])
+        self._values[key] = value
+        return value
+
+    def __iter__(self):
+        self._index_keys()
+        return iter(self._offsets)
+
+    def __len__(self):
+        self._index_keys()
+        return len(self._offsets)
+
+    def __contains__(self, key):
+        self._index_keys(key)
+        return key in self._offsets
+
+    def raw(self, key):
+        """Memoryview of the original bytes of the value"""
+        self._index_keys(key)
+        start = self._offsets[key]
+        return self._decoder._view[start:self._decoder.skip(start)]
+
+
+class BencodeStreamDecoder:
+    """
+    Resumable decoder: chunks are pushed with feed() as they arrive and
+    complete top-level values are taken with results(). Only the unparsed
+    tail of the last chunk and the string being read are kept in memory.
+    """
+    def __init__(self, max_depth=MAX_STREAM_DEPTH,
+                 max_string_length=MAX_STREAM_STRING_LENGTH):
+        self._max_depth = max_depth
+        self._max_string_length = max_string_length
+        self._buffer = bytearray()
+        self._stack = []
+        self._string = None
+        self._string_left = 0
+        self._results = []
+
+    def feed(self, chunk):
+        buffer = self._buffer
+        buffer += chunk
+        index = 0
+        length = len(buffer)
+        with memoryview(buffer) as view:
+            while index < length:
+                if self._string is not None:
+                    taken = min(self._string_left, length - index)
+                    self._string += view[index:index + taken]
+                    self._string_left -= taken
+                    index += taken
+                    if self._string_left == 0:
+                        value = bytes(self._string)
+                        self._string = None
+                        self._add(value)
+                    continue
+                symbol = buffer[index]
+                if _ZERO <= symbol <= _NINE:
+                    colon = buffer.find(b":", index)
+                    if colon == -1:
+                        self._check_string_length(buffer[index:length])
+                        break
+                    count = self._check_string_length(buffer[index:colon])
+                    index = colon + 1
+                    if count == 0:
+                        self._add(b"")
+                    else:
+                        self._string = bytearray()
+                        self._string_left = count
+                elif symbol == _INT:
+                    end = buffer.find(b"e", index)
+                    if end == -1:
+                        self._check_int(buffer[index + 1:length], False)
+                        break
+                    value = self._check_int(buffer[index + 1:end], True)
+                    index = end + 1
+                    self._add(value)
+                elif symbol == _LIST or symbol == _DICT:
+                    if len(self._stack) >= self._max_depth:
+                        raise Exception("Error in bencode: nesting is "
+                                        "deeper than %d" % self._max_depth)
+                    container = [] if symbol == _LIST else {}
+                    self._stack.append([container, _NO_KEY])
+                    index += 1
+                elif symbol == _END and self._stack:
+                    value, key = self._stack.pop()
+                    if key is not _NO_KEY:
+                        raise Exception('Error in bencode: dictionary key "' +
+                                        key.decode() + '" has no value')
+                    index += 1
+                    self._add(value)
+                else:
+                    raise Exception("Error in bencode: byte value " +
+                                    str(symbol))
+        del buffer[:index]
+
+    def is_complete(self):
+        return not self._stack and self._string is None and \
+            not self._buffer
+
+    def results(self):
+        if not self.is_complete():
+            raise Exception("Error in bencode: unexpected end of source")
+        return self._results
+
+    def _add(self, value):
+        if not self._stack:
+            self._results.append(value)
+            return
+        top = self._stack[-1]
+        container = top[0]
+        if isinstance(container, list):
+            container.append(value)
+        elif top[1] is _NO_KEY:
+            BencodeParser._is_key_string(value)
+            top[1] = value
+        else:
+            container[top[1]] = value
+            top[1] = _NO_KEY
+
+    def _check_string_length(self, digits):
+        if len(digits) > MAX_STREAM_NUMBER_LENGTH:
+            raise Exception("Error in bencode: string length is too long")
+        if digits and not digits.isdigit():
+            raise Exception("Error in bencode: incorrect symbol in "
+                            "string length")
+        count = int(digits) if digits else 0
+        if count > self._max_string_length:
+            raise Exception("Error in bencode: string length %d exceeds "
+                            "limit %d" % (count, self._max_string_length))
+        return count
+
+    @staticmethod
+    def _check_int(digits, is_finished):
+        if len(digits) > MAX_STREAM_NUMBER_LENGTH:
+            raise Exception("Error in bencode: integer number is too long")
+        unsigned = digits[1:] if digits[:1] == b"-" else digits
+        if unsigned and not unsigned.isdigit():
+            raise Exception("Error in bencode: incorrect symbol in "
+                            "integer number")
+        if is_finished:
+            if not unsigned:
+                raise Exception("Error in bencode: empty integer number")
+            return int(digits)
+
+
+class BencodeEncoder:
+    """
+    Encoder which computes exact size of the result first and then writes
+    everything into one preallocated buffer. Encoded strings and sorted
+    key lists found during size computation are reused during writing.
+    With sort_keys=False dictionaries are written in their own order.
+    """
+    def __init__(self, sort_keys=True):
+        self._sort_keys = sort_keys
+        self._cache = []
+        self._cached = None
+        self._buffer = None
+
+    def calc_size(self, source):
+        self._cache = []
+        try:
+            return self._size(source)
+        finally:
+            self._cache = []
+
+    def encode(self, source):
+        """Returns bytearray with bencode of source"""
+        self._cache = []
+        buffer = bytearray(self._size(source))
+        self._write_all(source, buffer, 0)
+        return buffer
+
+    def encode_into(self, source, buffer, offset=0):
+        """
+        Writes bencode of source into buffer (bytearray or writable
+        memoryview) from offset. Returns offset after the written data
+        """
+        self._cache = []
+        size = self._size(source)
+        if offset + size > len(buffer):
+            self._cache = []
+            raise ValueError("Buffer is too small for bencode object "
+                             "with size %d" % size)
+        return self._write_all(source, buffer, offset)
+
+    def _write_all(self, source, buffer, offset):
+        self._cached = iter(self._cache)
+        self._buffer = buffer
+        try:
+            return self._write(source, offset)
+        finally:
+            self._cache = []
+            self._cached = None
+            self._buffer = None
+
+    def _size(self, source):
+        kind = type(source)
+        if kind is bytes:
+            length = len(source)
+            return len(b"%d" % length) + 1 + length
+        elif kind is int:
+            return len(b"%d" % source) + 2
+        elif kind is list:
+            size = 2
+            for elem in source:
+                size += self._size(elem)
+            return size
+        elif kind is dict:
+            keys = list(source.keys())
+            for key in keys:
+                if type(key) is not bytes and \
+                        not isinstance(key, (str, bytes)):
+                    raise TypeError("Keys in bencode dictionary "
+                                    "can be strings or bytes only")
+            if self._sort_keys:
+                keys.sort()
+            self._cache.append(keys)
+            size = 2
+            for key in keys:
+                size += self._size(key) + self._size(source[key])
+            return size
+        elif kind is str:
+            encoded = source.encode()
+            self._cache.append(encoded)
+            return len(b"%d" % len(encoded)) + 1 + len(encoded)
+        return self._size(_as_base_type(source))
+
+    def _write(self, source, position):
+        buffer = self._buffer
+        kind = type(source)
+        if kind is bytes:
+            header = b"%d:" % len(source)
+            start = position + len(header)
+            end = start + len(source)
+            buffer[position:start] = header
+            buffer[start:end] = source
+            return end
+        elif kind is int:
+            data = b"i%de" % source
+            end = position + len(data)
+            buffer[position:end] = data
+            return end
+        elif kind is list:
+            buffer[position] = _LIST
+            position += 1
+            for elem in source:
+                position = self._write(elem, position)
+            buffer[position] = _END
+            return position + 1
+        elif kind is dict:
+            buffer[position] = _DICT
+            position += 1
+            for key in next(self._cached):
+                position = self._write(key, position)
+                position = self._write(source[key], position)
+            buffer[position] = _END
+            return position + 1
+        elif kind is str:
+            return self._write(next(self._cached), position)
+        return self._write(_as_base_type(source), position)
+
+
+def _as_base_type(source):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source)
+    for kind in (int, str, list, dict):
+        if isinstance(source, kind):
+            return kind(source)
+    raise TypeError("Cannot convert to bencode object "
                     "with type: " + str(type(source)))
 
 
 class BencodeTranslator:
     @staticmethod
-    def translate_to_bencode(source):
-        collection = []
-        _translate(source, collection)
-        result = b"".join(collection)
-        return result
+    def translate_to_bencode(source, sort_keys=True):
+        return bytes(BencodeEncoder(sort_keys).encode(source))
 
     @staticmethod
     def print_bencode(obj, depth=0):
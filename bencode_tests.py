@@ -1,6 +1,18 @@
+import os
 import re
 from unittest import TestCase
-from bencode import BencodeParser, BencodeTranslator
+from bencode import BencodeParser, BencodeTranslator, BencodeDecoder, \
+    BencodeStreamDecoder, BencodeDictView, BencodeEncoder
+from torrent_info import get_sha_1_hash
+
+SAMPLES_DIR = "samples"
+
+
+def _read_samples():
+    for name in sorted(os.listdir(SAMPLES_DIR)):
+        if name.endswith(".torrent"):
+            with open(os.path.join(SAMPLES_DIR, name), 'rb') as file:
+                yield name, file.read()
 
 
 class BencodeParserTests(TestCase):
@@ -219,6 +231,171 @@ class BencodeParserTests(TestCase):
                                BencodeParser.parse, source)
 
 
+class BencodeDecoderTests(TestCase):
+    def test_same_as_parser(self):
+        source = b"li128e5:hellod3:keyli32e2:hiee0:dee" + b"i-7e"
+        self.assertListEqual(BencodeDecoder(source).parse(),
+                             BencodeParser.parse(source))
+
+    def test_same_as_parser_on_samples(self):
+        for name, source in _read_samples():
+            self.assertEqual(BencodeDecoder(source).parse(),
+                             BencodeParser.parse(source), name)
+
+    def test_deep_nesting_without_recursion(self):
+        source = b"l" * 5000 + b"e" * 5000
+        content = BencodeDecoder(source).parse()
+        self.assertEqual(len(content), 1)
+
+    def test_errors_like_parser(self):
+        sources = [b"1O:somestring", b"15:string", b"15", b"i100500",
+                   b"i12343:abc", b"i2.5e", b"ie", b"i-e", b"li1234e",
+                   b"d3:key5:value", b"d4:key1i12e10:lonely_keye",
+                   b"di100e5:valuee", b"x"]
+        for source in sources:
+            with self.assertRaises(Exception) as expected:
+                BencodeParser.parse(source)
+            self.assertRaisesRegex(
+                Exception, re.escape(str(expected.exception)),
+                BencodeDecoder(source).parse)
+
+    def test_raw_span(self):
+        source = b"d4:infod1:ai1ee4:listl1:x3:abcee"
+        decoder = BencodeDecoder(source)
+        self.assertEqual(bytes(decoder.raw((b"info",))), b"d1:ai1ee")
+        self.assertEqual(bytes(decoder.raw((b"list", 1))), b"3:abc")
+        self.assertEqual(bytes(decoder.raw()), source)
+        self.assertIsNone(decoder.raw((b"absent",)))
+        self.assertIsNone(decoder.raw((b"list", 2)))
+
+    def test_raw_info_hash_on_samples(self):
+        for name, source in _read_samples():
+            decoder = BencodeDecoder(source)
+            info = decoder.parse()[0][b"info"]
+            self.assertEqual(
+                get_sha_1_hash(decoder.raw((b"info",))),
+                get_sha_1_hash(BencodeTranslator.translate_to_bencode(info)),
+                name)
+
+
+def _view_to_plain(value):
+    if isinstance(value, BencodeDictView):
+        return {key: _view_to_plain(value[key]) for key in value}
+    if isinstance(value, list):
+        return [_view_to_plain(elem) for elem in value]
+    return value
+
+
+class BencodeViewTests(TestCase):
+    def test_views_same_as_parser_on_samples(self):
+        for name, source in _read_samples():
+            view = BencodeDecoder(source).lazy()
+            self.assertEqual(_view_to_plain(view),
+                             BencodeParser.parse(source)[0], name)
+
+    def test_values_decoded_on_access(self):
+        source = b"d4:listli1ei2ee3:str3:abce"
+        view = BencodeDictView(BencodeDecoder(source))
+        self.assertListEqual(list(view.keys()), [b"list", b"str"])
+        self.assertDictEqual(view._values, {})
+        self.assertEqual(view[b"str"], b"abc")
+        self.assertListEqual(view[b"list"], [1, 2])
+        self.assertEqual(bytes(view.raw(b"list")), b"li1ei2ee")
+
+    def test_incorrect_dictionary(self):
+        self.assertRaisesRegex(Exception, re.compile(
+            "Error in bencode: unexpected end of source during "
+            "reading dictionary"),
+                               len, BencodeDecoder(b"d1:ai1e").lazy())
+        self.assertRaisesRegex(Exception, re.compile(
+            "is not a string, so it cannot be dictionary key"),
+                               len, BencodeDecoder(b"di1ei1ee").lazy())
+
+    def test_incorrect_int_in_skipped_value(self):
+        source = b"d4:infod6:lengthi1x2e4:name1:aee"
+        view = BencodeDictView(BencodeDecoder(source))
+        self.assertRaisesRegex(Exception, re.compile(
+            "Error in bencode: incorrect symbol in integer number"),
+                               view.raw, b"info")
+        for source in (b"li-ee", b"li--1ee", b"lie"):
+            self.assertRaises(Exception, BencodeDecoder(source).skip)
+
+
+class BencodeStreamDecoderTests(TestCase):
+    def test_feed_by_one_byte(self):
+        source = b"d5:peers12:abcdefghijkl8:intervali-1800e4:listli1e0:leee"
+        decoder = BencodeStreamDecoder()
+        for i in range(len(source)):
+            decoder.feed(source[i:i + 1])
+        self.assertListEqual(decoder.results(), BencodeParser.parse(source))
+
+    def test_feed_samples_by_chunks(self):
+        for name, source in _read_samples():
+            decoder = BencodeStreamDecoder()
+            for i in range(0, len(source), 1000):
+                decoder.feed(source[i:i + 1000])
+            self.assertEqual(decoder.results(),
+                             BencodeParser.parse(source), name)
+
+    def test_incomplete_source(self):
+        decoder = BencodeStreamDecoder()
+        decoder.feed(b"d3:key5:val")
+        self.assertFalse(decoder.is_complete())
+        self.assertRaisesRegex(Exception, re.compile(
+            "Error in bencode: unexpected end of source"),
+                               decoder.results)
+
+    def test_oversized_string_rejected_before_body(self):
+        decoder = BencodeStreamDecoder(max_string_length=100)
+        self.assertRaisesRegex(Exception, re.compile(
+            "Error in bencode: string length 1000 exceeds limit 100"),
+                               decoder.feed, b"l1000")
+
+    def test_depth_limit(self):
+        decoder = BencodeStreamDecoder(max_depth=3)
+        decoder.feed(b"lll")
+        self.assertRaisesRegex(Exception, re.compile(
+            "Error in bencode: nesting is deeper than 3"),
+                               decoder.feed, b"l")
+
+    def test_incorrect_int(self):
+        decoder = BencodeStreamDecoder()
+        self.assertRaisesRegex(Exception, re.compile(
+            "Error in bencode: incorrect symbol in integer number"),
+                               decoder.feed, b"i12:")
+
+
+class BencodeEncoderTests(TestCase):
+    def test_samples_round_trip(self):
+        for name, source in _read_samples():
+            content = BencodeParser.parse(source)[0]
+            encoder = BencodeEncoder()
+            self.assertEqual(encoder.calc_size(content), len(source), name)
+            self.assertEqual(encoder.encode(content), source, name)
+
+    def test_unsorted_keys(self):
+        source = {"b": 1, "a": [b"x", {"d": "", "c": 2}]}
+        result = BencodeEncoder(sort_keys=False).encode(source)
+        self.assertEqual(result, b"d1:bi1e1:al1:xd1:d0:1:ci2eeee")
+
+    def test_encode_into(self):
+        buffer = bytearray(b"#" * 12)
+        end = BencodeEncoder().encode_into(["ab", -5], buffer, 1)
+        self.assertEqual(end, 11)
+        self.assertEqual(buffer, b"#l2:abi-5ee#")
+        self.assertRaises(ValueError, BencodeEncoder().encode_into,
+                          ["ab", -5], buffer, 3)
+
+    def test_bytes_like(self):
+        result = BencodeEncoder().encode(
+            [bytearray(b"ab"), memoryview(b"cde"), True])
+        self.assertEqual(result, b"l2:ab3:cdei1ee")
+
+    def test_incorrect_types(self):
+        self.assertRaises(TypeError, BencodeEncoder().encode, [1.5])
+        self.assertRaises(TypeError, BencodeEncoder().encode, {1: 2})
+
+
 class BencodeTranslatorTests(TestCase):
     def test_positive_int(self):
         result = BencodeTranslator.translate_to_bencode(12)
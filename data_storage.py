@@ -1,94 +1,691 @@
 import os
 import mmap
+import errno
+import shutil
 import logging
-from torrent_info import TorrentMeta, FileRecord
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from collections import OrderedDict
+from torrent_info import TorrentMeta, FileRecord, bytes_to_int, \
+    int_to_four_bytes_big_endian
 
-class DataStorage:
-    def __init__(self, torrent: TorrentMeta, root_dir_path, logger):
-        self.log = logging.getLogger(logger.name + ".DataStorage")
+PREALLOCATION_SPARSE = "sparse"
+PREALLOCATION_FULL = "full"
+PREALLOCATION_ZERO = "zero"
+PREALLOCATION_MODES = (PREALLOCATION_SPARSE, PREALLOCATION_FULL,
+                       PREALLOCATION_ZERO)
+DEFAULT_MAX_OPEN_FILES = 64
+POSITIONAL_IO = hasattr(os, "pwritev") and hasattr(os, "preadv")
+IOV_MAX = 1024
+PART_FILE_MAGIC = b"BTPF"
+PART_FILE_VERSION = 1
+PART_FILE_SUFFIX = ".parts"
+_NO_SLOT = 0xFFFFFFFF
+STORAGE_FILE = "file"
+STORAGE_MEMORY = "memory"
+STORAGE_NULL = "null"
+STORAGE_BACKENDS = (STORAGE_FILE, STORAGE_MEMORY, STORAGE_NULL)
+
+
+class _FileHandle:
+    """Open file, its memory map and count of threads using them"""
+    def __init__(self, path):
+        self.file = open(path, "r+b")
+        self.mem_map = None
+        self.users = 0
+        self.is_evicted = False
+
+    def sync(self):
+        if self.mem_map is not None:
+            self.mem_map.flush()
+        self.file.flush()
+        if hasattr(os, "fdatasync"):
+            os.fdatasync(self.file.fileno())
+        else:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        try:
+            if self.mem_map is not None:
+                self.mem_map.flush()
+                self.mem_map.close()
+        finally:
+            self.file.close()
+
+
+class FileHandleCache:
+    """
+    Keeps files of torrent open, so reading and writing blocks do not
+    open files every time. Files are mapped to memory only if positional
+    I/O is not available. Count of open files is limited, least recently
+    used file is closed first. Lock guards only the cache itself: handles
+    are pinned by use() and I/O with them goes without lock, a handle
+    evicted while it is used is closed by its last user.
+    """
+    def __init__(self, max_open_files=DEFAULT_MAX_OPEN_FILES):
+        if max_open_files < 1:
+            raise ValueError("Limit of open files should be positive")
+        self.max_open_files = max_open_files
+        self.lock = threading.Lock()
+        self._handles = OrderedDict()
+
+    def __len__(self):
+        return len(self._handles)
+
+    def _get_handle(self, path):
+        if path in self._handles:
+            self._handles.move_to_end(path)
+            return self._handles[path]
+        while len(self._handles) >= self.max_open_files:
+            self._evict(self._handles.popitem(last=False)[1])
+        handle = _FileHandle(path)
+        self._handles[path] = handle
+        return handle
+
+    @staticmethod
+    def _evict(handle):
+        handle.is_evicted = True
+        if handle.users == 0:
+            handle.close()
+
+    def _acquire(self, handle):
+        handle.users += 1
+        return handle
+
+    def _release(self, handle):
+        with self.lock:
+            handle.users -= 1
+            if handle.is_evicted and handle.users == 0:
+                handle.close()
+
+    @contextmanager
+    def use(self, path, mapped=False):
+        """Yields open handle of file, it is not closed until exit"""
+        with self.lock:
+            handle = self._get_handle(path)
+            if mapped and handle.mem_map is None:
+                handle.mem_map = mmap.mmap(handle.file.fileno(), 0)
+            self._acquire(handle)
+        try:
+            yield handle
+        finally:
+            self._release(handle)
+
+    def flush(self):
+        with self.lock:
+            handles = [self._acquire(handle)
+                       for handle in self._handles.values()]
+        for handle in handles:
+            try:
+                handle.sync()
+            finally:
+                self._release(handle)
+
+    def flush_range(self, path, offset, length):
+        with self.lock:
+            if path not in self._handles:
+                return
+            handle = self._acquire(self._handles[path])
+        try:
+            if handle.mem_map is None:
+                handle.sync()
+            else:
+                start = offset - offset % mmap.ALLOCATIONGRANULARITY
+                handle.mem_map.flush(start, offset + length - start)
+        finally:
+            self._release(handle)
+
+    def close(self):
+        with self.lock:
+            while self._handles:
+                self._evict(self._handles.popitem(last=False)[1])
+
+
+def _split_buffers(buffers, count):
+    """Splits list of memoryviews into first count bytes and the rest"""
+    head = []
+    for index, buffer in enumerate(buffers):
+        if count <= 0:
+            return head, buffers[index:]
+        if len(buffer) > count:
+            head.append(buffer[:count])
+            return head, [buffer[count:]] + buffers[index + 1:]
+        head.append(buffer)
+        count -= len(buffer)
+    return head, []
+
+
+def _skip_bytes(buffers, count):
+    """Drops first count bytes from list of memoryviews"""
+    return _split_buffers(buffers, count)[1]
+
+
+class PartFile:
+    """
+    Side store for bytes of not downloading files inside pieces which
+    also touch downloading files. So such pieces are kept whole and can
+    be verified and uploaded, and not downloading files are not created.
+    File starts with header: magic, version, count of pieces, piece length
+    and slot number of every piece (4 bytes each), slots of piece length
+    follow in order of allocation. File is created on first write.
+    """
+    def __init__(self, path, pieces_count, piece_length, logger):
+        self.log = logging.getLogger(logger.name + ".PartFile")
+        self.path = path
+        self.pieces_count = pieces_count
+        self.piece_length = piece_length
+        self._lock = threading.Lock()
+        self._file = None
+        self._slots = dict()
+        self._header = PART_FILE_MAGIC + bytes([PART_FILE_VERSION]) + \
+            int_to_four_bytes_big_endian(pieces_count) + \
+            int_to_four_bytes_big_endian(piece_length)
+        self._header_length = len(self._header) + 4 * pieces_count
+        if os.path.exists(path):
+            self._read_header()
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _read_header(self):
+        with open(self.path, 'rb') as file:
+            header = file.read(self._header_length)
+        if len(header) != self._header_length or \
+                header[:len(self._header)] != self._header:
+            self.log.error("Part file '%s' does not match torrent, "
+                           "it will be rewritten" % self.path)
+            os.remove(self.path)
+            return
+        for piece_index in range(self.pieces_count):
+            position = len(self._header) + 4 * piece_index
+            slot = bytes_to_int(header[position:position + 4])
+            if slot != _NO_SLOT:
+                self._slots[piece_index] = slot
+
+    def _open(self):
+        if self._file is not None:
+            return
+        if not os.path.exists(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'wb') as file:
+                file.write(self._header + b"\xff" * 4 * self.pieces_count)
+        self._file = open(self.path, 'r+b')
+
+    def _get_offset(self, piece_index, piece_offset):
+        return self._header_length + \
+            self._slots[piece_index] * self.piece_length + piece_offset
+
+    def has_piece(self, piece_index):
+        return piece_index in self._slots
+
+    def write(self, piece_index, piece_offset, buffers):
+        with self._lock:
+            self._open()
+            if piece_index not in self._slots:
+                self._slots[piece_index] = len(self._slots)
+                self._file.seek(len(self._header) + 4 * piece_index)
+                self._file.write(int_to_four_bytes_big_endian(
+                    self._slots[piece_index]))
+            self._file.seek(self._get_offset(piece_index, piece_offset))
+            for buffer in buffers:
+                self._file.write(buffer)
+
+    def read_into(self, piece_index, piece_offset, buffer):
+        with self._lock:
+            self._open()
+            self._file.seek(self._get_offset(piece_index, piece_offset))
+            while len(buffer) > 0:
+                count = self._file.readinto(buffer)
+                if not count:
+                    raise EOFError("Part file '%s' is shorter than expected"
+                                   % self.path)
+                buffer = buffer[count:]
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class MemoryPartStore:
+    """Keeps bytes of not downloading files of boundary pieces in memory"""
+    def __init__(self, piece_length):
+        self.piece_length = piece_length
+        self._pieces = dict()
+
+    def __len__(self):
+        return len(self._pieces)
+
+    def has_piece(self, piece_index):
+        return piece_index in self._pieces
+
+    def write(self, piece_index, piece_offset, buffers):
+        if piece_index not in self._pieces:
+            self._pieces[piece_index] = bytearray(self.piece_length)
+        piece = self._pieces[piece_index]
+        for buffer in buffers:
+            piece[piece_offset:piece_offset + len(buffer)] = buffer
+            piece_offset += len(buffer)
+
+    def read_into(self, piece_index, piece_offset, buffer):
+        buffer[:] = self._pieces[piece_index][
+            piece_offset:piece_offset + len(buffer)]
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class NullPartStore(MemoryPartStore):
+    """Remembers which boundary pieces were written, reads zeros"""
+    def write(self, piece_index, piece_offset, buffers):
+        self._pieces[piece_index] = None
+
+    def read_into(self, piece_index, piece_offset, buffer):
+        buffer[:] = bytes(len(buffer))
+
+
+class StorageBackend(ABC):
+    """
+    Storage under DataStorage. DataStorage maps pieces to files of
+    torrent, backend keeps bytes of files (file_record is given to every
+    method) and bytes of not downloading files inside boundary pieces
+    (part store returned by get_part_store).
+    """
+    name = None
+    is_persistent = False
+
+    def __init__(self, torrent: TorrentMeta, logger):
+        self.log = logging.getLogger(logger.name + ".Backend")
         self.torrent = torrent
+
+    def check_free_space(self):
+        pass
+
+    @abstractmethod
+    def get_part_store(self):
+        pass
+
+    @abstractmethod
+    def create_file(self, file_record: FileRecord):
+        pass
+
+    @abstractmethod
+    def write(self, file_record: FileRecord, offset, buffers):
+        pass
+
+    @abstractmethod
+    def read_into(self, file_record: FileRecord, offset, buffer):
+        pass
+
+    def sync(self, file_record: FileRecord, offset, length):
+        pass
+
+    def open_file(self, file_record: FileRecord):
+        """Duplicated descriptor of file for os.sendfile or None"""
+        return None
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FileBackend(StorageBackend):
+    """Files of torrent in directory root_dir_path, one file per file"""
+    name = STORAGE_FILE
+    is_persistent = True
+
+    def __init__(self, torrent: TorrentMeta, root_dir_path, logger,
+                 preallocation=PREALLOCATION_SPARSE,
+                 max_open_files=DEFAULT_MAX_OPEN_FILES):
+        StorageBackend.__init__(self, torrent, logger)
         self.root_dir = root_dir_path
-        self.bytes_count = 0
+        self.preallocation = preallocation
+        self._handles = FileHandleCache(max_open_files)
+
+    def _get_torrent_dir_path(self):
+        """Directory of files, root_dir itself for one-file torrent"""
+        return os.path.join(self.root_dir, self.torrent.dir_name.decode())
+
+    def _get_file_path(self, file_record: FileRecord):
+        return os.path.join(self._get_torrent_dir_path(),
+                            *[elem.decode()
+                              for elem in file_record.local_path])
+
+    def _get_part_file_path(self):
+        return os.path.join(self._get_torrent_dir_path(),
+                            "." + self.torrent.info_hash.hex() +
+                            PART_FILE_SUFFIX)
+
+    def get_part_store(self):
+        return PartFile(self._get_part_file_path(),
+                        self.torrent.files_index.pieces_count,
+                        self.torrent.piece_length, self.log)
+
+    def check_free_space(self):
+        required = 0
         for file_record in self.torrent.files:
             if file_record.is_downloading:
-                self._create_file_structure(file_record)
-
-    def _create_file_structure(self, file_record: FileRecord):
-        path = self.root_dir + self.torrent.dir_name.decode()
-        for elem in file_record.local_path:
-            if not os.path.exists(path):
-                os.makedirs(path)
-            path += "\\" + elem.decode()
+                path = self._get_file_path(file_record)
+                existing = os.path.getsize(path) \
+                    if os.path.exists(path) else 0
+                required += max(0, file_record.length - existing)
+        free = shutil.disk_usage(self.root_dir).free
+        self.log.info("Free space check: required %d bytes, free %d bytes"
+                      % (required, free))
+        if required > free:
+            raise OSError(errno.ENOSPC,
+                          "Not enough free space in '%s': %d bytes are "
+                          "required, but only %d bytes are free"
+                          % (self.root_dir, required, free))
+
+    def create_file(self, file_record: FileRecord):
+        path = self._get_file_path(file_record)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
         self._make_file(path, file_record)
 
     def _make_file(self, path: str, file_record: FileRecord):
         length = file_record.length
-        self.bytes_count += length
         if not os.path.exists(path):
             with open(path, 'wb') as file:
-                self.log.info("Creating file with length=%d, piece_len=%d '%s'"
-                              % (length, self.torrent.piece_length, path))
-                for i in range(length // self.torrent.piece_length):
-                    file.write(bytes(self.torrent.piece_length))
-                file.write(bytes(length % self.torrent.piece_length))
+                self.log.info("Creating file (%s) with length=%d, "
+                              "piece_len=%d '%s'"
+                              % (self.preallocation, length,
+                                 self.torrent.piece_length, path))
+                if self.preallocation == PREALLOCATION_SPARSE:
+                    file.truncate(length)
+                elif self.preallocation == PREALLOCATION_ZERO or \
+                        not self._try_fallocate(file, length):
+                    self._fill_zeros(file, length)
         file_record.path = path
 
-    def write_piece(self, piece_index, piece):
-        written_len = 0
-        piece_start = piece_index * self.torrent.piece_length
-        for file_rec in self.torrent.files:
-            if file_rec.pieces_from <= piece_index <= file_rec.pieces_to:
-                if file_rec.is_downloading:
-                    start = max(piece_start, file_rec.offset)
-                    finish = min(piece_start + self.torrent.piece_length,
-                                 file_rec.offset + file_rec.length)
-                    start_in_piece = start - piece_start
-                    finish_in_piece = finish - piece_start
-                    fragment = piece[start_in_piece:finish_in_piece]
-
-                    start_in_file = start - file_rec.offset
-                    self._write_file_fragment(
-                        fragment, start_in_file, file_rec)
-
-                    len_to_write = finish_in_piece - start_in_piece
-                    written_len += len_to_write
-
-                    self.log.info("Write piece '%d' on place '%d' in file '%s'"
-                                  % (piece_index,
-                                     start_in_file,
-                                     file_rec.path))
-        return written_len
-
-    def _write_file_fragment(self, fragment, offset, file_rec):
-        path = file_rec.path
+    def _try_fallocate(self, file, length):
+        if not hasattr(os, "posix_fallocate"):
+            return False
         try:
-            with open(path, "r+b") as file:
-                map_offset = (offset // mmap.ALLOCATIONGRANULARITY) * \
-                             mmap.ALLOCATIONGRANULARITY
-                inner_offset = offset % mmap.ALLOCATIONGRANULARITY
-                map_len = len(fragment) + inner_offset
-                mem_map = mmap.mmap(file.fileno(), map_len, offset=map_offset)
-                mem_map[inner_offset:inner_offset+len(fragment)] = fragment
-                mem_map.close()
-        except Exception as ex:
-            print("\n!!! File exception in file '%s': %s" %(path, str(ex)))
-            print("!!! It maybe better stop downloading.")
-            self.log.fatal("Exception during file saving in file '%s': %s"
-                           % (path, str(ex)))
+            if length > 0:
+                os.posix_fallocate(file.fileno(), 0, length)
+            return True
+        except OSError as ex:
+            if ex.errno == errno.ENOSPC:
+                raise
+            self.log.info("posix_fallocate is not supported (%s), "
+                          "file will be filled with zeros" % str(ex))
+            return False
+
+    def _fill_zeros(self, file, length):
+        for i in range(length // self.torrent.piece_length):
+            file.write(bytes(self.torrent.piece_length))
+        file.write(bytes(length % self.torrent.piece_length))
+
+    def write(self, file_record: FileRecord, offset, buffers):
+        if POSITIONAL_IO:
+            with self._handles.use(file_record.path) as handle:
+                fd = handle.file.fileno()
+                while buffers:
+                    written = os.pwritev(fd, buffers[:IOV_MAX], offset)
+                    offset += written
+                    buffers = _skip_bytes(buffers, written)
+        else:
+            with self._handles.use(file_record.path, True) as handle:
+                for buffer in buffers:
+                    handle.mem_map[offset:offset + len(buffer)] = buffer
+                    offset += len(buffer)
+
+    def read_into(self, file_record: FileRecord, offset, buffer):
+        path = file_record.path
+        if POSITIONAL_IO:
+            with self._handles.use(path) as handle:
+                fd = handle.file.fileno()
+                while len(buffer) > 0:
+                    count = os.preadv(fd, [buffer], offset)
+                    if count == 0:
+                        raise EOFError("File '%s' is shorter than expected"
+                                       % path)
+                    offset += count
+                    buffer = buffer[count:]
+        else:
+            with self._handles.use(path, True) as handle:
+                buffer[:] = handle.mem_map[offset:offset + len(buffer)]
+
+    def sync(self, file_record: FileRecord, offset, length):
+        self._handles.flush_range(file_record.path, offset, length)
+
+    def open_file(self, file_record: FileRecord):
+        with self._handles.use(file_record.path) as handle:
+            return os.dup(handle.file.fileno())
+
+    def flush(self):
+        self._handles.flush()
+
+    def close(self):
+        self._handles.close()
+
+
+class MemoryBackend(StorageBackend):
+    """Keeps files of torrent in memory, for tests and benchmarks"""
+    name = STORAGE_MEMORY
+
+    def __init__(self, torrent: TorrentMeta, logger):
+        StorageBackend.__init__(self, torrent, logger)
+        self._files = dict()
+
+    def get_part_store(self):
+        return MemoryPartStore(self.torrent.piece_length)
+
+    def create_file(self, file_record: FileRecord):
+        self._files[file_record] = bytearray(file_record.length)
+
+    def write(self, file_record: FileRecord, offset, buffers):
+        data = self._files[file_record]
+        for buffer in buffers:
+            data[offset:offset + len(buffer)] = buffer
+            offset += len(buffer)
+
+    def read_into(self, file_record: FileRecord, offset, buffer):
+        buffer[:] = self._files[file_record][offset:offset + len(buffer)]
+
+
+class NullBackend(StorageBackend):
+    """Discards written bytes and reads zeros, for benchmarks"""
+    name = STORAGE_NULL
+
+    def get_part_store(self):
+        return NullPartStore(self.torrent.piece_length)
+
+    def create_file(self, file_record: FileRecord):
+        pass
+
+    def write(self, file_record: FileRecord, offset, buffers):
+        pass
+
+    def read_into(self, file_record: FileRecord, offset, buffer):
+        buffer[:] = bytes(len(buffer))
+
+
+def make_backend(kind, torrent: TorrentMeta, root_dir_path, logger,
+                 preallocation=PREALLOCATION_SPARSE,
+                 max_open_files=DEFAULT_MAX_OPEN_FILES):
+    if kind == STORAGE_FILE:
+        return FileBackend(torrent, root_dir_path, logger, preallocation,
+                           max_open_files)
+    if kind == STORAGE_MEMORY:
+        return MemoryBackend(torrent, logger)
+    if kind == STORAGE_NULL:
+        return NullBackend(torrent, logger)
+    raise ValueError("Unknown storage backend '%s'" % kind)
+
+
+class DataStorage:
+    def __init__(self, torrent: TorrentMeta, root_dir_path, logger,
+                 preallocation=PREALLOCATION_SPARSE,
+                 max_open_files=DEFAULT_MAX_OPEN_FILES,
+                 backend=STORAGE_FILE):
+        if preallocation not in PREALLOCATION_MODES:
+            raise ValueError("Unknown preallocation mode '%s'"
+                             % preallocation)
+        self.log = logging.getLogger(logger.name + ".DataStorage")
+        self.torrent = torrent
+        self.root_dir = root_dir_path
+        self.files_index = torrent.files_index
+        self.preallocation = preallocation
+        if isinstance(backend, str):
+            backend = make_backend(backend, torrent, root_dir_path, self.log,
+                                   preallocation, max_open_files)
+        self.backend = backend
+        self._part_file = backend.get_part_store()
+        self.bytes_count = 0
+        self.backend.check_free_space()
+        for file_record in self.torrent.files:
+            if file_record.is_downloading:
+                self.backend.create_file(file_record)
+                self.bytes_count += file_record.length
+
+    def write_run(self, first_piece_index, pieces):
+        """
+        Writes consecutive pieces with one vectored write per file and
+        flushes written fragments. Returns lengths written for every
+        piece. Exceptions are not suppressed, pieces are not saved then
+        """
+        start = first_piece_index * self.torrent.piece_length
+        used_part_file = False
+        for segment, buffers in self._split_by_files(start, pieces):
+            file_rec = segment.file
+            if file_rec.is_downloading:
+                self.backend.write(file_rec, segment.file_offset, buffers)
+                self.backend.sync(file_rec, segment.file_offset,
+                                  segment.length)
+            else:
+                self._write_to_part_file(start + segment.piece_offset,
+                                         buffers)
+                used_part_file = True
+        if used_part_file:
+            self._part_file.flush()
+        return [self.get_piece_saving_length(first_piece_index + i)
+                for i in range(len(pieces))]
+
+    def get_piece_saving_length(self, piece_index):
+        return sum(segment.length for segment
+                   in self.files_index.get_piece_segments(piece_index)
+                   if segment.file.is_downloading)
+
+    def _split_by_files(self, start_byte, pieces):
+        """
+        Yields FileSegment and list of memoryview slices of consecutive
+        pieces for every file touched by bytes from start_byte
+        """
+        views = [memoryview(piece) for piece in pieces]
+        total = sum(len(view) for view in views)
+        view_index = 0
+        view_offset = 0
+        for segment in self.files_index.get_segments(start_byte, total):
+            buffers = []
+            left = segment.length
+            while left > 0:
+                view = views[view_index]
+                buffer = view[view_offset:view_offset + left]
+                buffers.append(buffer)
+                left -= len(buffer)
+                view_offset += len(buffer)
+                if view_offset == len(view):
+                    view_index += 1
+                    view_offset = 0
+            yield segment, buffers
+
+    def _get_part_pieces(self, start_byte, length):
+        """Yields piece index, offset in piece and length by pieces"""
+        piece_length = self.torrent.piece_length
+        while length > 0:
+            piece_index, piece_offset = divmod(start_byte, piece_length)
+            count = min(piece_length - piece_offset, length)
+            yield piece_index, piece_offset, count
+            start_byte += count
+            length -= count
+
+    def _write_to_part_file(self, start_byte, buffers):
+        length = sum(len(buffer) for buffer in buffers)
+        for piece_index, piece_offset, count in \
+                self._get_part_pieces(start_byte, length):
+            head, buffers = _split_buffers(buffers, count)
+            self._part_file.write(piece_index, piece_offset, head)
+
+    def _is_segment_readable(self, start_byte, segment):
+        return segment.file.is_downloading or all(
+            self._part_file.has_piece(piece_index) for piece_index, _, _
+            in self._get_part_pieces(start_byte, segment.length))
+
+    def is_piece_readable(self, piece_index):
+        start = piece_index * self.torrent.piece_length
+        return all(self._is_segment_readable(start + segment.piece_offset,
+                                             segment)
+                   for segment
+                   in self.files_index.get_piece_segments(piece_index))
 
     def read_piece_segment(self, piece_index, begin, length):
+        """
+        Reads bytes of piece, possibly from several files and part file.
+        Returns None if some of them belong to not downloading file and
+        are not kept in part file
+        """
         start = piece_index * self.torrent.piece_length + begin
-        file_rec, offset = self.find_piece_in_files(start)
-        if not file_rec.is_downloading:
+        segments = self.files_index.get_segments(start, length)
+        if not all(self._is_segment_readable(start + segment.piece_offset,
+                                             segment)
+                   for segment in segments):
             return None
-        path = file_rec.path
-        with open(path, 'rb') as file:
-            file.seek(offset)
-            segment = file.read(length)
-            return segment
+        data = bytearray(sum(segment.length for segment in segments))
+        view = memoryview(data)
+        for segment in segments:
+            buffer = view[segment.piece_offset:
+                          segment.piece_offset + segment.length]
+            if segment.file.is_downloading:
+                self.backend.read_into(segment.file, segment.file_offset,
+                                       buffer)
+                continue
+            for part_index, part_offset, count in self._get_part_pieces(
+                    start + segment.piece_offset, segment.length):
+                self._part_file.read_into(part_index, part_offset,
+                                          buffer[:count])
+                buffer = buffer[count:]
+        return data
 
-    def find_piece_in_files(self, start_byte):
-        for file_record in self.torrent.files:
-            if start_byte < file_record.offset + file_record.length:
-                return file_record, start_byte - file_record.offset
-        return None
+    def open_piece_segment(self, piece_index, begin, length):
+        """
+        Returns duplicated descriptor of file containing the block and
+        offset of the block in the file, caller closes descriptor.
+        Returns None if block spans several files, its file is not
+        downloading or backend does not keep files
+        """
+        start = piece_index * self.torrent.piece_length + begin
+        segments = self.files_index.get_segments(start, length)
+        if len(segments) != 1 or segments[0].length != length or \
+                not segments[0].file.is_downloading:
+            return None
+        file_descriptor = self.backend.open_file(segments[0].file)
+        if file_descriptor is None:
+            return None
+        return file_descriptor, segments[0].file_offset
+
+    def read_piece(self, piece_index):
+        return self.read_piece_segment(
+            piece_index, 0, self.files_index.get_piece_length(piece_index))
+
+    def flush(self):
+        self.backend.flush()
+        self._part_file.flush()
+
+    def close(self):
+        self.backend.close()
+        self._part_file.close()
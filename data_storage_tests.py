@@ -0,0 +1,282 @@
+import os
+import errno
+import shutil
+import logging
+import tempfile
+from collections import namedtuple
+from unittest import TestCase
+from unittest.mock import patch
+from data_storage import DataStorage, FileHandleCache, StorageBackend, \
+    _skip_bytes, PREALLOCATION_SPARSE, PREALLOCATION_FULL, \
+    PREALLOCATION_ZERO, STORAGE_MEMORY, STORAGE_NULL
+from torrent_fixtures import make_torrent
+
+LOGGER = logging.getLogger("test")
+DiskUsage = namedtuple("DiskUsage", ["total", "used", "free"])
+
+
+class DataStorageTests(TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def _check_created_files(self, torrent):
+        for file_record in torrent.files:
+            self.assertEqual(os.path.getsize(file_record.path),
+                             file_record.length)
+
+    def test_preallocation_modes(self):
+        for mode in (PREALLOCATION_SPARSE, PREALLOCATION_FULL,
+                     PREALLOCATION_ZERO):
+            torrent = make_torrent([5, 0, 3, 10, 2], 4)
+            root_dir = os.path.join(self.root_dir, mode)
+            os.makedirs(root_dir)
+            storage = DataStorage(torrent, root_dir, LOGGER, mode)
+            self.assertEqual(storage.bytes_count, 20)
+            self._check_created_files(torrent)
+
+    def test_unknown_mode(self):
+        self.assertRaises(ValueError, DataStorage, make_torrent([5], 4),
+                          self.root_dir, LOGGER, "unknown")
+
+    def test_not_enough_free_space(self):
+        torrent = make_torrent([5, 3], 4)
+        with patch("shutil.disk_usage", return_value=DiskUsage(10, 3, 7)):
+            with self.assertRaises(OSError) as context:
+                DataStorage(torrent, self.root_dir, LOGGER)
+        self.assertEqual(context.exception.errno, errno.ENOSPC)
+        torrent.files[0].is_downloading = False
+        with patch("shutil.disk_usage", return_value=DiskUsage(10, 3, 7)):
+            DataStorage(torrent, self.root_dir, LOGGER)
+
+    def test_write_and_read_piece(self):
+        torrent = make_torrent([5, 0, 3, 10, 2], 4)
+        storage = DataStorage(torrent, self.root_dir, LOGGER)
+        data = bytes(range(20))
+        for piece_index in range(5):
+            written = storage.write_run(
+                piece_index, [data[piece_index * 4:piece_index * 4 + 4]])
+            self.assertEqual(written, [4])
+        self.assertEqual(storage.read_piece_segment(2, 0, 4), data[8:12])
+
+    def test_read_piece_from_several_files(self):
+        torrent = make_torrent([5, 0, 3, 10, 2], 4)
+        storage = DataStorage(torrent, self.root_dir, LOGGER)
+        data = bytes(range(20))
+        storage.write_run(0, [data[i:i + 4] for i in range(0, 20, 4)])
+        for piece_index in range(5):
+            self.assertEqual(storage.read_piece(piece_index),
+                             data[piece_index * 4:piece_index * 4 + 4])
+        torrent.files[2].is_downloading = False
+        self.assertIsNone(storage.read_piece(1))
+        self.assertEqual(storage.read_piece(2), data[8:12])
+
+    def test_cross_file_segment_read(self):
+        torrent = make_torrent([5, 0, 3, 10, 2], 4)
+        storage = DataStorage(torrent, self.root_dir, LOGGER)
+        data = bytes(range(20))
+        storage.write_run(0, [data[i:i + 4] for i in range(0, 20, 4)])
+        self.assertEqual(storage.read_piece_segment(1, 0, 4), data[4:8])
+        self.assertEqual(storage.read_piece_segment(1, 3, 3), data[7:10])
+
+    def test_memory_map_without_positional_io(self):
+        torrent = make_torrent([5, 0, 3, 10, 2], 4)
+        storage = DataStorage(torrent, self.root_dir, LOGGER)
+        data = bytes(range(20))
+        with patch("data_storage.POSITIONAL_IO", False):
+            storage.write_run(0, [data[i:i + 4] for i in range(0, 20, 4)])
+            self.assertEqual(storage.read_piece_segment(0, 2, 8), data[2:10])
+        self.assertEqual(storage.read_piece(4), data[16:20])
+
+    def test_open_piece_segment(self):
+        torrent = make_torrent([5, 0, 3, 10, 2], 4)
+        storage = DataStorage(torrent, self.root_dir, LOGGER)
+        data = bytes(range(20))
+        storage.write_run(0, [data[i:i + 4] for i in range(0, 20, 4)])
+        file_descriptor, offset = storage.open_piece_segment(2, 1, 3)
+        try:
+            self.assertEqual(offset, 1)
+            with open(file_descriptor, 'rb', closefd=False) as file:
+                file.seek(offset)
+                self.assertEqual(file.read(3), data[9:12])
+        finally:
+            os.close(file_descriptor)
+        self.assertIsNone(storage.open_piece_segment(1, 0, 4))
+        self.assertIsNone(storage.open_piece_segment(4, 0, 4))
+        storage.close()
+
+    def test_write_run(self):
+        torrent = make_torrent([5, 0, 3, 10, 2], 4)
+        torrent.files[4].is_downloading = False
+        storage = DataStorage(torrent, self.root_dir, LOGGER)
+        data = bytes(range(20))
+        written = storage.write_run(
+            1, [data[4:8], data[8:12], data[12:16], data[16:20]])
+        self.assertEqual(written, [4, 4, 4, 2])
+        storage.close()
+        with open(torrent.files[3].path, 'rb') as file:
+            self.assertEqual(file.read(), data[8:18])
+        self.assertIsNone(torrent.files[4].path)
+
+    def test_open_files_limit(self):
+        torrent = make_torrent([5, 0, 3, 10, 2], 4)
+        storage = DataStorage(torrent, self.root_dir, LOGGER,
+                              max_open_files=2)
+        data = bytes(range(20))
+        for piece_index in range(5):
+            storage.write_run(
+                piece_index, [data[piece_index * 4:piece_index * 4 + 4]])
+            self.assertLessEqual(len(storage.backend._handles), 2)
+        storage.close()
+        self.assertEqual(len(storage.backend._handles), 0)
+        for file_record in torrent.files:
+            with open(file_record.path, 'rb') as file:
+                self.assertEqual(file.read(), data[
+                    file_record.offset:
+                    file_record.offset + file_record.length])
+
+
+class PartFileTests(TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.data = bytes(range(20))
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def _make_storage(self):
+        torrent = make_torrent([5, 0, 3, 10, 2], 4)
+        torrent.files[2].is_downloading = False
+        return torrent, DataStorage(torrent, self.root_dir, LOGGER)
+
+    def test_boundary_pieces_are_kept_whole(self):
+        torrent, storage = self._make_storage()
+        self.assertFalse(storage.is_piece_readable(1))
+        written = storage.write_run(
+            1, [self.data[i:i + 4] for i in range(4, 20, 4)])
+        self.assertEqual(written, [1, 4, 4, 4])
+        self.assertEqual(len(storage._part_file), 1)
+        self.assertTrue(storage.is_piece_readable(1))
+        self.assertTrue(storage.is_piece_readable(2))
+        self.assertEqual(storage.read_piece(1), self.data[4:8])
+        self.assertEqual(storage.read_piece_segment(1, 3, 6),
+                         self.data[7:13])
+        self.assertIsNone(torrent.files[2].path)
+        storage.close()
+
+    def test_part_file_is_reopened(self):
+        _, storage = self._make_storage()
+        storage.write_run(2, [self.data[8:12]])
+        storage.write_run(1, [self.data[4:8]])
+        storage.close()
+        _, storage = self._make_storage()
+        self.assertTrue(storage.is_piece_readable(1))
+        self.assertEqual(storage.read_piece(1), self.data[4:8])
+        storage.close()
+
+    def test_wrong_part_file_is_rewritten(self):
+        _, storage = self._make_storage()
+        path = storage._part_file.path
+        storage.close()
+        with open(path, 'wb') as file:
+            file.write(b"BTPF" + bytes(100))
+        _, storage = self._make_storage()
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(len(storage._part_file), 0)
+
+
+class StorageBackendTests(TestCase):
+    def setUp(self):
+        self.data = bytes(range(20))
+
+    def test_memory_backend(self):
+        torrent = make_torrent([5, 0, 3, 10, 2], 4)
+        torrent.files[2].is_downloading = False
+        storage = DataStorage(torrent, None, LOGGER, backend=STORAGE_MEMORY)
+        self.assertEqual(storage.bytes_count, 17)
+        storage.write_run(0, [self.data[i:i + 4] for i in range(0, 20, 4)])
+        for piece_index in range(5):
+            self.assertEqual(storage.read_piece(piece_index),
+                             self.data[piece_index * 4:piece_index * 4 + 4])
+        self.assertEqual(storage.read_piece_segment(1, 2, 7),
+                         self.data[6:13])
+        self.assertIsNone(storage.open_piece_segment(2, 0, 4))
+        self.assertIsNone(torrent.files[0].path)
+
+    def test_null_backend(self):
+        torrent = make_torrent([5, 0, 3, 10, 2], 4)
+        torrent.files[2].is_downloading = False
+        storage = DataStorage(torrent, None, LOGGER, backend=STORAGE_NULL)
+        self.assertFalse(storage.is_piece_readable(1))
+        self.assertEqual(storage.write_run(1, [self.data[4:8]]), [1])
+        self.assertTrue(storage.is_piece_readable(1))
+        self.assertEqual(storage.read_piece(1), bytes(4))
+
+    def test_backend_is_abstract(self):
+        torrent = make_torrent([4], 4)
+        with self.assertRaises(TypeError):
+            StorageBackend(torrent, LOGGER)
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, DataStorage, make_torrent([5], 4),
+                          None, LOGGER, backend="tape")
+
+
+class SkipBytesTests(TestCase):
+    def test_skip_bytes(self):
+        buffers = [memoryview(b"abc"), memoryview(b"de"), memoryview(b"f")]
+        self.assertEqual([bytes(buffer) for buffer
+                          in _skip_bytes(buffers, 4)], [b"e", b"f"])
+        self.assertEqual(_skip_bytes(buffers, 6), [])
+        self.assertEqual(_skip_bytes(buffers, 0), buffers)
+
+
+class FileHandleCacheTests(TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.paths = []
+        for index in range(3):
+            path = os.path.join(self.root_dir, str(index))
+            with open(path, 'wb') as file:
+                file.write(bytes(10))
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def test_least_recently_used_closed(self):
+        cache = FileHandleCache(2)
+        with cache.use(self.paths[0]) as handle:
+            first = handle
+        with cache.use(self.paths[1]):
+            pass
+        with cache.use(self.paths[0]) as handle:
+            self.assertIs(handle, first)
+        with cache.use(self.paths[2]):
+            pass
+        self.assertEqual(list(cache._handles), [self.paths[0], self.paths[2]])
+        cache.close()
+        self.assertTrue(first.file.closed)
+
+    def test_used_handle_closed_after_use(self):
+        cache = FileHandleCache(1)
+        with cache.use(self.paths[0]) as handle:
+            with cache.use(self.paths[1]):
+                pass
+            self.assertFalse(handle.file.closed)
+            self.assertTrue(cache.lock.acquire(blocking=False))
+            cache.lock.release()
+        self.assertTrue(handle.file.closed)
+        self.assertEqual(list(cache._handles), [self.paths[1]])
+        cache.close()
+
+    def test_flush(self):
+        cache = FileHandleCache()
+        with cache.use(self.paths[0], True) as handle:
+            handle.mem_map[2:4] = b"ab"
+        cache.flush()
+        with open(self.paths[0], 'rb') as file:
+            self.assertEqual(file.read(4), b"\0\0ab")
+        cache.close()
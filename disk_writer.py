@@ -0,0 +1,95 @@
+import logging
+import threading
+
+DEFAULT_MEMORY_BUDGET = 64 * 2 ** 20
+
+
+def _split_runs(piece_indices):
+    runs = []
+    for piece_index in piece_indices:
+        if runs and runs[-1][-1] + 1 == piece_index:
+            runs[-1].append(piece_index)
+        else:
+            runs.append([piece_index])
+    return runs
+
+
+class DiskWriter(threading.Thread):
+    """
+    Write-back stage of verified pieces. Pieces wait in memory (no more
+    than memory_budget bytes, put() blocks peers when it is exhausted),
+    the writer thread writes adjacent pieces as contiguous runs, flushes
+    them and only then reports pieces as written.
+    """
+    def __init__(self, data_storage, on_written, on_failed, logger,
+                 memory_budget=DEFAULT_MEMORY_BUDGET):
+        threading.Thread.__init__(self, daemon=True)
+        self.name = "DiskWriter." + self.name
+        self.log = logging.getLogger(logger.name + ".DiskWriter")
+        self._data_storage = data_storage
+        self._on_written = on_written
+        self._on_failed = on_failed
+        self.memory_budget = memory_budget
+        self._pending = dict()
+        self._pending_bytes = 0
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def put(self, piece_index: int, piece: bytes):
+        """
+        Returns False if writer is closed: peers may finish pieces during
+        shutdown, such pieces are dropped and loaded again after restart
+        """
+        with self._condition:
+            while self._pending_bytes > 0 and not self._closed and \
+                    self._pending_bytes + len(piece) > self.memory_budget:
+                self._condition.wait()
+            if self._closed:
+                self.log.warning("Piece %d is not written, disk writer is "
+                                 "closed" % piece_index)
+                return False
+            self._pending[piece_index] = piece
+            self._pending_bytes += len(piece)
+            self._condition.notify_all()
+            return True
+
+    def get_pending_bytes_count(self):
+        return self._pending_bytes
+
+    def close(self):
+        """Writes all waiting pieces and stops the thread"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                batch = self._pending
+                self._pending = dict()
+            self._write_batch(batch)
+            with self._condition:
+                self._pending_bytes -= sum(
+                    len(piece) for piece in batch.values())
+                self._condition.notify_all()
+
+    def _write_batch(self, batch):
+        for run in _split_runs(sorted(batch)):
+            try:
+                written = self._data_storage.write_run(
+                    run[0], [batch[piece_index] for piece_index in run])
+            except Exception as ex:
+                print("\n!!! Exception during writing pieces %d-%d: %s"
+                      % (run[0], run[-1], str(ex)))
+                self.log.fatal("Exception during writing pieces %d-%d: %s"
+                               % (run[0], run[-1], str(ex)))
+                self._on_failed(run)
+                continue
+            self.log.info("Written pieces %d-%d" % (run[0], run[-1]))
+            self._on_written(list(zip(run, written)))
@@ -0,0 +1,95 @@
+import logging
+import threading
+from unittest import TestCase
+from disk_writer import DiskWriter, _split_runs
+
+LOGGER = logging.getLogger("test")
+
+
+class FakeStorage:
+    def __init__(self, fail_on=None):
+        self.runs = []
+        self.fail_on = fail_on
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def write_run(self, first_piece_index, pieces):
+        self.gate.wait()
+        if first_piece_index == self.fail_on:
+            raise OSError("disk error")
+        self.runs.append((first_piece_index, b"".join(pieces)))
+        return [len(piece) for piece in pieces]
+
+
+class DiskWriterTests(TestCase):
+    def setUp(self):
+        self.written = []
+        self.failed = []
+
+    def _make_writer(self, storage, memory_budget=100, start=True):
+        writer = DiskWriter(storage, self.written.extend, self.failed.extend,
+                            LOGGER, memory_budget)
+        if start:
+            writer.start()
+        return writer
+
+    def test_split_runs(self):
+        self.assertEqual(_split_runs([0, 1, 2, 5, 7, 8]),
+                         [[0, 1, 2], [5], [7, 8]])
+        self.assertEqual(_split_runs([]), [])
+
+    def test_adjacent_pieces_are_merged(self):
+        storage = FakeStorage()
+        writer = self._make_writer(storage, start=False)
+        for piece_index in (9, 3, 1, 2, 6):
+            writer.put(piece_index, b"%d" % piece_index)
+        writer.start()
+        writer.close()
+        self.assertEqual(storage.runs,
+                         [(1, b"123"), (6, b"6"), (9, b"9")])
+        self.assertEqual(sorted(self.written),
+                         [(1, 1), (2, 1), (3, 1), (6, 1), (9, 1)])
+        self.assertEqual(writer.get_pending_bytes_count(), 0)
+
+    def test_memory_budget_blocks_put(self):
+        storage = FakeStorage()
+        storage.gate.clear()
+        writer = self._make_writer(storage, memory_budget=10)
+        writer.put(0, bytes(8))
+        putting = threading.Thread(target=writer.put, args=(1, bytes(8)))
+        putting.start()
+        putting.join(0.2)
+        self.assertTrue(putting.is_alive())
+        self.assertEqual(self.written, [])
+        storage.gate.set()
+        putting.join(5)
+        self.assertFalse(putting.is_alive())
+        writer.close()
+        self.assertEqual(self.written, [(0, 8), (1, 8)])
+
+    def test_failed_run_is_reported(self):
+        writer = self._make_writer(FakeStorage(fail_on=4))
+        writer.put(4, b"a")
+        writer.close()
+        self.assertEqual(self.failed, [4])
+        self.assertEqual(self.written, [])
+        self.assertFalse(writer.put(5, b"b"))
+
+    def test_put_during_close_is_dropped(self):
+        storage = FakeStorage()
+        storage.gate.clear()
+        writer = self._make_writer(storage, memory_budget=10)
+        self.assertTrue(writer.put(0, bytes(8)))
+        results = []
+        putting = threading.Thread(
+            target=lambda: results.append(writer.put(1, bytes(8))))
+        putting.start()
+        putting.join(0.2)
+        closing = threading.Thread(target=writer.close)
+        closing.start()
+        putting.join(5)
+        self.assertEqual(results, [False])
+        storage.gate.set()
+        closing.join(5)
+        self.assertFalse(closing.is_alive())
+        self.assertEqual(self.written, [(0, 8)])
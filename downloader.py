@@ -1,12 +1,17 @@
+import os
 import logging
 import time
 from pathlib import Path
 import threading
 
-from bencode import BencodeParser
+from bencode import BencodeDecoder, BencodeDictView
 from tracker import TrackersConnector
 from pieces_allocator import Allocator
+from data_storage import PREALLOCATION_SPARSE, PREALLOCATION_MODES, \
+    STORAGE_FILE, STORAGE_BACKENDS
 from torrent_info import TorrentMeta
+from meta_cache import MetaCache
+from resume import ResumeFile
 
 
 def _check_file_correctness(file_path: str):
@@ -39,6 +44,63 @@ def _read_source_from_file(torrent_file_path: str):
 
 
 MODULE_LOG_NAME = "bt.Loader"
+META_CACHE_DIR = "cache"
+RESUME_DIR = "resume"
+LOGS_DIR = "logs"
+_meta_cache = None
+_meta_cache_lock = threading.Lock()
+_log_handler_lock = threading.Lock()
+
+
+def _add_loaders_log_handler():
+    """
+    One file handler for all loaders (every torrent logs with its own
+    logger name), so thousands of added torrents do not keep thousands
+    of open files. File is opened on first record
+    """
+    logger = logging.getLogger(MODULE_LOG_NAME)
+    with _log_handler_lock:
+        if logger.handlers:
+            return
+        formatter = logging.Formatter(
+            '%(asctime)s    %(threadName)s    %(name)s    %(levelname)s \n'
+            '\t   %(message)s')
+        file_handler = logging.FileHandler(
+            os.path.join(LOGS_DIR, MODULE_LOG_NAME + ".log"), delay=True)
+        file_handler.setFormatter(formatter)
+        logger.addHandler(file_handler)
+
+
+def _get_meta_cache():
+    global _meta_cache
+    with _meta_cache_lock:
+        if _meta_cache is None:
+            _meta_cache = MetaCache(META_CACHE_DIR,
+                                    logger_name=MODULE_LOG_NAME)
+        return _meta_cache
+
+
+def read_torrent_state(torrent_file_path: str):
+    """
+    Checks, reads and interprets torrent-file (using cache of metadata).
+    Runs in worker processes during bulk adding, so returns only plain
+    data: (torrent_file_path, state of TorrentMeta, error message)
+    """
+    try:
+        _check_file_correctness(torrent_file_path)
+        source = _read_source_from_file(torrent_file_path)
+        cache = _get_meta_cache()
+        cache_key = MetaCache.get_key(torrent_file_path, source)
+        torrent = cache.get(cache_key, MODULE_LOG_NAME)
+        if torrent is not None:
+            return torrent_file_path, torrent.get_state(), None
+        torrent = TorrentMeta(BencodeDictView(BencodeDecoder(source)),
+                              MODULE_LOG_NAME)
+        state = torrent.get_state()
+        cache.put_state(cache_key, state)
+        return torrent_file_path, state, None
+    except Exception as ex:
+        return torrent_file_path, None, str(ex) or type(ex).__name__
 
 
 class Loader(threading.Thread):
@@ -50,19 +112,15 @@ class Loader(threading.Thread):
         log_name = MODULE_LOG_NAME + "." + str(Loader.count)
         logger = logging.getLogger(log_name)
         logger.setLevel(logging.INFO)
-        formatter = logging.Formatter(
-            '%(asctime)s    %(threadName)s    %(name)s    %(levelname)s \n'
-            '\t   %(message)s')
-        file_handler = logging.FileHandler("logs\\" + log_name + ".log")
-        file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
+        _add_loaders_log_handler()
         return logger
 
     @staticmethod
     def get_peer_id():
         return ("-" + "MY" + "0001" + "-" + "123456789012").encode()
 
-    def __init__(self, torrent_file_path: str):
+    def __init__(self, torrent_file_path: str, lazy=True, use_cache=True,
+                 torrent_state=None):
         if not isinstance(torrent_file_path, str):
             raise TypeError("Loader takes string as file_path")
         _check_file_correctness(torrent_file_path)
@@ -73,31 +131,71 @@ class Loader(threading.Thread):
 
         self.torrent_file_path = torrent_file_path
         self.save_directory_path = None
-        try:
-            source = _read_source_from_file(torrent_file_path)
-        except Exception as ex:
-            ex = "Exception during reading torrent-file: " + str(ex)
-            self.log.error(ex)
-            print("!!! " + ex)
-            return
-        try:
-            content = BencodeParser.parse(source)[0]
-        except Exception as ex:
-            ex = "Exception during parsing torrent-file: " + str(ex)
-            self.log.error(ex)
-            print("!!! " + ex)
-            return
-        self.log.info("INIT. Parsed torrent file successfully. "
-                      "File path: %s" % self.torrent_file_path)
-        self.torrent = TorrentMeta(content, self.log.name)
-        self.log.info("INIT. Interpreted torrent file successfully")
+        self.preallocation = PREALLOCATION_SPARSE
+        self.storage_backend = STORAGE_FILE
+        # key of metadata which is put to cache once it is interpreted
+        self._meta_cache_key = None
+        if torrent_state is not None:
+            self.torrent = TorrentMeta.from_state(torrent_state, self.log.name)
+            self.log.info("INIT. Torrent file was interpreted in advance. "
+                          "File path: %s" % self.torrent_file_path)
+        else:
+            self._read_torrent(lazy, use_cache)
         self.allocator = None
+        self._resume_file = None
+        self._resume_lock = threading.Lock()
         self.trackers = TrackersConnector(self)
         self.is_working = False
         self.is_finished = False
         self.start_download_time = None
         self.finish_download_time = None
 
+    def _read_torrent(self, lazy, use_cache):
+        """Raises ValueError if torrent-file cannot be read or parsed"""
+        try:
+            source = _read_source_from_file(self.torrent_file_path)
+        except Exception as ex:
+            ex = "Exception during reading torrent-file: " + str(ex)
+            self.log.error(ex)
+            raise ValueError(ex)
+        self.torrent = None
+        cache = _get_meta_cache() if use_cache else None
+        if cache is not None:
+            cache_key = MetaCache.get_key(self.torrent_file_path, source)
+            self.torrent = cache.get(cache_key, self.log.name)
+        if self.torrent is not None:
+            self.log.info("INIT. Torrent file was taken from cache. "
+                          "File path: %s" % self.torrent_file_path)
+        else:
+            try:
+                decoder = BencodeDecoder(source)
+                if lazy:
+                    content = BencodeDictView(decoder)
+                    raw_info = None
+                else:
+                    content = decoder.parse()[0]
+                    raw_info = decoder.raw((b"info",))
+                # info is checked while its hash is counted
+                torrent = TorrentMeta(content, self.log.name, raw_info)
+                torrent.check_structure()
+            except Exception as ex:
+                ex = "Exception during parsing torrent-file: " + str(ex)
+                self.log.error(ex)
+                raise ValueError(ex)
+            self.torrent = torrent
+            self.log.info("INIT. Parsed and interpreted torrent file "
+                          "successfully. File path: %s"
+                          % self.torrent_file_path)
+            if cache is not None:
+                # lazy metadata is put when downloading starts, see run
+                self._meta_cache_key = cache_key
+
+    def _put_to_meta_cache(self):
+        if self._meta_cache_key is None:
+            return
+        _get_meta_cache().put(self._meta_cache_key, self.torrent)
+        self._meta_cache_key = None
+
     def set_save_path(self, save_path: str):
         if not isinstance(save_path, str):
             raise TypeError("Loader takes string as file_path")
@@ -109,24 +207,94 @@ class Loader(threading.Thread):
             raise ex
         self.save_directory_path = save_path
 
+    def set_preallocation(self, mode: str):
+        if mode not in PREALLOCATION_MODES:
+            raise ValueError("Unknown preallocation mode '%s', possible: %s"
+                             % (mode, ", ".join(PREALLOCATION_MODES)))
+        self.preallocation = mode
+
+    def set_storage_backend(self, kind: str):
+        if kind not in STORAGE_BACKENDS:
+            raise ValueError("Unknown storage backend '%s', possible: %s"
+                             % (kind, ", ".join(STORAGE_BACKENDS)))
+        self.storage_backend = kind
+
     def run(self):
         self.log.info("START Start creating empty files")
         self.start_download_time = time.time()
-        self.allocator = Allocator(self.torrent,
-                                   self.save_directory_path,
-                                   self.log,
-                                   self)
+        try:
+            self.allocator = Allocator(self.torrent,
+                                       self.save_directory_path,
+                                       self.log,
+                                       self,
+                                       self.preallocation,
+                                       self.storage_backend)
+        except OSError as ex:
+            ex = "Exception during creating files: " + str(ex)
+            self.log.error(ex)
+            print("\n!!! " + ex)
+            return
+        self.log.info("START Files were created in %.3f sec"
+                      % (time.time() - self.start_download_time))
+        self._put_to_meta_cache()
+        self._load_resume_data()
         self.is_working = True
+        if self.allocator.get_left_bytes_count() == 0:
+            self.log.info("START All pieces were downloaded before")
+            self.finish_downloading()
+            return
         self.log.info("START Start connecting with trackers")
         self.trackers.start()
 
+    def _load_resume_data(self):
+        if self.storage_backend != STORAGE_FILE:
+            self.log.info("START Resume data is not used with storage "
+                          "backend '%s'" % self.storage_backend)
+            return
+        self._resume_file = ResumeFile(RESUME_DIR, self.torrent,
+                                       self.save_directory_path,
+                                       self.log.name)
+        resume_data = self._resume_file.load()
+        if resume_data is None:
+            self.log.info("START No resume data")
+            return
+        self.allocator.load_resume_state(*resume_data)
+        self.log.info("START Resume data loaded: %d pieces, %d partial "
+                      "pieces" % (len(resume_data[0]), len(resume_data[1])))
+
+    def save_resume_data(self):
+        if self._resume_file is None:
+            return
+        with self._resume_lock:
+            self._resume_file.save(*self.allocator.get_resume_state())
+
+    def recheck(self, progress=None):
+        rechecker = self.allocator.recheck(progress)
+        self.save_resume_data()
+        return rechecker
+
+    def stop(self):
+        """Writes waiting pieces and resume data before exit"""
+        if self.allocator is None:
+            return
+        self.allocator.close()
+        self.save_resume_data()
+
     def finish_downloading(self):
         self.trackers.finish()
         self.is_finished = True
         self.finish_download_time = time.time()
 
-    def get_piece_hash(self, piece_index: int):
-        return self.torrent.pieces_hashes[piece_index]
+    def resume_downloading(self):
+        """Pieces were lost after finish (e.g. by recheck)"""
+        self.log.info("Downloading is resumed")
+        self.is_finished = False
+        self.finish_download_time = None
+        self.trackers = TrackersConnector(self)
+        threading.Thread(target=self.trackers.start, daemon=True).start()
+
+    def is_piece_correct(self, piece_index: int, piece):
+        return self.torrent.pieces_hashes.is_piece_correct(piece_index, piece)
 
     def get_save_dir_path(self):
         return self.save_directory_path
@@ -1,6 +1,11 @@
 import os
+import shutil
+import logging
+import tempfile
 from unittest import TestCase
-from downloader import Loader
+from unittest.mock import patch
+from downloader import Loader, read_torrent_state, MODULE_LOG_NAME
+from torrent_fixtures import make_torrent_source
 from tracker import _parse_peers_ip_and_port
 
 
@@ -18,3 +23,65 @@ class LoaderTests(TestCase):
         peers = _parse_peers_ip_and_port(ans)
         expected = [("1.2.3.4", 1286), ("7.8.9.10", 2828)]
         self.assertListEqual(expected, peers)
+
+
+class ReadTorrentStateTests(TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.root_dir, "1.torrent")
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def _read(self, source):
+        with open(self.path, 'wb') as file:
+            file.write(source)
+        with patch("downloader.META_CACHE_DIR",
+                   os.path.join(self.root_dir, "cache")), \
+                patch("downloader._meta_cache", None):
+            return read_torrent_state(self.path)
+
+    def test_state_is_read(self):
+        path, state, error = self._read(make_torrent_source([5, 3], 4))
+        self.assertEqual(path, self.path)
+        self.assertIsNotNone(state)
+        self.assertIsNone(error)
+
+    def test_broken_file_gives_error(self):
+        path, state, error = self._read(b"d8:announce3:url4:infoi1ee")
+        self.assertIsNone(state)
+        self.assertTrue(error)
+
+
+class LoaderParsingTests(TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        # logs of loaders are not written by tests
+        self.null_handler = logging.NullHandler()
+        logging.getLogger(MODULE_LOG_NAME).addHandler(self.null_handler)
+
+    def tearDown(self):
+        logging.getLogger(MODULE_LOG_NAME).removeHandler(self.null_handler)
+        shutil.rmtree(self.root_dir)
+
+    def _check_rejected(self, source):
+        path = os.path.join(self.root_dir, "1.torrent")
+        with open(path, 'wb') as file:
+            file.write(source)
+        with self.assertRaisesRegex(
+                ValueError, "Exception during parsing torrent-file"):
+            Loader(path, use_cache=False)
+
+    def test_incorrect_int_in_info_fails_at_adding(self):
+        self._check_rejected(b"d8:announce3:url4:infod6:lengthi1x2e"
+                             b"4:name1:a12:piece lengthi4e6:pieces0:ee")
+
+    def test_file_without_length_fails_at_adding(self):
+        self._check_rejected(b"d8:announce3:url4:infod5:filesld4:pathl"
+                             b"1:aeee4:name1:d12:piece lengthi4e"
+                             b"6:pieces0:ee")
+
+    def test_incorrect_pieces_length_fails_at_adding(self):
+        self._check_rejected(b"d8:announce3:url4:infod6:lengthi4e"
+                             b"4:name1:a12:piece lengthi4e6:pieces21:" +
+                             b"x" * 21 + b"ee")
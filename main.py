@@ -5,6 +5,7 @@ import math
 import logging
 import traceback
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 import downloader
 
 
@@ -17,7 +18,8 @@ def create_logger():
     formatter = logging.Formatter(
         '%(asctime)s    %(name)s    %(levelname)s \n'
         '\t   %(message)s')
-    file_handler = logging.FileHandler("logs\\bt.main.log")
+    file_handler = logging.FileHandler(os.path.join("logs", "bt.main.log"),
+                                       delay=True)
     file_handler.setFormatter(formatter)
     logger.addHandler(file_handler)
     return logger
@@ -43,12 +45,15 @@ class DownloadingInfo:
         self.name = Path(loader.torrent_file_path).name
         self.add_time = time.asctime()
         self.start_download_time = None
-        self.files = loader.torrent.files
         self.identifier = _id
         self.is_selecting = False
         self.is_selected = False
         self.is_load_started = False
 
+    @property
+    def files(self):
+        return self.loader.torrent.files
+
     def download(self):
         self.loader.start()
 
@@ -63,11 +68,16 @@ class ConsoleInterface:
             "exit": self.print_goodbye,
             "cats": self.print_cats,
             "add_torrent": self.add_torrent,
+            "add_dir": self.add_torrents_from_dir,
             "select": self.select_files_in_torrent,
             "download": self.start_downloading,
             "show": self.show_torrent_info,
             "show_all": self.show_all_info,
             'save_select': self.save_select,
+            'prealloc': self.set_preallocation,
+            'storage': self.set_storage_backend,
+            'recheck': self.recheck_torrent,
+            'stream': self.set_stream_cursor,
             'sample': self.sample
         }
         self.torrents = []
@@ -132,6 +142,9 @@ class ConsoleInterface:
         if len(args) != 1:
             self.print_error("Command 'exit' takes no argument")
             return
+        for torrent in self.torrents:
+            if torrent.loader.is_working:
+                torrent.loader.stop()
         print()
         print("GOODBYE!!! <3")
         LOG.info("Ended CUI\n\n")
@@ -144,6 +157,8 @@ class ConsoleInterface:
               "snake_case (with '_' between words)\n")
         print("  add_torrent [file_path]        "
               "Add new torrent-file for downloading")
+        print("  add_dir [dir_path]             "
+              "Add all torrent-files from directory")
         print("  cats                           Cats")
         print("  select [torrent_id]            "
               "Select files for downloading in torrent")
@@ -155,6 +170,24 @@ class ConsoleInterface:
               "in directory save_path. After start of\n"
               "                                 "
               "downloading selected files cannot be changed")
+        print("  prealloc [torrent_id] [mode]   "
+              "Set mode of creating files before downloading:\n"
+              "                                 "
+              "sparse (default), full or zero")
+        print("  storage [torrent_id] [backend] "
+              "Set storage of downloaded data: file (default),\n"
+              "                                 "
+              "memory or null (data is discarded)")
+        print("  recheck [torrent_id]           "
+              "Check downloaded pieces of started torrent\n"
+              "                                 "
+              "against hashes from torrent-file")
+        print("  stream [torrent_id] [file_no]  "
+              "Load file of started torrent in order from\n"
+              "  [percent|off]                  "
+              "percent of its size (e.g. for playback),\n"
+              "                                 "
+              "file_no is line number in .select file")
         print("  show [torrent_id]              "
               "Show info about torrent with this identifier")
         print("  show_all                       "
@@ -198,7 +231,7 @@ class ConsoleInterface:
             self.save_select(command.split())
         except Exception:
             return
-        command = "download " + _id + " results\\"
+        command = "download " + _id + " results"
         print("### " + command)
         try:
             self.start_downloading(command.split())
@@ -215,7 +248,7 @@ class ConsoleInterface:
             new_torrent = DownloadingInfo(
                 downloader.Loader(
                     os.path.abspath(file_name)), len(self.torrents) + 1)
-        except (FileNotFoundError, IsADirectoryError) as ex:
+        except (FileNotFoundError, IsADirectoryError, ValueError) as ex:
             self.print_error(ex)
             return
         except Exception as ex:
@@ -237,6 +270,59 @@ class ConsoleInterface:
               "~ To see list of all added torrents write command 'show_all'."
               % (new_torrent.name, len(self.torrents)))
 
+    def add_torrents_from_dir(self, args):
+        if len(args) < 2:
+            self.print_error("Command 'add_dir' takes one argument: "
+                             "path of directory with torrent-files")
+            return
+        dir_path = os.path.abspath(" ".join(args[1:]))
+        if not os.path.isdir(dir_path):
+            self.print_error("No such directory '%s'" % dir_path)
+            return
+        paths = sorted(str(path) for path in Path(dir_path).glob("*.torrent")
+                       if path.is_file())
+        if not paths:
+            self.print_error("No torrent-files in directory '%s'" % dir_path)
+            return
+        start = time.time()
+        workers = min(len(paths), os.cpu_count() or 1)
+        chunk_size = max(1, len(paths) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(downloader.read_torrent_state,
+                                        paths, chunksize=chunk_size))
+        parsed_time = time.time() - start
+
+        added = []
+        for path, state, error in results:
+            if error is None:
+                try:
+                    loader = downloader.Loader(path, torrent_state=state)
+                except Exception as ex:
+                    error = str(ex)
+                else:
+                    added.append(DownloadingInfo(
+                        loader, len(self.torrents) + len(added) + 1))
+            if error is not None:
+                LOG.error("Exception '%s' during adding torrent-file '%s'"
+                          % (error, path))
+                self.print_error("Torrent '%s' was not added: %s"
+                                 % (Path(path).name, error))
+        self.torrents.extend(added)
+        total_time = max(time.time() - start, 1e-6)
+        LOG.info("Added %d of %d torrent-files from '%s' in %.3f sec "
+                 "(parsing %.3f sec)" % (len(added), len(paths), dir_path,
+                                         total_time, parsed_time))
+        print("~ %d of %d torrent-files were added in %.2f sec "
+              "(%.1f files/sec, %s/sec)"
+              % (len(added), len(paths), total_time,
+                 len(paths) / total_time,
+                 convert_bytes_size(sum(os.path.getsize(path)
+                                        for path in paths) / total_time)))
+        if added:
+            print("~ Identifiers of added torrents: %d-%d. To see them write "
+                  "command 'show_all'."
+                  % (added[0].identifier, added[-1].identifier))
+
     def check_torrent_id_downloading(self, str_id):
         try:
             torrent_id = int(str_id)
@@ -271,6 +357,116 @@ class ConsoleInterface:
         torrent.is_load_started = True
         print("Downloading of '%s' started" % torrent.name)
 
+    def set_preallocation(self, args):
+        if len(args) != 3:
+            self.print_error("Command 'prealloc' takes two arguments: "
+                             "torrent_id and mode")
+            return
+        torrent = self.check_torrent_id_downloading(args[1])
+        if torrent is None:
+            return
+        try:
+            torrent.loader.set_preallocation(args[2])
+        except ValueError as ex:
+            self.print_error(ex)
+            return
+        print("~ Files of torrent %d will be created in mode '%s'"
+              % (torrent.identifier, args[2]))
+
+    def set_storage_backend(self, args):
+        if len(args) != 3:
+            self.print_error("Command 'storage' takes two arguments: "
+                             "torrent_id and backend")
+            return
+        torrent = self.check_torrent_id_downloading(args[1])
+        if torrent is None:
+            return
+        try:
+            torrent.loader.set_storage_backend(args[2])
+        except ValueError as ex:
+            self.print_error(ex)
+            return
+        print("~ Data of torrent %d will be kept in storage '%s'"
+              % (torrent.identifier, args[2]))
+
+    def recheck_torrent(self, args):
+        if len(args) != 2:
+            self.print_error("Command 'recheck' takes one argument: "
+                             "torrent_id")
+            return
+        try:
+            torrent_id = int(args[1])
+        except ValueError:
+            self.print_error("Torrent identifier should be integer number.")
+            return
+        if not 0 <= torrent_id - 1 < len(self.torrents):
+            self.print_error("No torrent with such identifier.")
+            return
+        torrent = self.torrents[torrent_id - 1]
+        if not torrent.loader.is_working:
+            self.print_error("Torrent with identifier %d is not started. "
+                             "Start it with command 'download'" % torrent_id)
+            return
+
+        def print_progress(rechecker):
+            print("\r~ Checked %s of %s (%s/sec)"
+                  % (convert_bytes_size(rechecker.checked_bytes),
+                     convert_bytes_size(rechecker.total_bytes),
+                     convert_bytes_size(rechecker.get_speed())),
+                  end="", flush=True)
+
+        before = torrent.loader.allocator.get_left_bytes_count()
+        rechecker = torrent.loader.recheck(print_progress)
+        left = torrent.loader.allocator.get_left_bytes_count()
+        print("\n~ Recheck of torrent %d finished in %.2f sec: %s left "
+              "(was %s)" % (torrent_id,
+                            rechecker.finish_time - rechecker.start_time,
+                            convert_bytes_size(left),
+                            convert_bytes_size(before)))
+
+    def set_stream_cursor(self, args):
+        if len(args) != 4:
+            self.print_error("Command 'stream' takes three arguments: "
+                             "torrent_id, file_no and percent or 'off'")
+            return
+        try:
+            torrent_id = int(args[1])
+            file_index = int(args[2]) - 1
+            percent = None if args[3] == "off" else float(args[3])
+        except ValueError:
+            self.print_error("Torrent identifier and file number should be "
+                             "integer numbers, percent should be number "
+                             "or 'off'")
+            return
+        if not 0 <= torrent_id - 1 < len(self.torrents):
+            self.print_error("No torrent with such identifier.")
+            return
+        torrent = self.torrents[torrent_id - 1]
+        if not torrent.loader.is_working:
+            self.print_error("Torrent with identifier %d is not started. "
+                             "Start it with command 'download'" % torrent_id)
+            return
+        allocator = torrent.loader.allocator
+        if percent is None:
+            allocator.stop_stream(file_index)
+            print("~ File %d of torrent %d is not streamed"
+                  % (file_index + 1, torrent_id))
+            return
+        if not 0 <= percent < 100:
+            self.print_error("Percent should be from 0 to 100")
+            return
+        if 0 <= file_index < len(torrent.files):
+            position = int(torrent.files[file_index].length * percent / 100)
+        else:
+            position = 0
+        try:
+            allocator.set_stream_cursor(file_index, position)
+        except ValueError as ex:
+            self.print_error(ex)
+            return
+        print("~ File %d of torrent %d is loaded in order from %s"
+              % (file_index + 1, torrent_id, convert_bytes_size(position)))
+
     def select_files_in_torrent(self, args):
         if len(args) != 2:
             self.print_error(
@@ -361,11 +557,29 @@ class ConsoleInterface:
                      planned, math.ceil(planned / piece_len),
                      loaded, math.ceil(loaded / piece_len),
                      left, math.ceil(left / piece_len)))
+            allocator = torrent.loader.allocator
+            print("Uploaded: %d bytes\n"
+                  "Read cache: %d hits, %d misses, %d evictions\n"
+                  "Sent from files bypassing read cache: %d blocks\n"
+                  % ((allocator.get_uploaded_bytes_count(),)
+                     + allocator.read_cache.get_stats()
+                     + (allocator.get_blocks_sent_from_files_count(),)))
+            for file_index, position in \
+                    torrent.loader.allocator.streams.items():
+                print("Streaming: file %d from %s"
+                      % (file_index + 1, convert_bytes_size(position)))
             print("Start time: ",
                   time.ctime(torrent.loader.start_download_time))
             if torrent.loader.is_finished:
                 print("Finish time: ",
                       time.ctime(torrent.loader.finish_download_time))
+                allocator = torrent.loader.allocator
+                if allocator.final_part_duration is not None:
+                    print("Final 1%%: %.3f sec (%d duplicate requests, "
+                          "%d cancels)"
+                          % (allocator.final_part_duration,
+                             allocator.duplicate_requests_count,
+                             allocator.cancels_count))
         else:
             print("Progress: -")
 
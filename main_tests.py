@@ -0,0 +1,97 @@
+import os
+import shutil
+import logging
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+import main
+import downloader
+from torrent_fixtures import make_torrent_source
+
+TORRENTS_COUNT = 300
+
+
+class AddDirectoryTests(TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.root_dir = tempfile.mkdtemp()
+        os.chdir(self.root_dir)
+        self.dir_path = os.path.join(self.root_dir, "torrents")
+        os.makedirs(self.dir_path)
+        for index in range(TORRENTS_COUNT):
+            source = make_torrent_source([5, 3, 10], 4, name=b"t%d" % index)
+            with open(os.path.join(self.dir_path, "%03d.torrent" % index),
+                      'wb') as file:
+                file.write(source)
+        with open(os.path.join(self.dir_path, "broken.torrent"),
+                  'wb') as file:
+            file.write(b"d8:announce3:url4:infod6:lengthi1x2e")
+        # logs of loaders are not written by tests
+        self.null_handler = logging.NullHandler()
+        logging.getLogger(downloader.MODULE_LOG_NAME).addHandler(
+            self.null_handler)
+
+    def tearDown(self):
+        logging.getLogger(downloader.MODULE_LOG_NAME).removeHandler(
+            self.null_handler)
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root_dir)
+
+    def test_directory_is_added(self):
+        console = main.ConsoleInterface()
+        with patch.object(main, "LOG", logging.getLogger("test")), \
+                patch("builtins.print") as printed:
+            console.add_torrents_from_dir(["add_dir", self.dir_path])
+        self.assertEqual(len(console.torrents), TORRENTS_COUNT)
+        self.assertEqual([torrent.identifier for torrent in console.torrents],
+                         list(range(1, TORRENTS_COUNT + 1)))
+        self.assertEqual(
+            len({torrent.loader.torrent.info_hash
+                 for torrent in console.torrents}), TORRENTS_COUNT)
+        self.assertTrue(any("broken.torrent" in str(call)
+                            for call in printed.call_args_list))
+        for torrent in console.torrents:
+            self.assertEqual(torrent.loader.log.handlers, [])
+            self.assertEqual(len(torrent.files), 3)
+
+
+class AddTorrentTests(TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.null_handler = logging.NullHandler()
+        logging.getLogger(downloader.MODULE_LOG_NAME).addHandler(
+            self.null_handler)
+
+    def tearDown(self):
+        logging.getLogger(downloader.MODULE_LOG_NAME).removeHandler(
+            self.null_handler)
+        shutil.rmtree(self.root_dir)
+
+    def _add(self, console, source):
+        path = os.path.join(self.root_dir,
+                            "%d.torrent" % len(os.listdir(self.root_dir)))
+        with open(path, 'wb') as file:
+            file.write(source)
+        with patch.object(main, "LOG", logging.getLogger("test")), \
+                patch("downloader._get_meta_cache", lambda: None), \
+                patch("builtins.print") as printed:
+            console.add_torrent(["add_torrent", path])
+            console.show_all_info(["show_all"])
+        return " ".join(str(call) for call in printed.call_args_list)
+
+    def test_broken_torrents_are_not_added(self):
+        console = main.ConsoleInterface()
+        for source in (
+                b"d8:announce3:url4:infod6:lengthi1x2e4:name1:a"
+                b"12:piece lengthi4e6:pieces0:ee",
+                b"d8:announce3:url4:infod5:filesld4:pathl1:aeee"
+                b"4:name1:d12:piece lengthi4e6:pieces0:ee",
+                b"d8:announce3:url4:infod6:lengthi4e4:name1:a"
+                b"12:piece lengthi4e6:pieces21:" + b"x" * 21 + b"ee"):
+            output = self._add(console, source)
+            self.assertIn("Exception during parsing torrent-file", output)
+            self.assertNotIn("successfully added", output)
+        self.assertEqual(console.torrents, [])
+        output = self._add(console, make_torrent_source([5, 3], 4))
+        self.assertIn("successfully added", output)
+        self.assertEqual(len(console.torrents), 1)
@@ -0,0 +1,126 @@
+import os
+import marshal
+import logging
+from collections import OrderedDict
+from torrent_info import TorrentMeta, get_sha_1_hash
+
+MAGIC = b"BTMC"
+FORMAT_VERSION = 1
+ENTRY_SUFFIX = ".meta"
+DEFAULT_MAX_SIZE = 64 * 2 ** 20
+
+
+class MetaCache:
+    """
+    On-disk cache of interpreted torrent-files. Entry of torrent is keyed
+    by size, modification time and SHA-1 of torrent-file content and holds
+    marshalled state of TorrentMeta (info hash, pieces hashes buffer and
+    files table). Total size of entries is bounded, least recently used
+    entries are removed first (modification time of entry is its last use).
+    Sizes of entries are read from directory once, then they are counted
+    in memory, so put does not look through the whole cache.
+    """
+    def __init__(self, dir_path: str, max_size=DEFAULT_MAX_SIZE,
+                 logger_name="bt"):
+        self.log = logging.getLogger(logger_name + ".MetaCache")
+        self.dir_path = dir_path
+        self.max_size = max_size
+        # path -> size, least recently used first; None until first put
+        self._entries = None
+        self._total_size = 0
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path, exist_ok=True)
+
+    @staticmethod
+    def get_key(torrent_file_path: str, source: bytes):
+        stat = os.stat(torrent_file_path)
+        key = b"%d:%d:" % (stat.st_size, stat.st_mtime_ns) + \
+            get_sha_1_hash(source)
+        return get_sha_1_hash(key).hex()
+
+    def _get_entry_path(self, key: str):
+        return os.path.join(self.dir_path, key + ENTRY_SUFFIX)
+
+    def get(self, key: str, subprogram_logger_name: str):
+        """Returns TorrentMeta restored from cache or None"""
+        path = self._get_entry_path(key)
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+        except OSError:
+            return None
+        try:
+            if data[:len(MAGIC)] != MAGIC or \
+                    data[len(MAGIC)] != FORMAT_VERSION or \
+                    data[len(MAGIC) + 1] != marshal.version:
+                raise ValueError("unknown format of cache entry")
+            state = marshal.loads(data[len(MAGIC) + 2:])
+            torrent = TorrentMeta.from_state(state, subprogram_logger_name)
+        except Exception as ex:
+            self.log.error("Broken cache entry '%s': %s" % (path, str(ex)))
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        if self._entries is not None and path in self._entries:
+            self._entries.move_to_end(path)
+        return torrent
+
+    def put(self, key: str, torrent: TorrentMeta):
+        self.put_state(key, torrent.get_state())
+
+    def put_state(self, key: str, state):
+        """Puts state of TorrentMeta which was already taken"""
+        path = self._get_entry_path(key)
+        data = MAGIC + bytes([FORMAT_VERSION, marshal.version]) + \
+            marshal.dumps(state)
+        if len(data) > self.max_size:
+            return
+        temp_path = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            with open(temp_path, 'wb') as file:
+                file.write(data)
+            os.replace(temp_path, path)
+        except OSError as ex:
+            self.log.error("Exception during writing cache entry '%s': %s"
+                           % (path, str(ex)))
+            self._remove(temp_path)
+            return
+        self._load_entries()
+        self._total_size += len(data) - self._entries.pop(path, 0)
+        self._entries[path] = len(data)
+        self._evict()
+
+    def _load_entries(self):
+        if self._entries is not None:
+            return
+        entries = []
+        for name in os.listdir(self.dir_path):
+            if not name.endswith(ENTRY_SUFFIX):
+                continue
+            path = os.path.join(self.dir_path, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, path, stat.st_size))
+        entries.sort()
+        self._entries = OrderedDict((path, size)
+                                    for _, path, size in entries)
+        self._total_size = sum(self._entries.values())
+
+    def _evict(self):
+        while self._total_size > self.max_size and self._entries:
+            path, size = self._entries.popitem(last=False)
+            self._total_size -= size
+            self._remove(path)
+
+    def _remove(self, path):
+        if self._entries is not None and path in self._entries:
+            self._total_size -= self._entries.pop(path)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,88 @@
+import os
+import time
+import tempfile
+import shutil
+from unittest import TestCase
+from unittest.mock import patch
+from bencode import BencodeDecoder, BencodeDictView
+from meta_cache import MetaCache
+from torrent_info import TorrentMeta
+
+SAMPLE_PATH = os.path.join("samples", "mi.torrent")
+
+
+def _read_sample():
+    with open(SAMPLE_PATH, 'rb') as file:
+        return file.read()
+
+
+class MetaCacheTests(TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.source = _read_sample()
+        self.torrent = TorrentMeta(
+            BencodeDictView(BencodeDecoder(self.source)), "test")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    def test_put_and_get(self):
+        cache = MetaCache(self.dir_path)
+        key = MetaCache.get_key(SAMPLE_PATH, self.source)
+        self.assertIsNone(cache.get(key, "test"))
+        cache.put(key, self.torrent)
+        cached = cache.get(key, "test")
+        self.assertEqual(cached.info_hash, self.torrent.info_hash)
+        self.assertEqual(cached.announce_list, self.torrent.announce_list)
+        self.assertEqual(cached.dir_name, self.torrent.dir_name)
+        self.assertEqual(cached.length, self.torrent.length)
+        self.assertEqual(cached.piece_length, self.torrent.piece_length)
+        self.assertEqual(cached.pieces_hashes.tobytes(),
+                         self.torrent.pieces_hashes.tobytes())
+        self.assertEqual(
+            [(f.local_path, f.offset, f.length) for f in cached.files],
+            [(f.local_path, f.offset, f.length) for f in self.torrent.files])
+
+    def test_key_depends_on_content(self):
+        key = MetaCache.get_key(SAMPLE_PATH, self.source)
+        self.assertNotEqual(
+            key, MetaCache.get_key(SAMPLE_PATH, self.source + b"\0"))
+
+    def test_broken_entry_is_removed(self):
+        cache = MetaCache(self.dir_path)
+        cache.put("key", self.torrent)
+        path = os.path.join(self.dir_path, "key.meta")
+        with open(path, 'r+b') as file:
+            file.truncate(10)
+        self.assertIsNone(cache.get("key", "test"))
+        self.assertFalse(os.path.exists(path))
+
+    def test_least_recently_used_evicted(self):
+        cache = MetaCache(self.dir_path)
+        cache.put("first", self.torrent)
+        entry_size = os.path.getsize(
+            os.path.join(self.dir_path, "first.meta"))
+        cache.max_size = entry_size * 2
+        cache.put("second", self.torrent)
+        old = time.time() - 100
+        os.utime(os.path.join(self.dir_path, "first.meta"), (old, old))
+        os.utime(os.path.join(self.dir_path, "second.meta"),
+                 (old - 10, old - 10))
+        self.assertIsNotNone(cache.get("second", "test"))
+        cache.put("third", self.torrent)
+        self.assertIsNone(cache.get("first", "test"))
+        self.assertIsNotNone(cache.get("second", "test"))
+        self.assertIsNotNone(cache.get("third", "test"))
+
+    def test_directory_is_listed_once(self):
+        cache = MetaCache(self.dir_path)
+        state = self.torrent.get_state()
+        with patch("meta_cache.os.listdir", wraps=os.listdir) as listdir:
+            for index in range(5):
+                cache.put_state("key%d" % index, state)
+        self.assertEqual(listdir.call_count, 1)
+        entry_size = os.path.getsize(os.path.join(self.dir_path, "key0.meta"))
+        cache.max_size = entry_size * 2
+        cache.put_state("key0", state)
+        self.assertEqual(sorted(os.listdir(self.dir_path)),
+                         ["key0.meta", "key4.meta"])
@@ -1,3 +1,4 @@
+import os
 import queue
 import threading
 import socket
@@ -5,10 +6,13 @@ import logging
 import time
 import traceback
 from torrent_info import bytes_to_int, int_to_four_bytes_big_endian,\
-    Messages, get_sha_1_hash
+    Messages
+from request_queue import RequestQueue
 
 BITFIELD_TIMEOUT_SEC = 2
 KEEPALIVE_TIMEOUT_SEC = 120
+NO_BLOCK_WAIT_SEC = 0.1
+SENDFILE = hasattr(os, "sendfile")
 
 
 class PeerConnection(threading.Thread):
@@ -36,15 +40,12 @@ class PeerConnection(threading.Thread):
         self._receiver = None
         self._receiver_closed = True
         self.response_queue = queue.Queue()
-        self._have_message_queue = queue.Queue()
+        self._haves_count = None
+        self._cancel_message_queue = queue.Queue()
         self._was_closed = False
         self._saved_piece = False
 
-        self._target_piece_index = None
-        self._target_begin = 0
-        self._target_piece_length = None
-        self._target_segment_length = None
-        self._storage = b""
+        self.requests = RequestQueue()
         self._state = "start"
         self._received_bitfield = False
         self._bitfield = None
@@ -87,28 +88,29 @@ class PeerConnection(threading.Thread):
                 return
             self._check_input_messages()
             self._send_haves()
+            self._send_cancels()
             if self._state == "start":
                 self._greet()
                 self._state = "wait_bitfield"
             elif self._state == "wait_bitfield":
                 if self._received_bitfield:
-                    self._state = "need_target"
+                    self._state = "download"
                 time_span = time.time() - start_time
                 if time_span > BITFIELD_TIMEOUT_SEC:
                     self.log.error("Exception: no bitfield was sent from '%s'"
                                    % str(self.peer_address))
                     self.close()
                     continue
-            elif self._state == "need_target":
-                if self._try_get_new_target():
-                    self._state = "send_request"
-                else:
-                    self.log.error("No target for me" + str(self.peer_address))
-                    self.close()
-                    continue
-            elif self._state == "send_request" and not self.peer_choking:
-                self._make_request()
-                self._state = "wait_piece"
+            elif self._state == "download" and not self.peer_choking:
+                self._make_requests()
+                if len(self.requests) == 0:
+                    if not self.allocator.is_peer_interesting(self):
+                        self.log.error("No target for me" +
+                                       str(self.peer_address))
+                        self.close()
+                        continue
+                    # all blocks which peer has are loaded by others now
+                    time.sleep(NO_BLOCK_WAIT_SEC)
 
             time_span = time.time() - last_keepalive_time
             if time_span > KEEPALIVE_TIMEOUT_SEC:
@@ -122,6 +124,8 @@ class PeerConnection(threading.Thread):
         self._receiver.start()
 
     def _greet(self):
+        # pieces saved after this moment may be in bitfield and in haves
+        self._haves_count = self.allocator.get_haves_count()
         if not self.allocator.is_bitfield_empty():
             self._sender.send_bitfield()
         self._sender.send_unchoke()
@@ -136,15 +140,26 @@ class PeerConnection(threading.Thread):
                 return
 
     def _send_haves(self):
+        """Sends pieces saved since the last call (or since bitfield)"""
+        if self._haves_count is None:
+            return
+        haves, self._haves_count = self.allocator.get_new_haves(
+            self, self._haves_count)
+        for piece_index in haves:
+            self._sender.send_have(piece_index)
+
+    def _send_cancels(self):
         while True:
             try:
-                piece_index = self._have_message_queue.get_nowait()
-                self._sender.send_have(piece_index)
+                block = self._cancel_message_queue.get_nowait()
             except queue.Empty:
                 return
+            if self.requests.discard(block):
+                self._sender.send_cancel(*block)
 
-    def send_have_message(self, piece_index: int):
-        self._have_message_queue.put(piece_index)
+    def send_cancel_message(self, piece_index: int, begin: int, length: int):
+        """Block came from other peer (endgame), request is cancelled"""
+        self._cancel_message_queue.put((piece_index, begin, length))
 
     def close(self):
         self._was_closed = True
@@ -169,22 +184,18 @@ class PeerConnection(threading.Thread):
         self.log.fatal("Connection with peer '%s' was closed"
                        % str(self.peer_address))
 
-    def _try_get_new_target(self):
-        target = self.allocator.try_get_target_piece_and_length(self)
-        if target:
-            self._target_piece_index = target[0]
-            self._target_piece_length = target[1]
-            self._target_segment_length = min(
-                self._target_piece_length,
-                Messages.piece_segment_length)
-            return True
-        return False
+    def _make_requests(self):
+        """Fills queue of requests up to its current depth"""
+        while not self.requests.is_full():
+            block = self.allocator.try_get_block(self)
+            if block is None:
+                return
+            self.requests.add(block)
+            self._sender.send_request(*block)
 
-    def _make_request(self):
-        self._sender.send_request(
-            self._target_piece_index,
-            self._target_begin,
-            self._target_segment_length)
+    def _release_requests(self):
+        for block in self.requests.clear():
+            self.allocator.release_block(*block, self)
 
     # TODO: проверка длины сообщения? нужна вроде бы
     def _react_keepalive(self, response: bytes):
@@ -192,6 +203,8 @@ class PeerConnection(threading.Thread):
 
     def _react_choke(self, response: bytes):
         self.peer_choking = True
+        # choking peer discards requests, blocks are given to others
+        self._release_requests()
 
     def _react_unchoke(self, response: bytes):
         self.peer_choking = False
@@ -219,6 +232,20 @@ class PeerConnection(threading.Thread):
         begin = bytes_to_int(response[5:9])
         length = bytes_to_int(response[9:13])
 
+        if SENDFILE:
+            # cached pieces are sent from memory, misses go straight from
+            # files and are not read into cache
+            piece = self.allocator.try_get_cached_piece_segment(
+                piece_index, begin, length)
+            if piece is not None:
+                self._sender.send_piece(piece_index, begin, piece)
+                return
+            source = self.allocator.try_open_piece_segment(
+                piece_index, begin, length)
+            if source is not None:
+                self._sender.send_piece_from_file(
+                    piece_index, begin, length, *source)
+                return
         piece = self.allocator.try_get_piece_segment(
             piece_index, begin, length)
         # TODO: сделать очередь
@@ -230,32 +257,9 @@ class PeerConnection(threading.Thread):
         begin = bytes_to_int(response[5:9])
         piece = response[9:]
 
-        if piece_index == self._target_piece_index and \
-                self._target_begin == begin and \
-                self._target_segment_length == len(piece):
-
-            self._storage += piece
-            self._target_begin = begin + self._target_segment_length
-            self._target_segment_length = min(
-                self._target_piece_length - self._target_begin,
-                Messages.piece_segment_length)
-            self._state = "send_request"
-
-            if self._target_begin == self._target_piece_length:
-                _hash = get_sha_1_hash(self._storage)
-                expected_hash = self._loader.get_piece_hash(piece_index)
-                if _hash == expected_hash:
-                    self.log.info("SAVED GOOD PIECE from '%s'"
-                                  % str(self.peer_address))
-                    self.allocator.save_piece(
-                        piece_index, self._storage, self)
-                    self._saved_piece = True
-                    self._state = "need_target"
-                    return
-                else:
-                    self.log.info("Piece with wrong hash from '%s'"
-                                  % str(self.peer_address))
-                    self._state = "need_target"
+        if self.requests.pop((piece_index, begin, len(piece))):
+            if self.allocator.add_block(piece_index, begin, piece, self):
+                self._saved_piece = True
 
     def _react_cancel(self, response: bytes):
         if len(response) != 13:
@@ -333,10 +337,37 @@ class PeerSender:
 
     # TODO: может сам извлечет piece?
     def send_piece(self, piece_index: int, begin: int, piece: bytes):
-        message = int_to_four_bytes_big_endian(piece_index) + \
+        message = Messages.piece + \
+                  int_to_four_bytes_big_endian(piece_index) + \
                   int_to_four_bytes_big_endian(begin) + piece
         self._send_with_length_prefix(message)
 
+    def send_piece_from_file(self, piece_index: int, begin: int,
+                             length: int, file_descriptor: int, offset: int):
+        """
+        Sends header of piece message, then block goes from file straight
+        to socket with os.sendfile. Closes file_descriptor
+        """
+        header = int_to_four_bytes_big_endian(9 + length) + \
+            Messages.piece + \
+            int_to_four_bytes_big_endian(piece_index) + \
+            int_to_four_bytes_big_endian(begin)
+        try:
+            self._socket.sendall(header)
+            socket_descriptor = self._socket.fileno()
+            while length > 0:
+                sent = os.sendfile(socket_descriptor, file_descriptor,
+                                   offset, length)
+                if sent == 0:
+                    raise EOFError("File is shorter than piece")
+                offset += sent
+                length -= sent
+        except Exception as ex:
+            self._client.log.error("Exception during sending: " + str(ex))
+            self._client.close()
+        finally:
+            os.close(file_descriptor)
+
     # TODO: обработать кусочки неполной длины. Выделить общее?
     def send_cancel(self, piece_index: int, begin: int, length: int):
         message = Messages.cancel + \
@@ -0,0 +1,165 @@
+import os
+import socket
+import logging
+import tempfile
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import patch
+from peer import PeerConnection
+from torrent_info import Messages, bytes_to_int, \
+    int_to_four_bytes_big_endian
+
+BLOCK_LENGTH = Messages.piece_segment_length
+
+
+class FakeSocket:
+    def __init__(self):
+        self.messages = []
+
+    def send(self, message):
+        self.messages.append(message[4:])
+        return len(message)
+
+    def get_requests(self):
+        return [(bytes_to_int(message[1:5]), bytes_to_int(message[5:9]),
+                 bytes_to_int(message[9:13]))
+                for message in self.messages
+                if message[:1] == Messages.request]
+
+
+class FakeAllocator:
+    def __init__(self, blocks_count):
+        self.free = [(index, 0, BLOCK_LENGTH)
+                     for index in range(blocks_count)]
+        self.added = []
+        self.released = []
+        self.cached = {}
+        self.opened = []
+
+    def try_get_block(self, peer):
+        return self.free.pop(0) if self.free else None
+
+    def add_block(self, piece_index, begin, block, peer):
+        self.added.append((piece_index, begin, len(block)))
+        return False
+
+    def release_block(self, piece_index, begin, length, peer):
+        self.released.append((piece_index, begin, length))
+
+    def try_get_cached_piece_segment(self, piece_index, begin, length):
+        piece = self.cached.get(piece_index)
+        return None if piece is None else piece[begin:begin + length]
+
+    def try_open_piece_segment(self, piece_index, begin, length):
+        self.opened.append((piece_index, begin, length))
+        return None
+
+    def try_get_piece_segment(self, piece_index, begin, length):
+        return False
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def time(self):
+        return self.now
+
+
+def _piece_message(piece_index, begin, length):
+    return Messages.piece + int_to_four_bytes_big_endian(piece_index) + \
+        int_to_four_bytes_big_endian(begin) + bytes(length)
+
+
+class PeerRequestsTests(TestCase):
+    def setUp(self):
+        loader = SimpleNamespace(
+            torrent=SimpleNamespace(info_hash=b"h" * 20),
+            get_peer_id=lambda: b"p" * 20)
+        tracker = SimpleNamespace(log=logging.getLogger("test"))
+        self.allocator = FakeAllocator(100)
+        self.peer = PeerConnection(("peer", 1), loader, tracker,
+                                   self.allocator)
+        self.peer._sender._socket.close()
+        self.socket = FakeSocket()
+        self.peer._sender._socket = self.socket
+        self.clock = Clock()
+        patcher = patch("request_queue.time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _receive(self, block):
+        self.peer._react_piece(_piece_message(*block))
+
+    def test_queue_is_filled_to_depth(self):
+        self.peer._make_requests()
+        self.assertEqual(self.socket.get_requests(),
+                         [(0, 0, BLOCK_LENGTH), (1, 0, BLOCK_LENGTH)])
+        self.peer._make_requests()
+        self.assertEqual(len(self.socket.get_requests()), 2)
+
+    def test_blocks_are_matched_with_requests(self):
+        self.peer._make_requests()
+        self._receive((1, 0, BLOCK_LENGTH))
+        # not requested, duplicate and of other length are dropped
+        self._receive((5, 0, BLOCK_LENGTH))
+        self._receive((1, 0, BLOCK_LENGTH))
+        self._receive((0, 0, BLOCK_LENGTH - 1))
+        self.assertEqual(self.allocator.added, [(1, 0, BLOCK_LENGTH)])
+        self.assertEqual(len(self.peer.requests), 1)
+        self.assertIn((0, 0, BLOCK_LENGTH), self.peer.requests)
+
+    def test_depth_grows_and_shrinks_with_rate(self):
+        self.peer._make_requests()
+        first, second = self.socket.get_requests()
+        self.clock.now = 0.5
+        self._receive(first)
+        self.clock.now = 1
+        self._receive(second)
+        # 2 blocks per second, requests for 3 seconds are kept
+        self.peer._make_requests()
+        self.assertEqual(len(self.peer.requests), 6)
+        # one block in 10 seconds, depth goes down and nothing is sent
+        self.clock.now = 11
+        self._receive(self.socket.get_requests()[2])
+        self.assertEqual(self.peer.requests.get_depth(), 3)
+        self.peer._make_requests()
+        self.assertEqual(len(self.socket.get_requests()), 8)
+        self.assertEqual(len(self.peer.requests), 5)
+
+    def test_choke_releases_requests(self):
+        self.peer._make_requests()
+        self.peer._react_choke(Messages.choke)
+        self.assertEqual(self.allocator.released,
+                         [(0, 0, BLOCK_LENGTH), (1, 0, BLOCK_LENGTH)])
+        self.assertEqual(len(self.peer.requests), 0)
+        self._receive((0, 0, BLOCK_LENGTH))
+        self.assertEqual(self.allocator.added, [])
+
+    def test_cached_piece_is_sent_before_file(self):
+        self.allocator.cached[2] = b"abcdefgh"
+        with patch("peer.SENDFILE", True):
+            self.peer._react_request(Messages.request + b"".join(
+                int_to_four_bytes_big_endian(value) for value in (2, 2, 4)))
+            self.peer._react_request(Messages.request + b"".join(
+                int_to_four_bytes_big_endian(value) for value in (3, 0, 4)))
+        self.assertEqual(self.socket.messages, [
+            Messages.piece + int_to_four_bytes_big_endian(2) +
+            int_to_four_bytes_big_endian(2) + b"cdef"])
+        self.assertEqual(self.allocator.opened, [(3, 0, 4)])
+
+    def test_piece_from_truncated_file(self):
+        first, second = socket.socketpair()
+        self.addCleanup(first.close)
+        self.addCleanup(second.close)
+        self.peer._sender._socket = first
+        file_descriptor, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        os.write(file_descriptor, b"abcd")
+        self.peer._sender.send_piece_from_file(3, 0, 8, file_descriptor, 0)
+        self.assertTrue(self.peer._was_closed)
+        with self.assertRaises(OSError):
+            os.fstat(file_descriptor)
+        second.settimeout(1)
+        self.assertEqual(second.recv(17), int_to_four_bytes_big_endian(17) +
+                         _piece_message(3, 0, 0) + b"abcd")
@@ -0,0 +1,128 @@
+from torrent_info import Messages
+
+BLOCK_LENGTH = Messages.piece_segment_length
+
+
+class PieceBlocks:
+    """
+    Block map of piece being downloaded: piece is split into blocks of
+    BLOCK_LENGTH (the last one may be shorter), every block is received
+    or not and is requested by some set of peers. Blocks may come from
+    different peers in any order
+    """
+    def __init__(self, piece_index: int, piece_length: int,
+                 block_length=BLOCK_LENGTH):
+        self.index = piece_index
+        self.length = piece_length
+        self.block_length = block_length
+        self.blocks_count = -(-piece_length // block_length)
+        self._data = bytearray(piece_length)
+        self._received = [False] * self.blocks_count
+        self._received_count = 0
+        self._requesters = [set() for _ in range(self.blocks_count)]
+        self._free_count = self.blocks_count
+
+    def get_block(self, block_index: int):
+        """Returns (begin, length) of block"""
+        begin = block_index * self.block_length
+        return begin, min(self.block_length, self.length - begin)
+
+    def get_block_index(self, begin: int, length: int):
+        """Returns index of block with such begin and length or -1"""
+        if begin % self.block_length != 0 or \
+                not 0 <= begin < self.length:
+            return -1
+        block_index = begin // self.block_length
+        if self.get_block(block_index)[1] != length:
+            return -1
+        return block_index
+
+    def get_received_count(self):
+        return self._received_count
+
+    def has_free_blocks(self):
+        """Are there blocks which are not received and not requested"""
+        return self._free_count > 0
+
+    def is_complete(self):
+        return self._received_count == self.blocks_count
+
+    def take_block(self, peer):
+        """
+        Gives to peer the first block which is not received and not
+        requested by anyone. Returns block index or -1
+        """
+        if self._free_count == 0:
+            return -1
+        for block_index in range(self.blocks_count):
+            if not self._received[block_index] and \
+                    not self._requesters[block_index]:
+                self._requesters[block_index].add(peer)
+                self._free_count -= 1
+                return block_index
+        return -1
+
+    def take_duplicate_block(self, peer):
+        """
+        Endgame: gives to peer block which is not received yet, but is
+        requested by others (by the least number of them). Returns block
+        index or -1
+        """
+        target_block = -1
+        for block_index in range(self.blocks_count):
+            requesters = self._requesters[block_index]
+            if not self._received[block_index] and \
+                    peer not in requesters and (
+                        target_block == -1 or len(requesters) <
+                        len(self._requesters[target_block])):
+                target_block = block_index
+        if target_block != -1:
+            if not self._requesters[target_block]:
+                self._free_count -= 1
+            self._requesters[target_block].add(peer)
+        return target_block
+
+    def get_requesters(self, block_index: int):
+        return set(self._requesters[block_index])
+
+    def release_block(self, block_index: int, peer):
+        requesters = self._requesters[block_index]
+        if peer in requesters:
+            requesters.remove(peer)
+            if not requesters and not self._received[block_index]:
+                self._free_count += 1
+
+    def release_blocks(self, peer):
+        """Forgets all requests of peer, e.g. when it is disconnected"""
+        for block_index in range(self.blocks_count):
+            self.release_block(block_index, peer)
+
+    def add_block(self, begin: int, block: bytes):
+        """Stores block, returns False if it is not expected one"""
+        block_index = self.get_block_index(begin, len(block))
+        if block_index == -1 or self._received[block_index]:
+            return False
+        self._data[begin:begin + len(block)] = block
+        self._received[block_index] = True
+        self._received_count += 1
+        if not self._requesters[block_index]:
+            self._free_count -= 1
+        self._requesters[block_index].clear()
+        return True
+
+    def get_data(self):
+        return bytes(self._data)
+
+    def get_loaded_prefix(self):
+        """Received blocks from the beginning of piece without gaps"""
+        count = 0
+        while count < self.blocks_count and self._received[count]:
+            count += 1
+        return bytes(self._data[:min(count * self.block_length,
+                                     self.length)])
+
+    def load_prefix(self, data: bytes):
+        """Marks whole blocks of data as received (e.g. from resume)"""
+        for block_index in range(len(data) // self.block_length):
+            begin, length = self.get_block(block_index)
+            self.add_block(begin, data[begin:begin + length])
@@ -0,0 +1,60 @@
+from unittest import TestCase
+from piece_blocks import PieceBlocks
+
+
+class PieceBlocksTests(TestCase):
+    def test_blocks_split(self):
+        blocks = PieceBlocks(3, 10, 4)
+        self.assertEqual(blocks.blocks_count, 3)
+        self.assertEqual(blocks.get_block(2), (8, 2))
+        self.assertEqual(blocks.get_block_index(8, 2), 2)
+        self.assertEqual(blocks.get_block_index(8, 4), -1)
+        self.assertEqual(blocks.get_block_index(2, 4), -1)
+
+    def test_blocks_from_different_peers(self):
+        blocks = PieceBlocks(0, 10, 4)
+        self.assertEqual(blocks.take_block("first"), 0)
+        self.assertEqual(blocks.take_block("second"), 1)
+        self.assertEqual(blocks.take_block("first"), 2)
+        self.assertFalse(blocks.has_free_blocks())
+        self.assertTrue(blocks.add_block(8, b"89"))
+        self.assertTrue(blocks.add_block(4, b"4567"))
+        self.assertFalse(blocks.add_block(4, b"4567"))
+        self.assertFalse(blocks.is_complete())
+        self.assertEqual(blocks.get_loaded_prefix(), b"")
+        self.assertTrue(blocks.add_block(0, b"0123"))
+        self.assertTrue(blocks.is_complete())
+        self.assertEqual(blocks.get_data(), b"0123456789")
+
+    def test_released_blocks_are_given_again(self):
+        blocks = PieceBlocks(0, 8, 4)
+        blocks.take_block("first")
+        blocks.take_block("first")
+        blocks.add_block(0, b"0123")
+        blocks.release_blocks("first")
+        self.assertTrue(blocks.has_free_blocks())
+        self.assertEqual(blocks.take_block("second"), 1)
+
+    def test_load_prefix(self):
+        blocks = PieceBlocks(0, 10, 4)
+        blocks.load_prefix(b"012345")
+        self.assertEqual(blocks.get_received_count(), 1)
+        self.assertEqual(blocks.get_loaded_prefix(), b"0123")
+        self.assertEqual(blocks.take_block("peer"), 1)
+
+    def test_duplicate_blocks(self):
+        blocks = PieceBlocks(0, 8, 4)
+        blocks.take_block("first")
+        blocks.take_block("second")
+        self.assertEqual(blocks.take_block("third"), -1)
+        self.assertEqual(blocks.take_duplicate_block("third"), 0)
+        self.assertEqual(blocks.take_duplicate_block("third"), 1)
+        self.assertEqual(blocks.take_duplicate_block("third"), -1)
+        self.assertEqual(blocks.get_requesters(1), {"second", "third"})
+        blocks.add_block(4, b"4567")
+        self.assertEqual(blocks.take_duplicate_block("second"), 0)
+        blocks.release_blocks("first")
+        blocks.release_blocks("second")
+        blocks.release_blocks("third")
+        self.assertEqual(blocks.take_block("fourth"), 0)
+
@@ -0,0 +1,240 @@
+_SET_BITS = [tuple(bit for bit in range(8) if value & (0x80 >> bit))
+             for value in range(256)]
+
+
+def _count_bits(value: int):
+    if hasattr(value, "bit_count"):
+        return value.bit_count()
+    return bin(value).count("1")
+
+
+class Bitfield:
+    """
+    Pieces of peer packed into bytes as in bitfield message: piece 0 is
+    the high bit of the first byte. Spare bits at the end are cleared.
+    The same bits are kept as int with count of set ones, both are
+    changed along with bytes, so checks of whole bitfield do not convert
+    bytes every time
+    """
+    def __init__(self, pieces_count: int, data=None):
+        self.pieces_count = pieces_count
+        size = -(-pieces_count // 8)
+        self._last_bit = size * 8 - 1
+        if data is None:
+            self._data = bytearray(size)
+            self._value = 0
+            self._count = 0
+        else:
+            if len(data) != size:
+                raise ValueError("Bitfield of %d pieces should have %d "
+                                 "bytes, not %d"
+                                 % (pieces_count, size, len(data)))
+            self._data = bytearray(data)
+            if pieces_count % 8 != 0:
+                self._data[-1] &= (0xFF << (8 - pieces_count % 8)) & 0xFF
+            self._value = int.from_bytes(self._data, "big")
+            self._count = _count_bits(self._value)
+
+    def __getitem__(self, piece_index: int):
+        return self._data[piece_index >> 3] & (0x80 >> (piece_index & 7)) \
+            != 0
+
+    def __iter__(self):
+        """Indices of set pieces, zero bytes are skipped at once"""
+        for byte_index, value in enumerate(self._data):
+            if value:
+                start = byte_index << 3
+                for bit in _SET_BITS[value]:
+                    yield start + bit
+
+    def _check_index(self, piece_index: int):
+        if not 0 <= piece_index < self.pieces_count:
+            raise ValueError("Piece index %d is out of bitfield of %d "
+                             "pieces" % (piece_index, self.pieces_count))
+
+    def add(self, piece_index: int):
+        """Sets piece, returns False if it was already set"""
+        self._check_index(piece_index)
+        mask = 0x80 >> (piece_index & 7)
+        if self._data[piece_index >> 3] & mask:
+            return False
+        self._data[piece_index >> 3] |= mask
+        self._value |= 1 << (self._last_bit - piece_index)
+        self._count += 1
+        return True
+
+    def remove(self, piece_index: int):
+        """Clears piece, returns False if it was not set"""
+        self._check_index(piece_index)
+        mask = 0x80 >> (piece_index & 7)
+        if not self._data[piece_index >> 3] & mask:
+            return False
+        self._data[piece_index >> 3] &= ~mask & 0xFF
+        self._value &= ~(1 << (self._last_bit - piece_index))
+        self._count -= 1
+        return True
+
+    def count(self):
+        return self._count
+
+    def is_full(self):
+        return self._count == self.pieces_count
+
+    def to_int(self):
+        return self._value
+
+    def intersects(self, other):
+        return self._value & other.to_int() != 0
+
+    def tobytes(self):
+        return bytes(self._data)
+
+
+class PiecePicker:
+    """
+    Rarest-first choice of pieces. Free pieces (wanted, not saved and
+    without downloader) are kept in buckets by availability (count of
+    peers having the piece), so changes of availability and state cost
+    O(1) and choice looks only through buckets of the rarest pieces.
+    Buckets are lists with known position of every piece in them: piece
+    is removed by swapping with the last one, so lists stay dense.
+    Busy pieces (being downloaded) are given only when no piece is free.
+    Seeds are only counted, they do not change order of pieces. Whole
+    bitfields move only their own free pieces between buckets, so cost
+    of bitfield does not depend on count of other free pieces.
+    Streams (e.g. for playback of media file) go before rarest-first:
+    window of first wanted pieces after cursor of stream is loaded in
+    order, window slides forward when its first pieces are loaded.
+    """
+    def __init__(self, pieces_count: int):
+        self._seeds_count = 0
+        self._availability = [0] * pieces_count
+        self._positions = [-1] * pieces_count
+        self._buckets = [[]]
+        self._busy = set()
+        self._free_count = 0
+        self._streams = dict()
+
+    def get_availability(self, piece_index: int):
+        return self._availability[piece_index] + self._seeds_count
+
+    def change_seeds_count(self, delta: int):
+        self._seeds_count += delta
+
+    def set_stream(self, key, first_piece: int, last_piece: int,
+                   window: int):
+        """Window of stream is window wanted pieces from first_piece"""
+        self._streams[key] = [first_piece, last_piece, window]
+
+    def remove_stream(self, key):
+        self._streams.pop(key, None)
+
+    def _is_wanted(self, piece_index):
+        return self._positions[piece_index] != -1 or \
+            piece_index in self._busy
+
+    def _pick_in_streams(self, peer_have):
+        for stream in self._streams.values():
+            piece_index, last_piece, window = stream
+            # pieces before the first wanted one are not needed any more
+            while piece_index <= last_piece and \
+                    not self._is_wanted(piece_index):
+                piece_index += 1
+            stream[0] = piece_index
+            while piece_index <= last_piece and window > 0:
+                if self._positions[piece_index] != -1:
+                    if peer_have[piece_index]:
+                        return piece_index
+                    window -= 1
+                elif piece_index in self._busy:
+                    window -= 1
+                piece_index += 1
+        return -1
+
+    def get_free_count(self):
+        return self._free_count
+
+    def _add(self, piece_index, availability):
+        while len(self._buckets) <= availability:
+            self._buckets.append([])
+        bucket = self._buckets[availability]
+        self._positions[piece_index] = len(bucket)
+        bucket.append(piece_index)
+
+    def _remove(self, piece_index, availability):
+        bucket = self._buckets[availability]
+        position = self._positions[piece_index]
+        last = bucket.pop()
+        if last != piece_index:
+            bucket[position] = last
+            self._positions[last] = position
+        self._positions[piece_index] = -1
+
+    def change_availability(self, piece_index: int, delta: int):
+        old = self._availability[piece_index]
+        self._availability[piece_index] = old + delta
+        if self._positions[piece_index] != -1:
+            self._remove(piece_index, old)
+            self._add(piece_index, old + delta)
+
+    def change_availability_of_all(self, pieces_indices, delta: int):
+        """The same as change_availability for every piece of bitfield"""
+        availability = self._availability
+        positions = self._positions
+        buckets = self._buckets
+        for piece_index in pieces_indices:
+            old = availability[piece_index]
+            availability[piece_index] = old + delta
+            position = positions[piece_index]
+            if position == -1:
+                continue
+            # the same as _remove and _add, inlined for long bitfields
+            bucket = buckets[old]
+            last = bucket.pop()
+            if last != piece_index:
+                bucket[position] = last
+                positions[last] = position
+            while len(buckets) <= old + delta:
+                buckets.append([])
+            bucket = buckets[old + delta]
+            positions[piece_index] = len(bucket)
+            bucket.append(piece_index)
+
+    def set_state(self, piece_index: int, is_free: bool, is_busy: bool):
+        if is_free != (self._positions[piece_index] != -1):
+            if is_free:
+                self._add(piece_index, self._availability[piece_index])
+                self._free_count += 1
+            else:
+                self._remove(piece_index, self._availability[piece_index])
+                self._free_count -= 1
+        if is_busy:
+            self._busy.add(piece_index)
+        else:
+            self._busy.discard(piece_index)
+
+    def pick(self, peer_have):
+        """
+        Returns free piece of stream window or the rarest free piece
+        which peer has (peer_have[index] is true), busy piece if there are
+        no free pieces at all or -1
+        """
+        if self._streams:
+            target_piece = self._pick_in_streams(peer_have)
+            if target_piece != -1:
+                return target_piece
+        first = 0 if self._seeds_count > 0 else 1
+        for availability in range(first, len(self._buckets)):
+            for piece_index in self._buckets[availability]:
+                if peer_have[piece_index]:
+                    return piece_index
+        if self._free_count > 0:
+            return -1
+        target_piece = -1
+        for piece_index in self._busy:
+            if peer_have[piece_index] and (
+                    target_piece == -1 or
+                    self._availability[piece_index] <
+                    self._availability[target_piece]):
+                target_piece = piece_index
+        return target_piece
@@ -0,0 +1,139 @@
+from unittest import TestCase
+from piece_picker import PiecePicker, Bitfield
+
+
+class PiecePickerTests(TestCase):
+    def _make_picker(self, availability):
+        picker = PiecePicker(len(availability))
+        for piece_index, count in enumerate(availability):
+            picker.change_availability(piece_index, count)
+            picker.set_state(piece_index, True, False)
+        return picker
+
+    def test_rarest_piece_is_picked(self):
+        picker = self._make_picker([3, 1, 2, 1])
+        self.assertEqual(picker.pick([True, False, True, True]), 3)
+        self.assertEqual(picker.pick([True, False, True, False]), 2)
+        self.assertEqual(picker.pick([False] * 4), -1)
+
+    def test_availability_changes(self):
+        picker = self._make_picker([2, 2])
+        picker.change_availability(1, -1)
+        self.assertEqual(picker.pick([True, True]), 1)
+        picker.change_availability(0, -1)
+        picker.change_availability(1, 2)
+        self.assertEqual(picker.pick([True, True]), 0)
+        self.assertEqual(picker.get_availability(1), 3)
+
+    def test_not_available_pieces_are_not_picked(self):
+        picker = self._make_picker([0, 1])
+        self.assertEqual(picker.pick([True, True]), 1)
+
+    def test_busy_pieces_only_without_free(self):
+        picker = self._make_picker([1, 2, 3])
+        picker.set_state(0, False, True)
+        picker.set_state(1, False, True)
+        self.assertEqual(picker.pick([True, True, False]), -1)
+        self.assertEqual(picker.get_free_count(), 1)
+        picker.set_state(2, False, False)
+        self.assertEqual(picker.pick([True, True, False]), 0)
+        picker.set_state(0, False, False)
+        self.assertEqual(picker.pick([True, True, False]), 1)
+
+    def test_seeds_make_pieces_available(self):
+        picker = self._make_picker([0, 2])
+        self.assertEqual(picker.pick([True, True]), 1)
+        picker.change_seeds_count(1)
+        self.assertEqual(picker.get_availability(0), 1)
+        self.assertEqual(picker.pick([True, True]), 0)
+
+    def test_availability_of_bitfield(self):
+        picker = self._make_picker([1, 1, 1])
+        picker.change_availability_of_all(Bitfield(3, b"\xa0"), 1)
+        self.assertEqual(picker.get_availability(0), 2)
+        self.assertEqual(picker.pick([True, True, True]), 1)
+        picker.change_availability_of_all([0, 2], -1)
+        picker.change_availability(1, 1)
+        self.assertEqual(picker.pick([True, True, False]), 0)
+
+    def test_bitfield_moves_its_free_pieces(self):
+        picker = self._make_picker([1] * 16)
+        picker.set_state(3, False, True)
+        picker.change_availability_of_all(range(8), 2)
+        picker.change_availability_of_all([0, 1], -1)
+        for availability, bucket in enumerate(picker._buckets):
+            for position, piece_index in enumerate(bucket):
+                self.assertEqual(picker._positions[piece_index], position)
+                self.assertEqual(picker.get_availability(piece_index),
+                                 availability)
+        self.assertEqual(sorted(picker._buckets[2]), [0, 1])
+        self.assertEqual(sorted(picker._buckets[3]), [2, 4, 5, 6, 7])
+        self.assertEqual(sorted(picker._buckets[1]), list(range(8, 16)))
+        self.assertEqual(picker.get_availability(3), 3)
+
+    def test_stream_window_goes_in_order(self):
+        picker = self._make_picker([3, 3, 3, 3, 3, 1])
+        picker.set_stream(0, 1, 4, 2)
+        self.assertEqual(picker.pick([True] * 6), 1)
+        picker.set_state(1, False, True)
+        self.assertEqual(picker.pick([True] * 6), 2)
+        picker.set_state(2, False, True)
+        # window of two pieces is busy, rarest piece goes next
+        self.assertEqual(picker.pick([True] * 6), 5)
+        picker.set_state(1, False, False)
+        self.assertEqual(picker.pick([True] * 6), 3)
+        # window slid to pieces 2 and 3, piece 4 is out of it
+        self.assertEqual(picker.pick([True, True, True, False, True, True]),
+                         5)
+        picker.set_stream(0, 4, 4, 2)
+        self.assertEqual(picker.pick([True] * 6), 4)
+        picker.remove_stream(0)
+        self.assertEqual(picker.pick([True] * 6), 5)
+
+
+class BitfieldTests(TestCase):
+    def test_bits_order(self):
+        bitfield = Bitfield(10, b"\x81\x40")
+        self.assertEqual(list(bitfield), [0, 7, 9])
+        self.assertTrue(bitfield[0])
+        self.assertFalse(bitfield[1])
+        self.assertEqual(bitfield.count(), 3)
+
+    def test_spare_bits_are_cleared(self):
+        bitfield = Bitfield(10, b"\xff\xff")
+        self.assertEqual(bitfield.tobytes(), b"\xff\xc0")
+        self.assertTrue(bitfield.is_full())
+
+    def test_add_and_remove(self):
+        bitfield = Bitfield(9)
+        self.assertTrue(bitfield.add(8))
+        self.assertFalse(bitfield.add(8))
+        self.assertEqual(bitfield.tobytes(), b"\x00\x80")
+        self.assertTrue(bitfield.remove(8))
+        self.assertFalse(bitfield.remove(8))
+        self.assertEqual(bitfield.count(), 0)
+
+    def test_index_out_of_pieces(self):
+        bitfield = Bitfield(10)
+        for piece_index in (10, 15, 16, -1):
+            with self.assertRaises(ValueError):
+                bitfield.add(piece_index)
+            with self.assertRaises(ValueError):
+                bitfield.remove(piece_index)
+        self.assertEqual(bitfield.count(), 0)
+        self.assertEqual(bitfield.tobytes(), b"\x00\x00")
+
+    def test_intersects(self):
+        first = Bitfield(16, b"\x0f\x00")
+        self.assertTrue(first.intersects(Bitfield(16, b"\x01\x00")))
+        second = Bitfield(16, b"\xf0\xff")
+        self.assertFalse(first.intersects(second))
+        second.add(7)
+        self.assertTrue(first.intersects(second))
+        second.remove(7)
+        self.assertFalse(first.intersects(second))
+        self.assertEqual(second.count(), 12)
+
+    def test_wrong_length(self):
+        with self.assertRaises(ValueError):
+            Bitfield(9, b"\x00")
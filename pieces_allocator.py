@@ -1,67 +1,129 @@
+import time
 import logging
+from collections import deque
 from threading import Lock
 from peer import PeerConnection
-from data_storage import DataStorage
+from data_storage import DataStorage, PREALLOCATION_SPARSE, STORAGE_FILE
+from disk_writer import DiskWriter
+from read_cache import PieceReadCache
+from recheck import Rechecker
+from piece_picker import PiecePicker, Bitfield
+from piece_blocks import PieceBlocks
 from torrent_info import TorrentMeta
 
+RESUME_SAVE_INTERVAL_SEC = 60
+FINAL_PART = 0.01
+STREAM_WINDOW_BYTES = 16 * 2 ** 20
+MAX_REQUEST_LENGTH = 2 ** 17
+
 
 class Piece:
     def __init__(self, index: int, is_downloading: bool):
         self.index = index
         self.have = False
-        self.count_in_peers = 0
+        self.saving = False
         self.is_downloading = is_downloading
-        self.downloader = None
         self.files = []
 
 
 class Allocator:
+    """
+    State of pieces of one torrent shared by all its peers. Locks are
+    narrow, only _blocks_lock is taken under _state_lock, other locks
+    are never nested:
+    _state_lock - pieces states, wanted pieces, own bitfield, left bytes;
+    _picker_lock - PiecePicker. Changes of pieces states and of
+    availability are queued to _picker_updates without lock and are
+    applied by the thread which chooses piece, so neither state nor
+    bitfields and haves of peers are waiting for picker;
+    _blocks_lock - block maps of pieces being loaded. _active is changed
+    only under both _state_lock and _blocks_lock, so any of them is
+    enough to read it;
+    _peers_lock - set of peers;
+    _upload_lock - uploaded bytes counter.
+    Streamed files (see set_stream_cursor) are loaded in order from the
+    cursor by picker, their pieces which are being loaded go first.
+    Bitfield of peer is changed only by thread of this peer, so it is
+    read and changed without lock. Saved pieces are appended to _haves
+    (under _state_lock) and every peer reads new ones by itself, see
+    get_new_haves, so saving of piece does not touch every peer
+    """
     def __init__(self, torrent: TorrentMeta,
-                 root_dir_path: str, logger, loader):
+                 root_dir_path: str, logger, loader,
+                 preallocation=PREALLOCATION_SPARSE,
+                 storage_backend=STORAGE_FILE):
         self.log = logging.getLogger(logger.name + ".Allocator")
         self.loader = loader
         self.length = torrent.length
         self.piece_length = torrent.piece_length
+        self._files = torrent.files
         self.pieces_count = self.length // self.piece_length + \
             (1 if self.length % self.piece_length > 0 else 0)
-        self._data_storage = DataStorage(torrent, root_dir_path, logger)
+        self._data_storage = DataStorage(torrent, root_dir_path, logger,
+                                         preallocation,
+                                         backend=storage_backend)
         self._left_bytes_count = self._data_storage.bytes_count
         self.planned_bytes_count = self._left_bytes_count
         self._uploaded = 0
+        self._blocks_sent_from_files = 0
+        self._state_lock = Lock()
+        self._picker_lock = Lock()
+        self._blocks_lock = Lock()
+        self._peers_lock = Lock()
+        self._upload_lock = Lock()
 
-        self._pieces = []
-        for piece_index in range(self.pieces_count):
-            is_downloading = False
-            start_byte = piece_index * self.piece_length
-            finish_byte = min((piece_index + 1) *
-                              self.piece_length, self.length)
-            while start_byte < finish_byte:
-                file_record, offset = \
-                    self._data_storage.find_piece_in_files(start_byte)
-                if file_record.is_downloading:
-                    is_downloading = True
-                start_byte += min(finish_byte - start_byte,
-                                  file_record.length - offset)
-            self._pieces.append(Piece(piece_index, is_downloading))
+        downloading_pieces = \
+            self._data_storage.files_index.get_downloading_pieces()
+        self._pieces = [Piece(piece_index, is_downloading)
+                        for piece_index, is_downloading
+                        in enumerate(downloading_pieces)]
+        self._picker = PiecePicker(self.pieces_count)
+        self._picker_updates = deque()
+        self._wanted = Bitfield(self.pieces_count)
+        self._active = dict()
+        # file index -> cursor in bytes, ranges are read without lock
+        self.streams = dict()
+        self._stream_ranges = ()
+        for piece in self._pieces:
+            self._update_picker(piece)
 
         self._peers_pieces_info = dict()
-        self._peers_targets = dict()
+        self._seed_peers = set()
+        self.endgame_start_time = None
+        self.final_part_start_time = None
+        self.final_part_duration = None
+        self.duplicate_requests_count = 0
+        self.cancels_count = 0
         bit_size = self.pieces_count // 8 + \
             (1 if self.pieces_count % 8 != 0 else 0)
         self._my_bitfield = bytearray(bit_size)
         self._is_empty = True
-        self._lock = Lock()
+        self._is_finished = False
+        self._haves = []
+        self._last_resume_time = time.time()
+        self._writer = DiskWriter(self._data_storage, self._complete_pieces,
+                                  self._fail_pieces, logger)
+        self._writer.start()
+        self.read_cache = PieceReadCache(self._data_storage, logger)
 
     def state_string_view(self):
-        result = ""
+        """
+        Is built without _state_lock: flags of pieces are read as they
+        are, only received counts of active pieces are copied under
+        _blocks_lock
+        """
+        with self._blocks_lock:
+            received = {piece_index: blocks.get_received_count()
+                        for piece_index, blocks in self._active.items()}
+        parts = []
         for piece in self._pieces:
             if piece.is_downloading:
                 state = 1 if piece.have else 0
-                if piece.downloader is None:
-                    result += str(state) + "----- "
+                if piece.index not in received:
+                    parts.append("%d----- " % state)
                 else:
-                    result += "%d-%4d " % (state, piece.downloader.index)
-        return result
+                    parts.append("%d-%4d " % (state, received[piece.index]))
+        return "".join(parts)
 
     def get_left_bytes_count(self):
         return self._left_bytes_count
@@ -69,6 +131,9 @@ class Allocator:
     def get_uploaded_bytes_count(self):
         return self._uploaded
 
+    def get_blocks_sent_from_files_count(self):
+        return self._blocks_sent_from_files
+
     def get_downloaded_bytes_count(self):
         return self.planned_bytes_count - self._left_bytes_count
 
@@ -76,141 +141,513 @@ class Allocator:
         return self._is_empty
 
     def get_bitfield(self):
-        return self._my_bitfield
+        return bytes(self._my_bitfield)
+
+    def get_piece_length(self, piece_index: int):
+        if piece_index == self.pieces_count - 1:
+            return self.length - (self.pieces_count - 1) * self.piece_length
+        return self.piece_length
 
-    def try_get_target_piece_and_length(self, peer: PeerConnection):
+    def get_haves_count(self):
+        return len(self._haves)
+
+    def get_new_haves(self, peer: PeerConnection, haves_count: int):
         """
-        Вернет False, если у пира не осталось кусочков,
-        которых клиент не загрузил. Иначе вернет номер кусочка, который
-        нужно загружать у этого пира и длину этого кусочка
+        Returns pieces saved after first haves_count ones (except pieces
+        which peer has) and new count of haves. Is not locked: _haves
+        only grows
         """
-        with self._lock:
-            if peer not in self._peers_pieces_info.keys():
-                self.log.error("Not bitfield info about peer " + str(peer))
-                return False
-            target_piece = self._find_target_piece_with_min_loaders_count(peer)
+        haves = self._haves
+        new_count = len(haves)
+        if new_count == haves_count:
+            return [], haves_count
+        peer_have = self._peers_pieces_info.get(peer)
+        new_haves = [piece_index
+                     for piece_index in haves[haves_count:new_count]
+                     if peer_have is None or not peer_have[piece_index]]
+        return new_haves, new_count
+
+    def is_peer_interesting(self, peer: PeerConnection):
+        """
+        Has peer pieces which client still wants. Is not locked, answer
+        may be a bit stale
+        """
+        peer_have = self._peers_pieces_info.get(peer)
+        return peer_have is not None and peer_have.intersects(self._wanted)
+
+    def try_get_block(self, peer: PeerConnection):
+        """
+        Returns (piece index, begin, length) of block which peer should
+        load, or None if there is no block for it now. Blocks of pieces
+        which are already being loaded go first, so pieces are completed
+        sooner; new piece is chosen by picker. When every wanted piece is
+        being loaded and has no free blocks, endgame begins: blocks which
+        are requested from other peers are requested from this one too
+        """
+        peer_have = self._peers_pieces_info.get(peer)
+        if peer_have is None:
+            self.log.error("Not bitfield info about peer " + str(peer))
+            return None
+        with self._blocks_lock:
+            block = self._try_take_free_block(peer_have, peer)
+        if block is not None:
+            return block
+        target_piece = self._find_target_piece_with_min_loaders_count(
+            peer_have, peer)
+        if target_piece is None:
+            return self._take_duplicate_block(peer_have, peer)
+        with self._state_lock:
+            with self._blocks_lock:
+                # other peer could start new piece while lock was free
+                block = self._try_take_free_block(peer_have, peer)
             if target_piece == -1:
-                return False
+                return block
+            piece = self._pieces[target_piece]
+            if block is not None or target_piece in self._active or \
+                    piece.have or piece.saving:
+                # piece was taken by picker, its real state is returned;
+                # if state was changed after choice, peer will ask again
+                self._update_picker(piece)
+                return block
+            blocks = PieceBlocks(target_piece,
+                                 self.get_piece_length(target_piece))
+            with self._blocks_lock:
+                self._active[target_piece] = blocks
+                block = self._take_block(blocks, peer)
+            self._update_picker(piece)
+            return block
+
+    def _try_take_free_block(self, peer_have: Bitfield,
+                             peer: PeerConnection):
+        stream_ranges = self._stream_ranges
+        target = None
+        for blocks in self._active.values():
+            if blocks.has_free_blocks() and peer_have[blocks.index]:
+                if not stream_ranges:
+                    return self._take_block(blocks, peer)
+                # the nearest piece of streams goes first
+                if _is_in_ranges(blocks.index, stream_ranges) and (
+                        target is None or blocks.index < target.index or
+                        not _is_in_ranges(target.index, stream_ranges)):
+                    target = blocks
+                elif target is None:
+                    target = blocks
+        if target is None:
+            return None
+        return self._take_block(target, peer)
 
-            prev = self._peers_targets[peer]
-            if prev is not None:
-                self._pieces[prev].downloader = None
-            self._pieces[target_piece].downloader = peer
-            self._peers_targets[peer] = target_piece
-
-            if target_piece == self.pieces_count - 1:
-                return target_piece, self.length - \
-                       (self.pieces_count - 1) * self.piece_length
-            return target_piece, self.piece_length
-
-    def _find_target_piece_with_min_loaders_count(self, peer):
-        peer_have = self._peers_pieces_info[peer]
-        minimal_count = 1000
-        target_piece = -1
-        left_without_peer = 0
-        for index in range(self.pieces_count):
-            if not self._pieces[index].have and \
-                    self._pieces[index].is_downloading and \
-                            self._pieces[index].downloader is None:
-                left_without_peer += 1
-                if peer_have[index]:
-                    if self._pieces[index].count_in_peers < minimal_count:
-                        minimal_count = self._pieces[index].count_in_peers
-                        target_piece = index
+    @staticmethod
+    def _take_block(blocks: PieceBlocks, peer: PeerConnection):
+        begin, length = blocks.get_block(blocks.take_block(peer))
+        return blocks.index, begin, length
+
+    def _take_duplicate_block(self, peer_have: Bitfield,
+                              peer: PeerConnection):
+        with self._blocks_lock:
+            for blocks in self._active.values():
+                if peer_have[blocks.index]:
+                    block_index = blocks.take_duplicate_block(peer)
+                    if block_index != -1:
+                        break
+            else:
+                return None
+            begin, length = blocks.get_block(block_index)
+            self.duplicate_requests_count += 1
+            is_endgame_start = self.endgame_start_time is None
+            if is_endgame_start:
+                self.endgame_start_time = time.time()
+        if is_endgame_start:
+            self.log.info("Endgame started, %d pieces are being loaded"
+                          % len(self._active))
+        return blocks.index, begin, length
+
+    def release_block(self, piece_index: int, begin: int, length: int,
+                      peer: PeerConnection):
+        """Peer will not load this block (e.g. it was choked)"""
+        with self._blocks_lock:
+            blocks = self._active.get(piece_index)
+            if blocks is not None:
+                block_index = blocks.get_block_index(begin, length)
+                if block_index != -1:
+                    blocks.release_block(block_index, peer)
+
+    def set_stream_cursor(self, file_index: int, position: int):
+        """
+        Pieces of file from byte position in it are loaded in order,
+        window of STREAM_WINDOW_BYTES goes before rarest pieces
+        """
+        if not 0 <= file_index < len(self._files):
+            raise ValueError("No file with index %d" % file_index)
+        file_record = self._files[file_index]
+        if not file_record.is_downloading:
+            raise ValueError("File %d is not selected for downloading"
+                             % file_index)
+        if not 0 <= position < file_record.length:
+            raise ValueError("Position should be in file of %d bytes"
+                             % file_record.length)
+        first_piece = (file_record.offset + position) // self.piece_length
+        window = max(1, STREAM_WINDOW_BYTES // self.piece_length)
+        with self._state_lock:
+            self.streams[file_index] = position
+            self._update_stream_ranges()
+            self._picker_updates.append(
+                (self._picker.set_stream,
+                 (file_index, first_piece, file_record.pieces_to, window)))
+
+    def stop_stream(self, file_index: int):
+        with self._state_lock:
+            self.streams.pop(file_index, None)
+            self._update_stream_ranges()
+            self._picker_updates.append(
+                (self._picker.remove_stream, (file_index,)))
+
+    def _update_stream_ranges(self):
+        """Is called under _state_lock"""
+        self._stream_ranges = tuple(
+            ((self._files[file_index].offset + position)
+             // self.piece_length, self._files[file_index].pieces_to)
+            for file_index, position in self.streams.items())
+
+    def _find_target_piece_with_min_loaders_count(self, peer_have: Bitfield,
+                                                  peer: PeerConnection):
+        """Returns index of free piece, -1 or None if endgame is on"""
+        if not peer_have.intersects(self._wanted):
+            return -1
+        with self._picker_lock:
+            self._apply_picker_updates()
+            free_count = self._picker.get_free_count()
+            if free_count == 0:
+                return None
+            target_piece = self._picker.pick(peer_have)
+            if target_piece != -1:
+                # is taken at once, so other peers do not choose it
+                self._picker.set_state(target_piece, False, True)
         if target_piece == -1:
-            peer_str = ""
-            piece_str = ""
-            for index in range(self.pieces_count):
-                if self._pieces[index].is_downloading:
-                    piece_str += '1' if self._pieces[index].have else '-'
-                    peer_str += '1' if peer_have[index] else '-'
-            self.log.info("piece " + piece_str + "\n       peer  " + peer_str)
-        if target_piece == -1 and left_without_peer == 0:
-            for index in range(self.pieces_count):
-                if not self._pieces[index].have and \
-                        self._pieces[index].is_downloading and \
-                        peer_have[index]:
-                    if self._pieces[index].count_in_peers < minimal_count:
-                        minimal_count = self._pieces[index].count_in_peers
-                        target_piece = index
+            self.log.info("No target piece for peer %s, free pieces: %d"
+                          % (str(peer), free_count))
         return target_piece
 
+    def _apply_picker_updates(self):
+        """Is called under _picker_lock"""
+        while self._picker_updates:
+            method, args = self._picker_updates.popleft()
+            method(*args)
+
+    def _update_picker(self, piece: Piece):
+        """Is called under _state_lock after every change of piece state"""
+        is_wanted = piece.is_downloading and not piece.have and \
+            not piece.saving
+        if is_wanted:
+            self._wanted.add(piece.index)
+        elif piece.index in self._active:
+            with self._blocks_lock:
+                self._active.pop(piece.index)
+        if not is_wanted:
+            self._wanted.remove(piece.index)
+        is_active = piece.index in self._active
+        self._picker_updates.append(
+            (self._picker.set_state,
+             (piece.index, is_wanted and not is_active,
+              is_wanted and is_active)))
+
     def add_bitfield_info(self, bitfield: bytes, peer: PeerConnection):
-        with self._lock:
+        if len(bitfield) != len(self._my_bitfield):
+            self.log.error("Incorrect bitfield len by peer " + str(peer))
+            return
+        pieces_info = Bitfield(self.pieces_count, bitfield)
+        is_seed = pieces_info.is_full()
+        # bits are walked before lock is taken, it is only for counters
+        pieces_indices = [] if is_seed else list(pieces_info)
+        with self._peers_lock:
             if peer in self._peers_pieces_info.keys():
                 self.log.error("Repeat bitfield adding by peer " + str(peer))
                 return
-            if len(bitfield) != len(self._my_bitfield):
-                self.log.error("Incorrect bitfield len by peer " + str(peer))
-                return
-            pieces_info = [False] * self.pieces_count
-            index = 0
-
-            for byte in bitfield:
-                value = byte
-                for i in range(8):
-                    value >>= 1
-                    if value & 1 == 1:
-                        pieces_info[index] = True
-                        self._pieces[index].count_in_peers += 1
-                    index += 1
-                    if index == self.pieces_count:
-                        break
-                if index == self.pieces_count:
-                    break
             self._peers_pieces_info[peer] = pieces_info
-            self._peers_targets[peer] = None
+            if is_seed:
+                self._seed_peers.add(peer)
+        if is_seed:
+            self._picker_updates.append(
+                (self._picker.change_seeds_count, (1,)))
+        else:
+            self._picker_updates.append(
+                (self._picker.change_availability_of_all,
+                 (pieces_indices, 1)))
 
     def add_have_info(self, piece_index: int, peer: PeerConnection):
-        with self._lock:
-            if peer not in self._peers_pieces_info.keys():
-                self._peers_pieces_info[peer] = [False] * self.pieces_count
-            self._peers_pieces_info[peer][piece_index] = True
-            self._pieces[piece_index].count_in_peers += 1
-
-    def save_piece(self, piece_index: int, piece: bytes,
-                   peer: PeerConnection):
-        with self._lock:
-            if self._pieces[piece_index].have:
-                return
-            self._pieces[piece_index].have = True
-            written_len = self._data_storage.write_piece(piece_index, piece)
-            self._left_bytes_count -= written_len
-            self._mark_my_bitfield(piece_index)
-            self._is_empty = False
-            for other_peer in self._peers_pieces_info:
-                if other_peer != peer:
-                    other_peer.send_have_message(piece_index)
-            if self._left_bytes_count == 0:
-                self.log.info("DOWNLOADING FINISHED")
-                self.loader.finish_downloading()
-        self.log.info(self.state_string_view())
+        if not 0 <= piece_index < self.pieces_count:
+            self.log.error("Incorrect piece index %d in have by peer %s"
+                           % (piece_index, str(peer)))
+            return
+        peer_have = self._peers_pieces_info.get(peer)
+        if peer_have is None:
+            with self._peers_lock:
+                peer_have = self._peers_pieces_info.setdefault(
+                    peer, Bitfield(self.pieces_count))
+        if peer_have.add(piece_index):
+            self._picker_updates.append(
+                (self._picker.change_availability, (piece_index, 1)))
+
+    def add_block(self, piece_index: int, begin: int, block: bytes,
+                  peer: PeerConnection):
+        """
+        Stores received block, returns False if it was not expected.
+        Other peers which requested the same block are asked to cancel
+        their requests. Block which completes piece makes it checked
+        against its hash and passed to disk writer. Piece is marked as
+        present only when it is written, see _complete_pieces. Blocks
+        peer while memory budget of disk writer is exhausted
+        """
+        with self._blocks_lock:
+            blocks = self._active.get(piece_index)
+            if blocks is None:
+                return False
+            block_index = blocks.get_block_index(begin, len(block))
+            if block_index == -1:
+                return False
+            requesters = blocks.get_requesters(block_index)
+            if not blocks.add_block(begin, block):
+                return False
+            requesters.discard(peer)
+            self.cancels_count += len(requesters)
+            is_complete = blocks.is_complete()
+        for other_peer in requesters:
+            other_peer.send_cancel_message(piece_index, begin, len(block))
+        if not is_complete:
+            return True
+        with self._state_lock:
+            piece = self._pieces[piece_index]
+            if piece.have or piece.saving:
+                return True
+            piece.saving = True
+            self._update_picker(piece)
+        piece = blocks.get_data()
+        if not self.loader.is_piece_correct(piece_index, piece):
+            self.log.info("Piece %d with wrong hash, last block from '%s'"
+                          % (piece_index, str(peer.peer_address)))
+            self._fail_pieces([piece_index])
+            return True
+        self.log.info("SAVED GOOD PIECE %d" % piece_index)
+        self._writer.put(piece_index, piece)
+        return True
+
+    def _complete_pieces(self, written):
+        with self._state_lock:
+            for piece_index, written_len in written:
+                self._pieces[piece_index].saving = False
+                self._pieces[piece_index].have = True
+                self._update_picker(self._pieces[piece_index])
+                self._left_bytes_count -= written_len
+                if self.final_part_start_time is None and \
+                        self._left_bytes_count <= \
+                        self.planned_bytes_count * FINAL_PART:
+                    self.final_part_start_time = time.time()
+                self._mark_my_bitfield(piece_index)
+                self._is_empty = False
+                self._haves.append(piece_index)
+            finished = self._check_finished()
+        if finished:
+            self._finish()
+        if self.log.isEnabledFor(logging.INFO):
+            self.log.info(self.state_string_view())
+        # Writer thread is the only one which writes files, so files are
+        # not changing while resume data is being saved here
+        if finished or time.time() - self._last_resume_time >= \
+                RESUME_SAVE_INTERVAL_SEC:
+            self._last_resume_time = time.time()
+            self.loader.save_resume_data()
+
+    def _check_finished(self):
+        """Is called under _state_lock, True only once"""
+        if self._left_bytes_count != 0 or self._is_finished:
+            return False
+        self._is_finished = True
+        if self.final_part_start_time is not None:
+            self.final_part_duration = \
+                time.time() - self.final_part_start_time
+        return True
+
+    def _finish(self):
+        self.log.info("DOWNLOADING FINISHED")
+        if self.final_part_duration is not None:
+            self.log.info("Final %d%% took %.3f sec, %d duplicate requests, "
+                          "%d cancels" % (FINAL_PART * 100,
+                                          self.final_part_duration,
+                                          self.duplicate_requests_count,
+                                          self.cancels_count))
+        self._data_storage.close()
+        self.loader.finish_downloading()
+
+    def recheck(self, progress=None):
+        """
+        Checks pieces on disk against hashes and updates bitfield:
+        correct pieces are marked as present, present pieces which are
+        not correct are marked as absent. If finished torrent loses
+        pieces, downloading is resumed. Returns Rechecker with stats
+        """
+        with self._state_lock:
+            had_pieces = {piece.index for piece in self._pieces
+                          if piece.have}
+        rechecker = Rechecker(self._data_storage, self.log)
+        checked, correct = rechecker.check(progress)
+        with self._state_lock:
+            for piece_index in checked:
+                piece = self._pieces[piece_index]
+                if piece.have or piece.saving or not piece.is_downloading:
+                    if piece_index in had_pieces and \
+                            piece_index not in correct:
+                        self.log.info("Piece %d failed recheck" % piece_index)
+                        piece.have = False
+                        self._update_picker(piece)
+                        self._left_bytes_count += self._data_storage.\
+                            get_piece_saving_length(piece_index)
+                        self._unmark_my_bitfield(piece_index)
+                    continue
+                if piece_index in correct:
+                    piece.have = True
+                    self._update_picker(piece)
+                    self._left_bytes_count -= \
+                        self._data_storage.get_piece_saving_length(
+                            piece_index)
+                    self._mark_my_bitfield(piece_index)
+                    self._haves.append(piece_index)
+            self._is_empty = not any(self._my_bitfield)
+            self.read_cache.clear()
+            finished = self._check_finished()
+            resumed = self._is_finished and self._left_bytes_count != 0
+            if resumed:
+                self._is_finished = False
+                self.final_part_start_time = None
+                self.final_part_duration = None
+        if finished:
+            self._finish()
+        if resumed:
+            self.log.info("Pieces were lost after finish, %d bytes left"
+                          % self._left_bytes_count)
+            self.loader.resume_downloading()
+        return rechecker
+
+    def _fail_pieces(self, piece_indices):
+        with self._state_lock:
+            for piece_index in piece_indices:
+                self._pieces[piece_index].saving = False
+                self._update_picker(self._pieces[piece_index])
+
+    def get_resume_state(self):
+        """Returns saved pieces indices and partial pieces for resume file"""
+        with self._state_lock:
+            have_pieces = [piece.index for piece in self._pieces
+                           if piece.have]
+            partial_pieces = dict()
+            with self._blocks_lock:
+                for blocks in self._active.values():
+                    loaded = blocks.get_loaded_prefix()
+                    if loaded:
+                        partial_pieces[blocks.index] = loaded
+        return have_pieces, partial_pieces
+
+    def load_resume_state(self, have_pieces, partial_pieces):
+        with self._state_lock:
+            for piece_index in have_pieces:
+                piece = self._pieces[piece_index]
+                if piece.have or not piece.is_downloading:
+                    continue
+                piece.have = True
+                self._update_picker(piece)
+                self._left_bytes_count -= \
+                    self._data_storage.get_piece_saving_length(piece_index)
+                self._mark_my_bitfield(piece_index)
+                self._is_empty = False
+            for piece_index, loaded in partial_pieces.items():
+                piece = self._pieces[piece_index]
+                if piece.have or piece.saving or not piece.is_downloading:
+                    continue
+                with self._blocks_lock:
+                    blocks = self._active.get(piece_index)
+                    if blocks is None:
+                        blocks = PieceBlocks(
+                            piece_index, self.get_piece_length(piece_index))
+                        self._active[piece_index] = blocks
+                    blocks.load_prefix(loaded)
+                self._update_picker(piece)
+
+    def close(self):
+        """Writes waiting pieces and closes files"""
+        self._writer.close()
+        self._data_storage.close()
 
     def _mark_my_bitfield(self, piece_index):
-        self._my_bitfield[piece_index // 8] |= (1 << (piece_index % 8))
+        self._my_bitfield[piece_index // 8] |= (0x80 >> (piece_index % 8))
+
+    def _unmark_my_bitfield(self, piece_index):
+        self._my_bitfield[piece_index // 8] &= ~(0x80 >> (piece_index % 8))
+
+    def _add_uploaded(self, bytes_count: int):
+        with self._upload_lock:
+            self._uploaded += bytes_count
+
+    def _is_request_valid(self, piece_index: int, begin: int, length: int):
+        """Block requested by peer lies in piece which we have"""
+        return 0 <= piece_index < self.pieces_count and \
+            self._pieces[piece_index].have and \
+            0 < length <= MAX_REQUEST_LENGTH and 0 <= begin and \
+            begin + length <= self.get_piece_length(piece_index)
 
     def try_get_piece_segment(
             self, piece_index: int, begin: int, length: int):
-        with self._lock:
-            piece = self._pieces[piece_index]
-            if piece.have:
-                segment = self._data_storage.read_piece_segment(
-                    piece_index, begin, length)
-                self._uploaded += len(segment)
-                return segment
+        if not self._is_request_valid(piece_index, begin, length):
             return False
+        segment = self.read_cache.get_segment(piece_index, begin, length)
+        if not segment:
+            return False
+        self._add_uploaded(len(segment))
+        return segment
+
+    def try_get_cached_piece_segment(
+            self, piece_index: int, begin: int, length: int):
+        """Returns block only if its piece is in read cache, else None"""
+        if not self._is_request_valid(piece_index, begin, length):
+            return None
+        segment = self.read_cache.peek_segment(piece_index, begin, length)
+        if segment is not None:
+            self._add_uploaded(len(segment))
+        return segment
+
+    def try_open_piece_segment(
+            self, piece_index: int, begin: int, length: int):
+        """
+        Returns (file descriptor, offset) for sending block straight from
+        file or None, see DataStorage.open_piece_segment. Such blocks do
+        not pass through read cache
+        """
+        if not self._is_request_valid(piece_index, begin, length):
+            return None
+        source = self._data_storage.open_piece_segment(
+            piece_index, begin, length)
+        if source is not None:
+            self._add_uploaded(length)
+            with self._upload_lock:
+                self._blocks_sent_from_files += 1
+        return source
 
     def remove_peer(self, peer: PeerConnection):
-        with self._lock:
-            if peer in self._peers_pieces_info:
-                piece_info = self._peers_pieces_info[peer]
-                for index in range(len(piece_info)):
-                    if piece_info[index]:
-                        self._pieces[index].count_in_peers -= 1
-                self._peers_pieces_info.pop(peer)
-            if peer in self._peers_targets:
-                target = self._peers_targets[peer]
-                if target is not None and \
-                    self._pieces[target].downloader == peer:
-                    self._pieces[target].downloader = None
-                self._peers_targets.pop(peer)
+        with self._peers_lock:
+            peer_have = self._peers_pieces_info.pop(peer, None)
+            is_seed = peer in self._seed_peers
+            self._seed_peers.discard(peer)
+        if peer_have is not None and is_seed:
+            self._picker_updates.append(
+                (self._picker.change_seeds_count, (-1,)))
+        elif peer_have is not None:
+            self._picker_updates.append(
+                (self._picker.change_availability_of_all,
+                 (list(peer_have), -1)))
+        with self._blocks_lock:
+            for blocks in self._active.values():
+                blocks.release_blocks(peer)
+
+
+def _is_in_ranges(piece_index: int, ranges):
+    for first_piece, last_piece in ranges:
+        if first_piece <= piece_index <= last_piece:
+            return True
+    return False
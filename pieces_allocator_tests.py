@@ -0,0 +1,201 @@
+import logging
+import threading
+from unittest import TestCase
+from data_storage import STORAGE_NULL, STORAGE_MEMORY
+from pieces_allocator import Allocator
+from torrent_fixtures import make_torrent
+
+LOGGER = logging.getLogger("test")
+BLOCK_LENGTH = 2 ** 14
+
+
+class Loader:
+    def __init__(self):
+        self.finished = threading.Event()
+        self.resumed_count = 0
+
+    def is_piece_correct(self, piece_index, piece):
+        return True
+
+    def finish_downloading(self):
+        self.finished.set()
+
+    def save_resume_data(self):
+        pass
+
+    def resume_downloading(self):
+        self.resumed_count += 1
+        self.finished.clear()
+
+
+class Peer:
+    def __init__(self, index):
+        self.peer_address = ("peer", index)
+        self.cancels = []
+
+    def send_cancel_message(self, piece_index, begin, length):
+        self.cancels.append((piece_index, begin, length))
+
+
+class AllocatorTests(TestCase):
+    def setUp(self):
+        self.loader = Loader()
+        torrent = make_torrent([10 * 2 * BLOCK_LENGTH], 2 * BLOCK_LENGTH)
+        self.allocator = Allocator(torrent, None, LOGGER, self.loader,
+                                   storage_backend=STORAGE_NULL)
+
+    def tearDown(self):
+        self.allocator.close()
+
+    def _load(self, peer, blocks_count):
+        for _ in range(blocks_count):
+            block = self.allocator.try_get_block(peer)
+            if block is None:
+                return
+            piece_index, begin, length = block
+            self.allocator.add_block(piece_index, begin, bytes(length), peer)
+
+    def test_haves_are_given_to_peers(self):
+        first, second = Peer(1), Peer(2)
+        self.allocator.add_bitfield_info(b"\xff\xc0", first)
+        self.allocator.add_bitfield_info(b"\x00\x00", second)
+        self._load(first, 2)
+        self.allocator.close()
+        self.assertEqual(self.allocator.get_new_haves(first, 0), ([], 1))
+        self.assertEqual(self.allocator.get_new_haves(second, 0), ([0], 1))
+        self.assertEqual(self.allocator.get_new_haves(second, 1), ([], 1))
+
+    def test_requests_out_of_piece_are_rejected(self):
+        peer = Peer(1)
+        self.allocator.add_bitfield_info(b"\x80\x00", peer)
+        self._load(peer, 2)
+        self.allocator.close()
+        piece_length = 2 * BLOCK_LENGTH
+        self.assertTrue(self.allocator.try_get_piece_segment(
+            0, BLOCK_LENGTH, BLOCK_LENGTH))
+        for piece_index, begin, length in [
+                (0, 0, piece_length + 1), (0, piece_length, 4),
+                (0, BLOCK_LENGTH, BLOCK_LENGTH + 1), (0, -1, 4), (0, 0, 0),
+                (1, 0, 4), (10, 0, 4), (-1, 0, 4)]:
+            self.assertFalse(self.allocator.try_get_piece_segment(
+                piece_index, begin, length))
+            self.assertIsNone(self.allocator.try_open_piece_segment(
+                piece_index, begin, length))
+            self.assertIsNone(self.allocator.try_get_cached_piece_segment(
+                piece_index, begin, length))
+
+    def test_have_out_of_pieces_is_ignored(self):
+        bad, good = Peer(1), Peer(2)
+        self.allocator.add_bitfield_info(b"\x00\x00", bad)
+        self.allocator.add_bitfield_info(b"\x80\x00", good)
+        for piece_index in (10, 12, 16, 2 ** 31):
+            self.allocator.add_have_info(piece_index, bad)
+        self.assertFalse(self.allocator.is_peer_interesting(bad))
+        self.assertEqual(self.allocator.try_get_block(good),
+                         (0, 0, BLOCK_LENGTH))
+
+    def test_peers_load_blocks_of_one_piece(self):
+        first, second = Peer(1), Peer(2)
+        self.allocator.add_bitfield_info(b"\x80\x00", first)
+        self.allocator.add_bitfield_info(b"\x80\x00", second)
+        self.assertEqual(self.allocator.try_get_block(first),
+                         (0, 0, BLOCK_LENGTH))
+        self.assertEqual(self.allocator.try_get_block(second),
+                         (0, BLOCK_LENGTH, BLOCK_LENGTH))
+
+    def test_streamed_file_is_loaded_in_order(self):
+        first, second, third = Peer(1), Peer(2), Peer(3)
+        for peer in (first, second, third):
+            self.allocator.add_bitfield_info(b"\xff\xc0", peer)
+        self.allocator.set_stream_cursor(0, 5 * 2 * BLOCK_LENGTH + 1)
+        self.assertEqual(self.allocator.try_get_block(first),
+                         (5, 0, BLOCK_LENGTH))
+        self.assertEqual(self.allocator.try_get_block(second),
+                         (5, BLOCK_LENGTH, BLOCK_LENGTH))
+        self.assertEqual(self.allocator.try_get_block(third),
+                         (6, 0, BLOCK_LENGTH))
+        self.allocator.stop_stream(0)
+        self.assertEqual(self.allocator.streams, {})
+        with self.assertRaises(ValueError):
+            self.allocator.set_stream_cursor(0, 10 * 2 * BLOCK_LENGTH)
+        with self.assertRaises(ValueError):
+            self.allocator.set_stream_cursor(1, 0)
+
+    def test_endgame_cancels(self):
+        first, second = Peer(1), Peer(2)
+        self.allocator.add_bitfield_info(b"\xff\xc0", first)
+        self.allocator.add_bitfield_info(b"\xff\xc0", second)
+        for _ in range(20):
+            self.allocator.try_get_block(first)
+        self.assertIsNone(self.allocator.try_get_block(first))
+        self.assertEqual(self.allocator.try_get_block(second),
+                         (0, 0, BLOCK_LENGTH))
+        self.assertTrue(self.allocator.add_block(0, 0, bytes(BLOCK_LENGTH),
+                                                 second))
+        self.assertEqual(first.cancels, [(0, 0, BLOCK_LENGTH)])
+        self.assertFalse(self.allocator.add_block(0, 0, bytes(BLOCK_LENGTH),
+                                                  first))
+
+    def test_many_peer_threads(self):
+        peers = [Peer(index) for index in range(50)]
+        for peer in peers:
+            self.allocator.add_bitfield_info(b"\xff\xc0", peer)
+        threads = [threading.Thread(target=self._load, args=(peer, 100))
+                   for peer in peers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(self.loader.finished.wait(5))
+        self.assertEqual(self.allocator.get_left_bytes_count(), 0)
+        self.assertEqual(sorted(self.allocator.get_new_haves(Peer(0), 0)[0]),
+                         list(range(10)))
+        for peer in peers:
+            self.allocator.remove_peer(peer)
+        self.assertEqual(self.allocator.get_resume_state(),
+                         (list(range(10)), {}))
+
+
+class RecheckAfterFinishTests(TestCase):
+    def setUp(self):
+        self.loader = Loader()
+        self.piece_length = 2 * BLOCK_LENGTH
+        self.data = bytes(index % 251 for index in range(4 * BLOCK_LENGTH))
+        torrent = make_torrent([len(self.data)], self.piece_length,
+                               self.data)
+        self.allocator = Allocator(torrent, None, LOGGER, self.loader,
+                                   storage_backend=STORAGE_MEMORY)
+        self.peer = Peer(1)
+        self.allocator.add_bitfield_info(b"\xc0", self.peer)
+
+    def tearDown(self):
+        self.allocator.close()
+
+    def _load_all(self):
+        while True:
+            block = self.allocator.try_get_block(self.peer)
+            if block is None:
+                return
+            piece_index, begin, length = block
+            start = piece_index * self.piece_length + begin
+            self.allocator.add_block(piece_index, begin,
+                                     self.data[start:start + length],
+                                     self.peer)
+
+    def test_bad_piece_after_finish_is_loaded_again(self):
+        self._load_all()
+        self.assertTrue(self.loader.finished.wait(5))
+        self.allocator.recheck()
+        self.assertEqual(self.loader.resumed_count, 0)
+        self.allocator._data_storage.write_run(1, [bytes(self.piece_length)])
+        self.allocator.recheck()
+        self.assertEqual(self.loader.resumed_count, 1)
+        self.assertFalse(self.loader.finished.is_set())
+        self.assertEqual(self.allocator.get_left_bytes_count(),
+                         self.piece_length)
+        self.assertEqual(self.allocator.try_get_block(self.peer),
+                         (1, 0, BLOCK_LENGTH))
+        self.allocator.release_block(1, 0, BLOCK_LENGTH, self.peer)
+        self._load_all()
+        self.assertTrue(self.loader.finished.wait(5))
+        self.assertEqual(self.allocator.get_left_bytes_count(), 0)
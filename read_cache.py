@@ -0,0 +1,78 @@
+import logging
+import threading
+from collections import OrderedDict
+
+DEFAULT_READ_CACHE_SIZE = 32 * 2 ** 20
+
+
+class PieceReadCache:
+    """
+    LRU cache of whole pieces for serving requests of peers. Peers
+    request pieces block by block, so on a miss the whole piece is read
+    ahead and next blocks are taken from memory. Size is counted in bytes
+    """
+    def __init__(self, data_storage, logger,
+                 max_size=DEFAULT_READ_CACHE_SIZE):
+        self.log = logging.getLogger(logger.name + ".ReadCache")
+        self.max_size = max_size
+        self._data_storage = data_storage
+        self._pieces = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._pieces)
+
+    def get_size(self):
+        return self._size
+
+    def get_stats(self):
+        return self.hits, self.misses, self.evictions
+
+    def get_segment(self, piece_index: int, begin: int, length: int):
+        with self._lock:
+            piece = self._pieces.get(piece_index)
+            if piece is not None:
+                self.hits += 1
+                self._pieces.move_to_end(piece_index)
+                return piece[begin:begin + length]
+            self.misses += 1
+        piece = self._data_storage.read_piece(piece_index)
+        if piece is None:
+            return None
+        with self._lock:
+            if piece_index not in self._pieces:
+                self._put(piece_index, piece)
+        return piece[begin:begin + length]
+
+    def peek_segment(self, piece_index: int, begin: int, length: int):
+        """
+        Returns segment only if piece is cached, nothing is read and
+        miss is not counted: caller sends block by other means
+        """
+        with self._lock:
+            piece = self._pieces.get(piece_index)
+            if piece is None:
+                return None
+            self.hits += 1
+            self._pieces.move_to_end(piece_index)
+            return piece[begin:begin + length]
+
+    def _put(self, piece_index, piece):
+        if len(piece) > self.max_size:
+            return
+        self._pieces[piece_index] = piece
+        self._size += len(piece)
+        while self._size > self.max_size:
+            index, evicted = self._pieces.popitem(last=False)
+            self._size -= len(evicted)
+            self.evictions += 1
+            self.log.debug("Piece %d evicted from read cache" % index)
+
+    def clear(self):
+        with self._lock:
+            self._pieces.clear()
+            self._size = 0
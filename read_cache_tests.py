@@ -0,0 +1,61 @@
+import logging
+from unittest import TestCase
+from read_cache import PieceReadCache
+
+LOGGER = logging.getLogger("test")
+
+
+class FakeStorage:
+    def __init__(self, piece_length):
+        self.piece_length = piece_length
+        self.reads = []
+
+    def read_piece(self, piece_index):
+        self.reads.append(piece_index)
+        if piece_index < 0:
+            return None
+        return bytes([piece_index]) * self.piece_length
+
+
+class PieceReadCacheTests(TestCase):
+    def test_whole_piece_is_read_ahead(self):
+        storage = FakeStorage(8)
+        cache = PieceReadCache(storage, LOGGER, max_size=64)
+        for begin in range(0, 8, 2):
+            self.assertEqual(cache.get_segment(3, begin, 2), b"\x03\x03")
+        self.assertEqual(storage.reads, [3])
+        self.assertEqual(cache.get_stats(), (3, 1, 0))
+        self.assertEqual(cache.get_size(), 8)
+
+    def test_least_recently_used_evicted(self):
+        storage = FakeStorage(8)
+        cache = PieceReadCache(storage, LOGGER, max_size=16)
+        cache.get_segment(0, 0, 1)
+        cache.get_segment(1, 0, 1)
+        cache.get_segment(0, 0, 1)
+        cache.get_segment(2, 0, 1)
+        self.assertEqual(cache.get_stats(), (1, 3, 1))
+        self.assertEqual(len(cache), 2)
+        cache.get_segment(1, 0, 1)
+        self.assertEqual(storage.reads, [0, 1, 2, 1])
+
+    def test_peek_does_not_read(self):
+        storage = FakeStorage(8)
+        cache = PieceReadCache(storage, LOGGER, max_size=16)
+        self.assertIsNone(cache.peek_segment(0, 0, 2))
+        cache.get_segment(0, 0, 2)
+        self.assertEqual(cache.peek_segment(0, 2, 2), b"\0\0")
+        self.assertEqual(storage.reads, [0])
+        self.assertEqual(cache.get_stats(), (1, 1, 0))
+
+    def test_not_readable_piece(self):
+        storage = FakeStorage(8)
+        cache = PieceReadCache(storage, LOGGER, max_size=16)
+        self.assertIsNone(cache.get_segment(-1, 0, 1))
+        self.assertEqual(len(cache), 0)
+
+    def test_piece_larger_than_cache(self):
+        storage = FakeStorage(32)
+        cache = PieceReadCache(storage, LOGGER, max_size=16)
+        self.assertEqual(cache.get_segment(1, 4, 2), b"\x01\x01")
+        self.assertEqual(len(cache), 0)
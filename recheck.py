@@ -0,0 +1,116 @@
+import os
+import time
+import hashlib
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+READ_CHUNK_SIZE = 16 * 2 ** 20
+
+
+def _hash_pieces(data, piece_length):
+    view = memoryview(data)
+    return b"".join(hashlib.sha1(view[start:start + piece_length]).digest()
+                    for start in range(0, len(view), piece_length))
+
+
+class Rechecker:
+    """
+    Checks pieces saved on disk against hashes from torrent-file. Files
+    are read sequentially by large chunks of consecutive pieces, chunks
+    are hashed on thread pool (hashlib releases GIL while hashing) while
+    next chunks are being read. Pieces touching not downloading files
+    are checked only if those bytes are kept in part file.
+    """
+    def __init__(self, data_storage, logger, workers=None,
+                 chunk_size=READ_CHUNK_SIZE):
+        self.log = logging.getLogger(logger.name + ".Rechecker")
+        self._data_storage = data_storage
+        self.files_index = data_storage.files_index
+        self.pieces_hashes = data_storage.torrent.pieces_hashes
+        self.piece_length = data_storage.torrent.piece_length
+        self.workers = workers or os.cpu_count() or 1
+        self.pieces_per_chunk = max(1, chunk_size // self.piece_length)
+        self.total_bytes = 0
+        self.checked_bytes = 0
+        self.start_time = None
+        self.finish_time = None
+
+    def get_speed(self):
+        """Checked bytes per second"""
+        if self.start_time is None:
+            return 0
+        time_span = (self.finish_time or time.time()) - self.start_time
+        return self.checked_bytes / time_span if time_span > 0 else 0
+
+    def get_chunks(self):
+        """List of (first piece index, count of pieces) to read and hash"""
+        chunks = []
+        first = None
+        for piece_index in range(self.files_index.pieces_count):
+            readable = self._data_storage.is_piece_readable(piece_index)
+            if first is not None and (
+                    not readable or
+                    piece_index - first == self.pieces_per_chunk):
+                chunks.append((first, piece_index - first))
+                first = None
+            if readable and first is None:
+                first = piece_index
+        if first is not None:
+            chunks.append((first, self.files_index.pieces_count - first))
+        return chunks
+
+    def _get_chunk_length(self, first, count):
+        start = first * self.piece_length
+        return min(count * self.piece_length,
+                   self.files_index.length - start)
+
+    def check(self, progress=None):
+        """
+        Returns list of checked pieces and set of correct ones.
+        progress(rechecker) is called after every chunk
+        """
+        chunks = self.get_chunks()
+        self.total_bytes = sum(self._get_chunk_length(first, count)
+                               for first, count in chunks)
+        self.checked_bytes = 0
+        self.start_time = time.time()
+        checked = []
+        correct = set()
+        pending = deque()
+        with ThreadPoolExecutor(self.workers) as pool:
+            for first, count in chunks:
+                length = self._get_chunk_length(first, count)
+                try:
+                    data = self._data_storage.read_piece_segment(
+                        first, 0, length)
+                except Exception as ex:
+                    self.log.error("Exception during reading pieces %d-%d: "
+                                   "%s" % (first, first + count - 1, str(ex)))
+                    data = None
+                future = None if data is None else \
+                    pool.submit(_hash_pieces, data, self.piece_length)
+                pending.append((first, count, length, future))
+                while len(pending) > 2 * self.workers:
+                    self._collect(pending.popleft(), checked, correct,
+                                  progress)
+            while pending:
+                self._collect(pending.popleft(), checked, correct, progress)
+        self.finish_time = time.time()
+        self.log.info("Recheck: %d of %d pieces are correct, %d bytes in "
+                      "%.3f sec" % (len(correct), len(checked),
+                                    self.checked_bytes,
+                                    self.finish_time - self.start_time))
+        return checked, correct
+
+    def _collect(self, chunk, checked, correct, progress):
+        first, count, length, future = chunk
+        checked.extend(range(first, first + count))
+        if future is not None:
+            results = self.pieces_hashes.compare(first, future.result())
+            correct.update(first + offset
+                           for offset, is_correct in enumerate(results)
+                           if is_correct)
+        self.checked_bytes += length
+        if progress is not None:
+            progress(self)
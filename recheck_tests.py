@@ -0,0 +1,48 @@
+import logging
+from unittest import TestCase
+from data_storage import DataStorage, STORAGE_MEMORY
+from recheck import Rechecker
+from torrent_fixtures import make_torrent
+
+LOGGER = logging.getLogger("test")
+PIECE_LENGTH = 4
+DATA = bytes(range(20))
+
+
+class RecheckerTests(TestCase):
+    def setUp(self):
+        self.torrent = make_torrent([5, 0, 3, 10, 2], PIECE_LENGTH, DATA)
+        self.storage = DataStorage(self.torrent, None, LOGGER,
+                                   backend=STORAGE_MEMORY)
+
+    def tearDown(self):
+        self.storage.close()
+
+    def test_all_pieces_correct(self):
+        self.storage.write_run(0, [DATA[start:start + PIECE_LENGTH]
+                                   for start in range(0, 20, PIECE_LENGTH)])
+        progress = []
+        rechecker = Rechecker(self.storage, LOGGER, workers=2, chunk_size=8)
+        checked, correct = rechecker.check(
+            lambda checker: progress.append(checker.checked_bytes))
+        self.assertEqual(checked, [0, 1, 2, 3, 4])
+        self.assertEqual(correct, {0, 1, 2, 3, 4})
+        self.assertEqual(progress, [8, 16, 20])
+        self.assertEqual(rechecker.total_bytes, 20)
+        self.assertGreater(rechecker.get_speed(), 0)
+
+    def test_wrong_and_not_checked_pieces(self):
+        self.storage.write_run(0, [DATA[0:4]])
+        self.storage.write_run(2, [b"abcd"])
+        self.storage.write_run(3, [DATA[12:16]])
+        self.torrent.files[4].is_downloading = False
+        rechecker = Rechecker(self.storage, LOGGER)
+        self.assertEqual(rechecker.get_chunks(), [(0, 4)])
+        checked, correct = rechecker.check()
+        self.assertEqual(checked, [0, 1, 2, 3])
+        self.assertEqual(correct, {0, 3})
+
+    def test_chunks_are_split(self):
+        self.torrent.files[2].is_downloading = False
+        rechecker = Rechecker(self.storage, LOGGER, chunk_size=8)
+        self.assertEqual(rechecker.get_chunks(), [(0, 1), (2, 2), (4, 1)])
@@ -0,0 +1,88 @@
+import time
+from collections import OrderedDict
+from torrent_info import Messages
+
+MIN_QUEUE_DEPTH = 2
+MAX_QUEUE_DEPTH = 64
+REQUEST_QUEUE_TIME_SEC = 3
+RATE_INTERVAL_SEC = 1
+RATE_SMOOTHING = 0.5
+
+
+class RequestQueue:
+    """
+    Outstanding block requests of one peer. Depth of queue follows
+    measured download rate of the peer: requests for queue_time of
+    loading (or for two round trips on slower links) are kept in flight,
+    so latency does not limit throughput, but not less than min_depth
+    and not more than max_depth. Round trip is the least time between
+    request and block, later samples include waiting in peer's queue.
+    Blocks are (piece index, begin, length)
+    """
+    def __init__(self, min_depth=MIN_QUEUE_DEPTH, max_depth=MAX_QUEUE_DEPTH,
+                 queue_time=REQUEST_QUEUE_TIME_SEC,
+                 block_length=Messages.piece_segment_length):
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.queue_time = queue_time
+        self.block_length = block_length
+        self._outstanding = OrderedDict()
+        self.rate = 0
+        self.min_rtt = None
+        self._interval_start = None
+        self._interval_bytes = 0
+
+    def __len__(self):
+        return len(self._outstanding)
+
+    def __contains__(self, block):
+        return block in self._outstanding
+
+    def get_depth(self):
+        queue_time = self.queue_time
+        if self.min_rtt is not None:
+            queue_time = max(queue_time, 2 * self.min_rtt)
+        depth = int(self.rate * queue_time / self.block_length)
+        return max(self.min_depth, min(self.max_depth, depth))
+
+    def is_full(self):
+        return len(self._outstanding) >= self.get_depth()
+
+    def add(self, block, now=None):
+        now = time.time() if now is None else now
+        if self._interval_start is None:
+            self._interval_start = now
+        self._outstanding[block] = now
+
+    def pop(self, block, now=None):
+        """
+        Removes received block and updates rate and round trip time.
+        Returns False if block was not requested
+        """
+        sent_time = self._outstanding.pop(block, None)
+        if sent_time is None:
+            return False
+        now = time.time() if now is None else now
+        if self.min_rtt is None or now - sent_time < self.min_rtt:
+            self.min_rtt = now - sent_time
+        self._interval_bytes += block[2]
+        elapsed = now - self._interval_start
+        if elapsed >= RATE_INTERVAL_SEC:
+            rate = self._interval_bytes / elapsed
+            self.rate = rate if self.rate == 0 else \
+                self.rate + RATE_SMOOTHING * (rate - self.rate)
+            self._interval_start = now
+            self._interval_bytes = 0
+        return True
+
+    def discard(self, block):
+        """Forgets request without measuring, returns False if no such"""
+        return self._outstanding.pop(block, None) is not None
+
+    def clear(self):
+        """Forgets all requests (e.g. peer choked), returns their blocks"""
+        blocks = list(self._outstanding)
+        self._outstanding.clear()
+        self._interval_start = None
+        self._interval_bytes = 0
+        return blocks
@@ -0,0 +1,59 @@
+from unittest import TestCase
+from request_queue import RequestQueue
+
+
+class RequestQueueTests(TestCase):
+    def test_received_blocks_are_matched(self):
+        requests = RequestQueue()
+        requests.add((0, 0, 16), now=0)
+        requests.add((0, 16, 16), now=0)
+        self.assertTrue((0, 16, 16) in requests)
+        self.assertFalse(requests.pop((0, 16, 8), now=1))
+        self.assertTrue(requests.pop((0, 16, 16), now=1))
+        self.assertFalse(requests.pop((0, 16, 16), now=1))
+        self.assertEqual(len(requests), 1)
+
+    def test_depth_follows_rate(self):
+        requests = RequestQueue(min_depth=2, max_depth=10, queue_time=2,
+                                block_length=100)
+        self.assertEqual(requests.get_depth(), 2)
+        requests.add((0, 0, 100), now=0)
+        requests.add((0, 100, 100), now=0)
+        self.assertTrue(requests.is_full())
+        requests.pop((0, 0, 100), now=0.1)
+        requests.pop((0, 100, 100), now=1)
+        self.assertEqual(requests.rate, 200)
+        self.assertEqual(requests.get_depth(), 4)
+        self.assertFalse(requests.is_full())
+
+    def test_depth_bounds(self):
+        requests = RequestQueue(min_depth=2, max_depth=10, queue_time=2,
+                                block_length=100)
+        requests.add((0, 0, 100), now=0)
+        requests.pop((0, 0, 100), now=5)
+        self.assertEqual(requests.get_depth(), 2)
+        requests.rate = 10 ** 6
+        self.assertEqual(requests.get_depth(), 10)
+
+    def test_long_round_trip(self):
+        requests = RequestQueue(min_depth=1, max_depth=100, queue_time=1,
+                                block_length=100)
+        requests.add((0, 0, 100), now=0)
+        requests.pop((0, 0, 100), now=2)
+        requests.rate = 1000
+        self.assertEqual(requests.get_depth(), 40)
+
+    def test_clear(self):
+        requests = RequestQueue()
+        requests.add((1, 0, 16))
+        requests.add((2, 0, 16))
+        self.assertEqual(requests.clear(), [(1, 0, 16), (2, 0, 16)])
+        self.assertEqual(len(requests), 0)
+
+    def test_discard(self):
+        requests = RequestQueue()
+        requests.add((1, 0, 16), now=0)
+        self.assertTrue(requests.discard((1, 0, 16)))
+        self.assertFalse(requests.discard((1, 0, 16)))
+        self.assertIsNone(requests.min_rtt)
+
@@ -0,0 +1,133 @@
+import os
+import logging
+from bencode import BencodeDecoder, BencodeEncoder
+from torrent_info import TorrentMeta, Messages
+
+FORMAT_VERSION = 1
+RESUME_SUFFIX = ".resume"
+
+
+def get_files_stats(torrent: TorrentMeta):
+    """[is_downloading, size, mtime_ns] of every file, size of missing is -1"""
+    stats = []
+    for file_record in torrent.files:
+        try:
+            stat = os.stat(file_record.path)
+            size, mtime = stat.st_size, stat.st_mtime_ns
+        except (OSError, TypeError):
+            size, mtime = -1, 0
+        stats.append([int(file_record.is_downloading), size, mtime])
+    return stats
+
+
+def pack_pieces(piece_indices, pieces_count):
+    bitfield = bytearray(-(-pieces_count // 8))
+    for piece_index in piece_indices:
+        bitfield[piece_index // 8] |= 0x80 >> (piece_index % 8)
+    return bytes(bitfield)
+
+
+def unpack_pieces(bitfield, pieces_count):
+    return [piece_index for piece_index in range(pieces_count)
+            if bitfield[piece_index // 8] & (0x80 >> (piece_index % 8))]
+
+
+class ResumeFile:
+    """
+    Fast-resume data of torrent: saved pieces, size and modification time
+    of files at the moment of saving and beginnings of partially
+    downloaded pieces. Pieces touching files which were changed since
+    then are not trusted and will be downloaded again.
+    """
+    def __init__(self, dir_path: str, torrent: TorrentMeta, save_path: str,
+                 logger_name="bt"):
+        self.log = logging.getLogger(logger_name + ".ResumeFile")
+        self.torrent = torrent
+        self.save_path = save_path
+        self.path = os.path.join(dir_path,
+                                 torrent.info_hash.hex() + RESUME_SUFFIX)
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path, exist_ok=True)
+
+    def save(self, have_pieces, partial_pieces):
+        files_index = self.torrent.files_index
+        content = {
+            b"version": FORMAT_VERSION,
+            b"info hash": self.torrent.info_hash,
+            b"save path": self.save_path.encode(),
+            b"pieces": pack_pieces(have_pieces, files_index.pieces_count),
+            b"files": get_files_stats(self.torrent),
+            b"partial": [[piece_index, bytes(data)] for piece_index, data
+                         in sorted(partial_pieces.items())],
+        }
+        temp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        try:
+            with open(temp_path, 'wb') as file:
+                file.write(BencodeEncoder().encode(content))
+            os.replace(temp_path, self.path)
+        except OSError as ex:
+            self.log.error("Exception during writing resume file '%s': %s"
+                           % (self.path, str(ex)))
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return False
+        self.log.info("Resume file saved: %d pieces, %d partial pieces"
+                      % (len(have_pieces), len(partial_pieces)))
+        return True
+
+    def load(self):
+        """
+        Returns list of saved pieces which can be trusted and dict of
+        partial pieces (piece index: downloaded beginning) or None
+        """
+        try:
+            with open(self.path, 'rb') as file:
+                data = file.read()
+        except OSError:
+            return None
+        try:
+            return self._validate(BencodeDecoder(data).decode(0)[0])
+        except Exception as ex:
+            self.log.error("Broken resume file '%s': %s"
+                           % (self.path, str(ex)))
+            return None
+
+    def _validate(self, content):
+        files_index = self.torrent.files_index
+        pieces_count = files_index.pieces_count
+        if content[b"version"] != FORMAT_VERSION:
+            raise ValueError("unknown version %d" % content[b"version"])
+        if content[b"info hash"] != self.torrent.info_hash:
+            raise ValueError("info hash differs")
+        if content[b"save path"] != self.save_path.encode():
+            self.log.info("Resume file is for other save path")
+            return None
+        if len(content[b"pieces"]) != -(-pieces_count // 8) or \
+                len(content[b"files"]) != len(self.torrent.files):
+            raise ValueError("wrong count of pieces or files")
+
+        not_trusted = set()
+        current_stats = get_files_stats(self.torrent)
+        for file_record, saved, current in zip(
+                self.torrent.files, content[b"files"], current_stats):
+            if file_record.length > 0 and current[0] and saved != current:
+                self.log.info("File was changed since resume data saving: "
+                              "'%s'" % file_record.path)
+                not_trusted.update(range(file_record.pieces_from,
+                                         file_record.pieces_to + 1))
+
+        have_pieces = [piece_index for piece_index
+                       in unpack_pieces(content[b"pieces"], pieces_count)
+                       if piece_index not in not_trusted]
+        have = set(have_pieces)
+        partial_pieces = dict()
+        for piece_index, piece in content[b"partial"]:
+            if 0 <= piece_index < pieces_count and \
+                    piece_index not in have and \
+                    0 < len(piece) < files_index.get_piece_length(
+                        piece_index) and \
+                    len(piece) % Messages.piece_segment_length == 0:
+                partial_pieces[piece_index] = piece
+        return have_pieces, partial_pieces
@@ -0,0 +1,71 @@
+import os
+import shutil
+import logging
+import tempfile
+from unittest import TestCase
+from data_storage import DataStorage
+from resume import ResumeFile, pack_pieces, unpack_pieces
+from torrent_fixtures import make_torrent
+
+LOGGER = logging.getLogger("test")
+
+
+class ResumeFileTests(TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.save_dir = os.path.join(self.root_dir, "data")
+        self.resume_dir = os.path.join(self.root_dir, "resume")
+        os.makedirs(self.save_dir)
+        self.torrent = make_torrent([5, 0, 3, 10, 2], 4)
+        self.segment = b"x" * 2 ** 14
+        storage = DataStorage(self.torrent, self.save_dir, LOGGER)
+        storage.write_run(0, [bytes(4)] * 5)
+        storage.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def _make_resume_file(self, save_dir=None):
+        return ResumeFile(self.resume_dir, self.torrent,
+                          save_dir or self.save_dir, "test")
+
+    def test_pack_pieces(self):
+        bitfield = pack_pieces([0, 3, 9], 10)
+        self.assertEqual(bitfield, b"\x90\x40")
+        self.assertEqual(unpack_pieces(bitfield, 10), [0, 3, 9])
+
+    def test_save_and_load(self):
+        self.assertIsNone(self._make_resume_file().load())
+        self.assertTrue(self._make_resume_file().save([0, 2, 4], dict()))
+        self.assertEqual(self._make_resume_file().load(), ([0, 2, 4], {}))
+
+    def test_changed_file_is_not_trusted(self):
+        self._make_resume_file().save([0, 1, 2, 3, 4], dict())
+        with open(self.torrent.files[2].path, 'r+b') as file:
+            file.write(b"abcd")
+        self.assertEqual(self._make_resume_file().load()[0], [0, 2, 3, 4])
+
+    def test_newly_selected_file_is_not_trusted(self):
+        self.torrent.files[4].is_downloading = False
+        self._make_resume_file().save([0, 1, 2, 3, 4], dict())
+        self.torrent.files[4].is_downloading = True
+        self.assertEqual(self._make_resume_file().load()[0], [0, 1, 2, 3])
+
+    def test_partial_pieces(self):
+        os.remove(self.torrent.files[0].path)
+        self.torrent = make_torrent([2 ** 16], 2 ** 15)
+        DataStorage(self.torrent, self.save_dir, LOGGER).close()
+        partial = {0: self.segment, 1: self.segment * 2}
+        self._make_resume_file().save([], partial)
+        self.assertEqual(self._make_resume_file().load(),
+                         ([], {0: self.segment}))
+
+    def test_other_save_path(self):
+        self._make_resume_file().save([0], dict())
+        self.assertIsNone(self._make_resume_file(self.root_dir).load())
+
+    def test_broken_file(self):
+        resume_file = self._make_resume_file()
+        with open(resume_file.path, 'wb') as file:
+            file.write(b"d7:versioni1e")
+        self.assertIsNone(resume_file.load())
@@ -0,0 +1,29 @@
+import hashlib
+from bencode import BencodeDecoder, BencodeDictView
+from torrent_info import TorrentMeta
+
+
+def make_torrent_source(files_lengths, piece_length, data=None,
+                        name=b"dir"):
+    """
+    Bencoded multi-file torrent with files f0, f1, ... in directory name.
+    Hashes of pieces are hashes of data if it is given, else filler
+    """
+    files = b"".join(b"d6:lengthi%de4:pathl2:f%dee" % (length, index)
+                     for index, length in enumerate(files_lengths))
+    if data is None:
+        pieces_count = -(-sum(files_lengths) // piece_length)
+        pieces = b"x" * pieces_count * 20
+    else:
+        pieces = b"".join(
+            hashlib.sha1(data[start:start + piece_length]).digest()
+            for start in range(0, len(data), piece_length))
+    return b"d8:announce3:url4:infod5:filesl" + files + \
+        b"e4:name%d:%s12:piece lengthi%de6:pieces%d:" \
+        % (len(name), name, piece_length, len(pieces)) + pieces + b"ee"
+
+
+def make_torrent(files_lengths, piece_length, data=None,
+                 logger_name="test"):
+    source = make_torrent_source(files_lengths, piece_length, data)
+    return TorrentMeta(BencodeDictView(BencodeDecoder(source)), logger_name)
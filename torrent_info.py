@@ -1,17 +1,22 @@
+import bisect
 import hashlib
 import logging
+import threading
 import traceback
-from bencode import BencodeTranslator
+from collections import namedtuple
+from bencode import BencodeTranslator, BencodeDictView
+
+HASH_LENGTH = 20
 
 
 class TorrentMeta:
-    def __init__(self, bencode_source, subprogram_logger_name):
+    def __init__(self, bencode_source, subprogram_logger_name,
+                 raw_info=None, info_hash=None):
         self.log = logging.getLogger(subprogram_logger_name + ".TorrentMeta")
         self.log.info("Start interpreting of torrent")
 
         self._announce = self.try_get_key(bencode_source, b"announce")
         self._info = self.try_get_key(bencode_source, b"info")
-        self.info_hash = self._calc_info_hash()
 
         self.announce_list = [self._announce]
         self.creation_date = None
@@ -29,17 +34,8 @@ class TorrentMeta:
             self.created_by = bencode_source[b"created by"]
 
         self.piece_length = self.try_get_key(self._info, b"piece length")
-        try:
-            length = len(self.try_get_key(self._info, b"pieces"))
-            self.pieces_hashes = [
-                self._info[b"pieces"][index:index + 20]
-                for index in range(0, length, 20)]
-        except IndexError as ex:
-            self.log.error("Exception '%s' "
-                           "during parsing pieces hashes\n %s"
-                           % (str(ex), traceback.format_exc()))
-            raise ValueError("Incorrect torrent file: "
-                             "not enough pieces hashes count")
+        self.check_key(self._info, b"pieces")
+        self._pieces_hashes = None
 
         self.private = None
         self.md5sum = None
@@ -53,24 +49,145 @@ class TorrentMeta:
 
         self.file_name = None
         self.dir_name = None
-        self.length = None
-        self.files = None
+        self._length = None
+        self._files = None
+        self._files_index = None
+        self._lock = threading.Lock()
 
         if b"length" in self._info.keys():
             self.is_one_file = True
             self.file_name = self.try_get_key(self._info, b"name")
-            self.length = self.try_get_key(self._info, b"length")
+            self._length = self.try_get_key(self._info, b"length")
             self.dir_name = b""
-            self.files = [FileRecord(
-                {b"length": self.length, b"path": [self.file_name]}, 0, self)]
         else:
             self.is_many_files = True
-            self.dir_name = b"\\" + self.try_get_key(self._info, b"name")
-            self.length = 0
-            self.files = []
-            for record in self.try_get_key(self._info, b"files"):
-                self.files.append(FileRecord(record, self.length, self))
-                self.length += self.files[-1].length
+            self.dir_name = self.try_get_key(self._info, b"name")
+            self.check_key(self._info, b"files")
+
+        if info_hash is not None:
+            self.info_hash = info_hash
+        else:
+            if raw_info is None and \
+                    isinstance(bencode_source, BencodeDictView):
+                raw_info = bencode_source.raw(b"info")
+            self.info_hash = self._calc_info_hash(raw_info)
+
+    @staticmethod
+    def from_state(state, subprogram_logger_name):
+        info_hash, source = state
+        return TorrentMeta(source, subprogram_logger_name,
+                           info_hash=info_hash)
+
+    def get_state(self):
+        """
+        Returns info hash and decoded fields of torrent (only plain
+        dictionaries, lists, bytes and ints), enough to restore it
+        with from_state without any bencode decoding
+        """
+        info = {
+            b"name": self._info[b"name"],
+            b"piece length": self.piece_length,
+            b"pieces": self.pieces_hashes.tobytes(),
+        }
+        if self.is_one_file:
+            info[b"length"] = self._length
+        else:
+            info[b"files"] = [
+                {key: record[key] for key in (b"length", b"path", b"md5sum")
+                 if key in record}
+                for record in self._info[b"files"]]
+        if self.private is not None:
+            info[b"private"] = self.private
+        if self.md5sum is not None:
+            info[b"md5sum"] = self.md5sum
+        source = {
+            b"announce": self._announce,
+            b"announce-list": [[url] for url in self.announce_list[1:]],
+            b"info": info,
+        }
+        if self.creation_date is not None:
+            source[b"creation date"] = self.creation_date
+        if self.comment is not None:
+            source[b"comment"] = self.comment
+        if self.created_by is not None:
+            source[b"created by"] = self.created_by
+        return self.info_hash, source
+
+    @property
+    def pieces_hashes(self):
+        with self._lock:
+            if self._pieces_hashes is None:
+                pieces = self._info[b"pieces"]
+                if len(pieces) % HASH_LENGTH != 0:
+                    self.log.error("Length of pieces hashes %d is not "
+                                   "multiple of %d"
+                                   % (len(pieces), HASH_LENGTH))
+                    raise ValueError("Incorrect torrent file: "
+                                     "not enough pieces hashes count")
+                self._pieces_hashes = PieceHashes(pieces)
+            return self._pieces_hashes
+
+    @property
+    def files(self):
+        """
+        File records are built on first access: with lazy bencode source
+        entries of 'files' are not even decoded before that
+        """
+        self._read_files()
+        return self._files
+
+    @property
+    def files_index(self):
+        self._read_files()
+        with self._lock:
+            if self._files_index is None:
+                self._files_index = FilesIndex(
+                    self._files, self.piece_length, self._length)
+            return self._files_index
+
+    @property
+    def length(self):
+        self._read_files()
+        return self._length
+
+    def _read_files(self):
+        with self._lock:
+            if self._files is None:
+                self._build_files()
+
+    def _build_files(self):
+        if self.is_one_file:
+            self._files = [FileRecord(
+                {b"length": self._length, b"path": [self.file_name]},
+                0, self)]
+            return
+        offset = 0
+        files = []
+        for record in self._info[b"files"]:
+            files.append(FileRecord(record, offset, self))
+            offset += files[-1].length
+        self._files = files
+        self._length = offset
+
+    def check_structure(self):
+        """
+        Cheap checks of values which are interpreted lazily (length of
+        pieces hashes, lengths and paths of files), so incorrect file is
+        rejected at once, not by the first thread which touches it
+        """
+        pieces_length = len(self._info[b"pieces"])
+        if pieces_length % HASH_LENGTH != 0:
+            raise ValueError("Incorrect torrent file: length of pieces "
+                             "hashes %d is not multiple of %d"
+                             % (pieces_length, HASH_LENGTH))
+        if not self.is_many_files:
+            return
+        for record in self._info[b"files"]:
+            length = self.try_get_key(record, b"length")
+            self.check_key(record, b"path")
+            if not isinstance(length, int) or length < 0:
+                raise ValueError("Incorrect torrent file: wrong length "
+                                 "of file")
 
     def try_get_key(self, source: dict, key: bytes):
         try:
@@ -83,7 +200,17 @@ class TorrentMeta:
                              "value '%s' is absent in torrent-file"
                              % key.decode())
 
-    def _calc_info_hash(self):
+    def check_key(self, source: dict, key: bytes):
+        if key not in source.keys():
+            self.log.error("Exception during parsing torrent. "
+                           "Value '%s' is absent" % key)
+            raise ValueError("Incorrect torrent file: "
+                             "value '%s' is absent in torrent-file"
+                             % key.decode())
+
+    def _calc_info_hash(self, raw_info=None):
+        if raw_info is not None:
+            return get_sha_1_hash(raw_info)
         info_bencode = BencodeTranslator.translate_to_bencode(self._info)
         return get_sha_1_hash(info_bencode)
 
@@ -105,6 +232,121 @@ class FileRecord:
                          (0 if finish % torrent_meta.piece_length > 0 else 1)
 
 
+FileSegment = namedtuple(
+    "FileSegment", ["file", "file_offset", "piece_offset", "length"])
+
+
+class FilesIndex:
+    """
+    Maps byte ranges of torrent (and pieces) to segments of files with
+    bisect over file offsets instead of scanning all files
+    """
+    def __init__(self, files, piece_length: int, length: int):
+        self.files = [file for file in files if file.length > 0]
+        self._offsets = [file.offset for file in self.files]
+        self.piece_length = piece_length
+        self.length = length
+        self.pieces_count = length // piece_length + \
+            (1 if length % piece_length > 0 else 0)
+
+    def get_piece_length(self, piece_index: int):
+        if piece_index == self.pieces_count - 1:
+            return self.length - piece_index * self.piece_length
+        return self.piece_length
+
+    def find_file(self, start_byte: int):
+        """Returns file record containing start_byte and offset in it"""
+        if not 0 <= start_byte < self.length:
+            return None
+        position = bisect.bisect_right(self._offsets, start_byte) - 1
+        file_record = self.files[position]
+        return file_record, start_byte - file_record.offset
+
+    def get_segments(self, start_byte: int, length: int):
+        """
+        Returns list of FileSegment for bytes [start_byte,
+        start_byte + length), piece_offset is counted from start_byte
+        """
+        segments = []
+        if length <= 0 or not 0 <= start_byte < self.length:
+            return segments
+        position = bisect.bisect_right(self._offsets, start_byte) - 1
+        finish_byte = min(start_byte + length, self.length)
+        current = start_byte
+        while current < finish_byte:
+            file_record = self.files[position]
+            finish = min(finish_byte, file_record.offset + file_record.length)
+            segments.append(FileSegment(
+                file_record, current - file_record.offset,
+                current - start_byte, finish - current))
+            current = finish
+            position += 1
+        return segments
+
+    def get_piece_segments(self, piece_index: int):
+        return self.get_segments(piece_index * self.piece_length,
+                                 self.get_piece_length(piece_index))
+
+    def get_downloading_pieces(self):
+        """List of flags: whether piece touches any selected file"""
+        flags = [False] * self.pieces_count
+        for file_record in self.files:
+            if file_record.is_downloading:
+                for piece_index in range(file_record.pieces_from,
+                                         file_record.pieces_to + 1):
+                    flags[piece_index] = True
+        return flags
+
+
+class PieceHashes:
+    """
+    Table of SHA-1 hashes of pieces over the single 'pieces' buffer of
+    torrent: items are memoryview slices, nothing is copied per piece
+    """
+    def __init__(self, pieces):
+        self._view = memoryview(pieces)
+        self._count = len(self._view) // HASH_LENGTH
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, piece_index: int):
+        if not 0 <= piece_index < self._count:
+            raise IndexError("Piece index %d out of range" % piece_index)
+        start = piece_index * HASH_LENGTH
+        return self._view[start:start + HASH_LENGTH]
+
+    def __iter__(self):
+        for piece_index in range(self._count):
+            yield self[piece_index]
+
+    def is_correct(self, piece_index: int, digest):
+        return self[piece_index] == digest
+
+    def is_piece_correct(self, piece_index: int, piece):
+        return self.is_correct(piece_index, get_sha_1_hash(piece))
+
+    def compare(self, first_index: int, digests):
+        """
+        Compares concatenated digests of pieces starting from first_index
+        with the table. Returns list of booleans, one for every piece
+        """
+        digests = memoryview(digests)
+        count = len(digests) // HASH_LENGTH
+        start = first_index * HASH_LENGTH
+        finish = start + count * HASH_LENGTH
+        if first_index < 0 or first_index + count > self._count:
+            raise IndexError("Pieces %d-%d out of range"
+                             % (first_index, first_index + count - 1))
+        if self._view[start:finish] == digests[:count * HASH_LENGTH]:
+            return [True] * count
+        return [self._view[start + offset:start + offset + HASH_LENGTH] ==
+                digests[offset:offset + HASH_LENGTH]
+                for offset in range(0, count * HASH_LENGTH, HASH_LENGTH)]
+
+    def tobytes(self):
+        return self._view.tobytes()
+
 
 def int_to_four_bytes_big_endian(number):
     return number.to_bytes(4, byteorder='big')
@@ -0,0 +1,108 @@
+import os
+from unittest import TestCase
+from bencode import BencodeDecoder, BencodeDictView
+from torrent_info import TorrentMeta, PieceHashes, get_sha_1_hash
+from torrent_fixtures import make_torrent
+
+SAMPLES_DIR = "samples"
+
+
+def _read_samples():
+    for name in sorted(os.listdir(SAMPLES_DIR)):
+        if name.endswith(".torrent"):
+            with open(os.path.join(SAMPLES_DIR, name), 'rb') as file:
+                yield name, file.read()
+
+
+class TorrentMetaTests(TestCase):
+    def test_lazy_same_as_eager(self):
+        for name, source in _read_samples():
+            decoder = BencodeDecoder(source)
+            eager = TorrentMeta(decoder.parse()[0], "test")
+            lazy = TorrentMeta(BencodeDictView(decoder), "test")
+            self.assertEqual(lazy.info_hash, eager.info_hash, name)
+            self.assertEqual(lazy.announce_list, eager.announce_list, name)
+            self.assertEqual(lazy.dir_name, eager.dir_name, name)
+            self.assertEqual(lazy.length, eager.length, name)
+            self.assertEqual(lazy.pieces_hashes.tobytes(),
+                             eager.pieces_hashes.tobytes(), name)
+            self.assertEqual(
+                [(f.local_path, f.offset, f.length) for f in lazy.files],
+                [(f.local_path, f.offset, f.length) for f in eager.files],
+                name)
+
+    def test_lazy_files_not_decoded_before_access(self):
+        source = b"d8:announce3:url4:infod5:filesld6:lengthi5e4:pathl1:a" \
+                 b"eed6:lengthi7e4:pathl1:beee4:name3:dir" \
+                 b"12:piece lengthi4e6:pieces60:" + b"x" * 60 + b"ee"
+        content = BencodeDictView(BencodeDecoder(source))
+        torrent = TorrentMeta(content, "test")
+        self.assertIsNone(torrent._files)
+        self.assertEqual(torrent.length, 12)
+        self.assertEqual(torrent.files[1].offset, 5)
+        self.assertEqual(torrent.files[1].pieces_from, 1)
+        self.assertEqual(torrent.files[1].pieces_to, 2)
+
+
+class FilesIndexTests(TestCase):
+    def setUp(self):
+        self.torrent = make_torrent([5, 0, 3, 10, 2], 4)
+        self.index = self.torrent.files_index
+
+    def test_find_file(self):
+        files = self.torrent.files
+        self.assertEqual(self.index.find_file(0), (files[0], 0))
+        self.assertEqual(self.index.find_file(5), (files[2], 0))
+        self.assertEqual(self.index.find_file(12), (files[3], 4))
+        self.assertEqual(self.index.find_file(19), (files[4], 1))
+        self.assertIsNone(self.index.find_file(20))
+
+    def test_piece_segments(self):
+        files = self.torrent.files
+        segments = self.index.get_piece_segments(1)
+        self.assertListEqual(
+            [(segment.file, segment.file_offset,
+              segment.piece_offset, segment.length)
+             for segment in segments],
+            [(files[0], 4, 0, 1), (files[2], 0, 1, 3)])
+        segments = self.index.get_piece_segments(4)
+        self.assertListEqual(
+            [(segment.file, segment.length) for segment in segments],
+            [(files[3], 2), (files[4], 2)])
+
+    def test_segments_cover_all_pieces(self):
+        for piece_index in range(self.index.pieces_count):
+            segments = self.index.get_piece_segments(piece_index)
+            self.assertEqual(sum(segment.length for segment in segments),
+                             self.index.get_piece_length(piece_index))
+
+    def test_downloading_pieces(self):
+        for file_record in self.torrent.files:
+            file_record.is_downloading = False
+        self.torrent.files[2].is_downloading = True
+        self.assertListEqual(self.index.get_downloading_pieces(),
+                             [False, True, False, False, False])
+
+
+class PieceHashesTests(TestCase):
+    def setUp(self):
+        self.pieces = [b"first", b"second", b"third"]
+        self.hashes = PieceHashes(
+            b"".join(get_sha_1_hash(piece) for piece in self.pieces))
+
+    def test_items(self):
+        self.assertEqual(len(self.hashes), 3)
+        self.assertEqual(self.hashes[1], get_sha_1_hash(b"second"))
+        self.assertIsInstance(self.hashes[1], memoryview)
+        self.assertRaises(IndexError, self.hashes.__getitem__, 3)
+
+    def test_is_piece_correct(self):
+        self.assertTrue(self.hashes.is_piece_correct(2, b"third"))
+        self.assertFalse(self.hashes.is_piece_correct(2, b"second"))
+
+    def test_compare(self):
+        digests = get_sha_1_hash(b"second") + get_sha_1_hash(b"third")
+        self.assertListEqual(self.hashes.compare(1, digests), [True, True])
+        digests = get_sha_1_hash(b"second") + get_sha_1_hash(b"wrong")
+        self.assertListEqual(self.hashes.compare(1, digests), [True, False])
+        self.assertRaises(IndexError, self.hashes.compare, 2, digests)
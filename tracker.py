@@ -4,7 +4,7 @@ import logging
 from random import Random
 from socket import socket, SOCK_DGRAM, AF_INET, gaierror
 import requests
-from bencode import BencodeParser
+from bencode import BencodeStreamDecoder
 from peer import PeerConnection
 from torrent_info import int_to_four_bytes_big_endian, bytes_to_int
 
@@ -14,6 +14,7 @@ FIRST_NUMWANT = 50
 NUMWANT = 50
 PORT = 6889
 CHECK_PAUSE_SEC = 5
+HTTP_CHUNK_SIZE = 2 ** 14
 
 
 def _parse_peers_ip_and_port(tracker_answer):
@@ -43,14 +44,19 @@ def _convert_str_to_pair_address(url):
 
 def _connect_http(tracker_url, params, logger: logging.Logger, loader):
     try:
-        response = requests.get(tracker_url, params=params)
+        response = requests.get(tracker_url, params=params, stream=True)
+        decoder = BencodeStreamDecoder()
         try:
-            tracker_answer = BencodeParser.parse(response.content)[0]
+            for chunk in response.iter_content(HTTP_CHUNK_SIZE):
+                decoder.feed(chunk)
+            tracker_answer = decoder.results()[0]
             return tracker_answer
         except Exception as ex:
-            logger.error("Exception in parsing loader '%s' answer: %s\n %s"
-                         % (tracker_url.decode(), str(ex), response.content))
+            logger.error("Exception in parsing loader '%s' answer: %s"
+                         % (tracker_url.decode(), str(ex)))
             return None
+        finally:
+            response.close()
     except Exception as ex:
         logger.error("Exception during HTTP connection with loader '%s':"
                      "\n %s" % (tracker_url.decode(), str(ex)))